@@ -0,0 +1,180 @@
+"""
+End-to-end admin throughput benchmark over loopback.
+
+Starts a stand-in OpenTTD admin server in a separate process. The server
+answers the Join handshake and then blasts a configurable mix of admin
+packets at a regular AdminSocket client. The client reports sustained
+packets/sec, sampled decode latency percentiles and CPU time per packet:
+
+    python benchmarks/admin_loopback.py -n 200000 -m Date=1,Chat=2,CmdLogging=6,CompanyEconomy=1
+"""
+import os, sys
+import json
+import multiprocessing
+import platform
+import resource
+import socket
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+try:
+    from libopenttd import packets
+    from libopenttd.admin import AdminSocket, AdminServerSocket, send, recv
+    from libopenttd.packets.base import ProtocolInformation
+    from libopenttd.packets.enums import Action, DestType, UpdateType, UpdateFrequency
+    from libopenttd.packets.packetsocket import encode_packet
+    from libopenttd.utils.clock import perf_counter
+except ImportError:
+    print("Somehow we were unable to load libopenttd, please make sure it's in python's path.")
+    raise
+
+from datetime import datetime
+from optparse import OptionParser
+
+PARSER = OptionParser()
+PARSER.add_option("-n", "--packets", action="store", type="int", dest="packets", default=200000,
+    help="The amount of packets the server sends after the handshake")
+PARSER.add_option("-m", "--mix", action="store", type="string", dest="mix",
+    default="Date=1,Chat=2,CmdLogging=6,CompanyEconomy=1",
+    help="Comma separated Packet=weight list of packets to send")
+PARSER.add_option("-s", "--sample-rate", action="store", type="float", dest="sample_rate", default=0.01,
+    help="Fraction of decodes to time for the latency percentiles")
+PARSER.add_option("-c", "--chunk-size", action="store", type="int", dest="chunk_size", default=64 * 1024,
+    help="Amount of bytes the server writes per send call")
+
+SAMPLE_PACKETS = {
+    'Date':             recv.Date(date = datetime(1950, 1, 1)),
+    'Chat':             recv.Chat(action = Action.CHAT, dest_type = DestType.BROADCAST, client_id = 2,
+                                  message = 'Hello there, anyone up for a game of OpenTTD?', data = 0),
+    'Console':          recv.Console(origin = 'net', message = 'Client #2 joined the game'),
+    'CmdLogging':       recv.CmdLogging(client_id = 2, company_id = 0, command_id = 42, params = [1, 0x100],
+                                        tile = 0x1234, text = '', frame = 123456),
+    'CompanyEconomy':   recv.CompanyEconomy(company_id = 0, money = 1000000, current_loan = 300000,
+                                            income = 25000, delivered = 120, history = [
+                                                {'value': 900000, 'performance': 500, 'delivered': 100},
+                                                {'value': 800000, 'performance': 450, 'delivered': 90},
+                                            ]),
+    'CompanyStats':     recv.CompanyStats(company_id = 0,
+                                          vehicles = {'train': 10, 'lorry': 5, 'bus': 3, 'plane': 1, 'ship': 0},
+                                          stations = {'train': 4, 'lorry': 2, 'bus': 2, 'plane': 1, 'ship': 0}),
+}
+
+def parse_mix(mix):
+    weights = []
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        if name not in SAMPLE_PACKETS:
+            raise ValueError("Unknown packet '%s', expected one of: %s" % (name, ', '.join(sorted(SAMPLE_PACKETS))))
+        weights.append((name, int(weight or 1)))
+    return weights
+
+def build_chunk(weights, chunk_size):
+    """
+    Returns a list of pre-encoded frames following the given mix, adding up
+    to at least chunk_size bytes, so the server spends its time writing
+    rather than encoding.
+    """
+    extra = ProtocolInformation(packets.constants.NETWORK_GAME_ADMIN_VERSION)
+    cycle = []
+    for name, weight in weights:
+        cycle.extend([encode_packet(SAMPLE_PACKETS[name], extra)] * weight)
+    frames = []
+    size = 0
+    while size < chunk_size:
+        frames.extend(cycle)
+        size += sum([len(frame) for frame in cycle])
+    return frames
+
+def serve(listener, weights, count, chunk_size):
+    conn, addr = listener.accept()
+    listener.close()
+    sock = AdminServerSocket.from_socket(conn, addr)
+    joined = False
+    while not joined:
+        if not sock.process_recv():
+            return
+        joined = any([isinstance(packet, send.Join) for packet in sock.process_packets()])
+
+    settings = dict([(update_type, UpdateFrequency.POLL | UpdateFrequency.AUTOMATIC | UpdateFrequency.DAILY)
+                     for update_type in range(UpdateType._END)])
+    sock.send_packet(recv.Protocol(version = packets.constants.NETWORK_GAME_ADMIN_VERSION, settings = settings))
+    sock.send_packet(recv.Welcome(name = 'Loopback benchmark', version = 'bench', dedicated = True,
+                                  map_name = 'Benchmark', seed = 0, landscape = 0,
+                                  startyear = datetime(1950, 1, 1), size_x = 256, size_y = 256))
+    while sock.buffer.write_avail:
+        sock.process_send()
+
+    frames = build_chunk(weights, chunk_size)
+    chunk = ''.join(frames)
+    sent = 0
+    try:
+        while sent + len(frames) <= count:
+            sock.sendall(chunk)
+            sent += len(frames)
+        sock.sendall(''.join(frames[:count - sent]))
+    finally:
+        sock.close()
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run(options):
+    weights = parse_mix(options.mix)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    address = listener.getsockname()
+    server = multiprocessing.Process(target = serve, args = (listener, weights, options.packets, options.chunk_size))
+    server.start()
+    listener.close()
+
+    latencies = []
+    mixed = set([type(SAMPLE_PACKETS[name]) for name, _ in weights])
+    def record_latency(point, target, result, elapsed):
+        if target.packet in mixed:
+            latencies.append(elapsed)
+
+    client = AdminSocket()
+    client.connect(address)
+    client.send_packet(send.Join(password = 'bench', name = 'bench', version = 'bench'))
+    client.process_send()
+
+    received = 0
+    packets.hooks.register('decode', record_latency, options.sample_rate)
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    start = perf_counter()
+    try:
+        while client.connected and received < options.packets:
+            client.process_recv()
+            received += len([packet for packet in client.process_packets() if type(packet) in mixed])
+    finally:
+        elapsed = perf_counter() - start
+        usage_end = resource.getrusage(resource.RUSAGE_SELF)
+        packets.hooks.unregister('decode', record_latency)
+        client.close()
+        server.join()
+
+    cpu = (usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime)
+    return {
+        'python':           platform.python_version(),
+        'platform':         platform.platform(),
+        'mix':              dict(weights),
+        'packets':          received,
+        'seconds':          elapsed,
+        'packets_per_sec':  received / elapsed if elapsed else None,
+        'cpu_seconds':      cpu,
+        'cpu_us_per_packet': cpu * 1e6 / received if received else None,
+        'decode_samples':   len(latencies),
+        'decode_p50_us':    percentile(latencies, 0.50) * 1e6 if latencies else None,
+        'decode_p99_us':    percentile(latencies, 0.99) * 1e6 if latencies else None,
+    }
+
+def main():
+    options, _ = PARSER.parse_args()
+    print(json.dumps(run(options), indent = 2, sort_keys = True))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""
+Codec microbenchmarks for every registered packet type.
+
+Builds representative instances of every admin, query and master server
+packet (plus worst cases with maximally repeated fields), and measures encode
+and decode throughput. Results are written as JSON, and can be compared to a
+previous run to catch codec regressions:
+
+    python benchmarks/codec.py -o before.json
+    python benchmarks/codec.py -o after.json -c before.json
+
+Allocations per call are measured with tracemalloc, which python 2 lacks:
+there the allocation results are null (and the report's 'allocations' is
+None), only the gc-tracked objects a call leaves alive are reported.
+"""
+import os, sys
+import gc
+import json
+import platform
+import time
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+try:
+    from libopenttd import packets
+    from libopenttd.packets import fields
+    from libopenttd.packets.base import ProtocolInformation
+    from libopenttd.packets.exceptions import InvalidFieldData
+    from libopenttd.packets.registry import registry
+    from libopenttd.utils import six, ipaddr
+    from libopenttd.utils.clock import perf_counter
+    import libopenttd.admin
+    import libopenttd.query.master
+    import libopenttd.query.server
+except ImportError:
+    print("Somehow we were unable to load libopenttd, please make sure it's in python's path.")
+    raise
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from datetime import datetime
+from optparse import OptionParser
+
+PARSER = OptionParser()
+PARSER.add_option("-o", "--output", action="store", type="string", dest="output", default=None,
+    help="Write the JSON results to this file instead of stdout")
+PARSER.add_option("-t", "--min-time", action="store", type="float", dest="min_time", default=0.2,
+    help="Minimum amount of time (in seconds) to spend on each measurement")
+PARSER.add_option("-f", "--filter", action="store", type="string", dest="filter", default=None,
+    help="Only benchmark packets whose name contains this string")
+PARSER.add_option("-c", "--compare", action="store", type="string", dest="compare", default=None,
+    help="Compare against the results in this JSON file and report regressions")
+PARSER.add_option("-r", "--threshold", action="store", type="float", dest="threshold", default=0.10,
+    help="Relative slowdown that counts as a regression when comparing")
+
+ALLOCATION_CALLS = 100  ###< Calls averaged over when measuring allocations
+TYPICAL_REPEAT  = 4     ###< Amount of items in variable length fields for typical packets
+WORST_REPEAT    = 255   ###< Amount of items in variable length fields for worst case packets
+WORST_DICT      = 1024  ###< Amount of items in dictionary fields (such as CmdNames) for worst cases
+
+SAMPLE_INTS     = (1, 3, 0, 2)
+SAMPLE_STRING   = 'libopenttd sample string'
+SAMPLE_JSON     = {'action': 'sample', 'values': [1, 2, 3], 'nested': {'key': 'value'}}
+SAMPLE_MD5      = '0123456789ABCDEF0123456789ABCDEF'
+SAMPLE_DATE     = datetime(1950, 1, 1)
+SAMPLE_IPADDR   = ipaddr.IPAddress('127.0.0.1')
+
+def sample_struct(field):
+    if isinstance(field, fields.BooleanField):
+        return True
+    if isinstance(field, fields.CharField):
+        return 'x'
+    if isinstance(field, fields.MD5Field):
+        return SAMPLE_MD5
+    if isinstance(field, fields.DateField):
+        return SAMPLE_DATE
+    if isinstance(field, fields.IPAddrPrefixField):
+        return 1
+    for value in SAMPLE_INTS:
+        try:
+            field.is_valid(value)
+        except InvalidFieldData:
+            continue
+        return value
+    raise InvalidFieldData("Unable to find a valid sample value for field '%s'" % field.name)
+
+def sample_fields(options, repeat, dict_size):
+    return dict([(field.name, sample_value(field, repeat, dict_size)) for field in options.fields])
+
+def sample_value(field, repeat, dict_size):
+    if isinstance(field, fields.DictField):
+        key = field._meta.get_field_by_name('key')
+        value = field._meta.get_field_by_name('value')
+        if isinstance(value, fields.StringField):
+            return dict([(i, '%s %d' % (SAMPLE_STRING, i)) for i in range(dict_size)])
+        return dict([(i, sample_value(value, repeat, dict_size)) for i in range(dict_size)])
+    if isinstance(field, fields.GroupedField):
+        return sample_fields(field._meta, repeat, dict_size)
+    if isinstance(field, fields.RepeatingField):
+        count = repeat if isinstance(field.field_count, fields.Field) else field.expected_count
+        return [sample_fields(field._meta, repeat, dict_size) for _ in range(count)]
+    if isinstance(field, fields.LoopingField):
+        return [sample_fields(field._meta, repeat, dict_size) for _ in range(repeat)]
+    if isinstance(field, fields.JsonField):
+        return SAMPLE_JSON
+    if isinstance(field, fields.StringField):
+        return SAMPLE_STRING
+    if isinstance(field, fields.IPAddrField):
+        return SAMPLE_IPADDR
+    if isinstance(field, fields.StructField):
+        value = sample_struct(field)
+        if field.field_count != 1 and not field.is_version_identifier:
+            return [value] * field.field_count
+        return value
+    raise InvalidFieldData("Don't know how to build a sample for field '%s'" % field.name)
+
+def is_variable_field(field):
+    if isinstance(field, fields.LoopingField):
+        return True
+    return isinstance(field, fields.RepeatingField) and isinstance(field.field_count, fields.Field)
+
+def has_variable_fields(packet):
+    return any([is_variable_field(field) for field in packet._meta.fields])
+
+def all_packet_classes():
+    seen = set()
+    for protocol, directions in sorted(six.iteritems(registry.all_packets)):
+        for direction, pids in sorted(six.iteritems(directions)):
+            for pid, packet in sorted(six.iteritems(pids)):
+                if packet in seen:
+                    continue
+                seen.add(packet)
+                yield protocol, packet
+
+def build_samples(packet):
+    yield 'typical', packet(**sample_fields(packet._meta, TYPICAL_REPEAT, TYPICAL_REPEAT * 2))
+    if has_variable_fields(packet):
+        yield 'worst', packet(**sample_fields(packet._meta, WORST_REPEAT, WORST_DICT))
+
+def measure(func, min_time):
+    """
+    Returns the amount of calls to func per second, running it in growing
+    batches until a batch takes at least min_time seconds.
+    """
+    number = 1
+    while True:
+        start = perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = perf_counter() - start
+        if elapsed >= min_time:
+            return number / elapsed
+        number *= 2 if elapsed <= 0 else max(2, int(min_time / elapsed * 1.2))
+
+def measure_allocations(func, number = ALLOCATION_CALLS):
+    """
+    Returns the memory blocks and bytes a call allocates, net of what it
+    frees again (averaged over number calls whose results are kept alive),
+    and the peak amount of bytes a single call allocates. All None without
+    tracemalloc (python 2), there is no allocation counter to fall back to.
+    """
+    if tracemalloc is None:
+        return None, None, None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        current, _ = tracemalloc.get_traced_memory()
+        result = func()
+        _, peak = tracemalloc.get_traced_memory()
+        del result
+
+        results = []
+        before = tracemalloc.take_snapshot()
+        for _ in range(number):
+            results.append(func())
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    del results
+    # Leave out what taking the first snapshot allocated.
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    stats = after.filter_traces(ignore).compare_to(before.filter_traces(ignore), 'lineno')
+    blocks = sum([stat.count_diff for stat in stats])
+    size = sum([stat.size_diff for stat in stats])
+    return float(blocks) / number, float(size) / number, peak - current
+
+def measure_retained_objects(func):
+    """
+    Returns the amount of gc-tracked objects a single call leaves alive. It
+    says nothing about allocations, it is only a rough stand in for when
+    tracemalloc isn't available.
+    """
+    if tracemalloc is not None:
+        return None
+    gc.collect()
+    before = len(gc.get_objects())
+    result = func()
+    retained = len(gc.get_objects()) - before
+    del result
+    return retained
+
+def bench_packet(protocol, packet, variant, instance, min_time):
+    data = bytes(instance.write(extra = ProtocolInformation()))
+    encode = lambda: instance.write(extra = ProtocolInformation())
+    decode = lambda: packet.manager.from_data(data, extra = ProtocolInformation())
+
+    encode_blocks, encode_bytes, encode_peak = measure_allocations(encode)
+    decode_blocks, decode_bytes, decode_peak = measure_allocations(decode)
+    return {
+        'protocol':         packets.Protocol.get_name(protocol),
+        'direction':        packets.Direction.get_name(packet._meta.direction),
+        'packet':           '%s.%s' % (packet.__module__, packet.__name__),
+        'pid':              packet.pid,
+        'variant':          variant,
+        'size':             len(data),
+        'encode_ops':       measure(encode, min_time),
+        'decode_ops':       measure(decode, min_time),
+        'encode_alloc_blocks': encode_blocks,
+        'decode_alloc_blocks': decode_blocks,
+        'encode_alloc_bytes': encode_bytes,
+        'decode_alloc_bytes': decode_bytes,
+        'encode_peak_bytes': encode_peak,
+        'decode_peak_bytes': decode_peak,
+        'encode_retained_gc_objects': measure_retained_objects(encode),
+        'decode_retained_gc_objects': measure_retained_objects(decode),
+    }
+
+def run(options):
+    results = []
+    for protocol, packet in all_packet_classes():
+        if options.filter and options.filter not in packet.__name__:
+            continue
+        for variant, instance in build_samples(packet):
+            results.append(bench_packet(protocol, packet, variant, instance, options.min_time))
+    return {
+        'python':       platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform':     platform.platform(),
+        'time':         time.time(),
+        'min_time':     options.min_time,
+        # Where the *_alloc_* and *_peak_bytes results come from, None when
+        #  they couldn't be measured and are null.
+        'allocations':  'tracemalloc' if tracemalloc is not None else None,
+        'results':      results,
+    }
+
+def result_key(result):
+    return (result['packet'], result['variant'])
+
+def compare(report, baseline, threshold):
+    """
+    Returns a list of (key, metric, old, new) for every throughput metric
+    that dropped by more than threshold compared to the baseline.
+    """
+    old_results = dict([(result_key(result), result) for result in baseline['results']])
+    regressions = []
+    for result in report['results']:
+        old = old_results.get(result_key(result))
+        if old is None:
+            continue
+        for metric in ('encode_ops', 'decode_ops'):
+            if result[metric] < old[metric] * (1.0 - threshold):
+                regressions.append((result_key(result), metric, old[metric], result[metric]))
+    return regressions
+
+def main():
+    options, _ = PARSER.parse_args()
+    report = run(options)
+    output = json.dumps(report, indent = 2, sort_keys = True)
+    if options.output:
+        with open(options.output, 'w') as fileobj:
+            fileobj.write(output)
+    else:
+        print(output)
+
+    if options.compare:
+        with open(options.compare) as fileobj:
+            baseline = json.load(fileobj)
+        regressions = compare(report, baseline, options.threshold)
+        for (name, variant), metric, old, new in regressions:
+            sys.stderr.write("%s (%s) %s: %.0f -> %.0f ops/sec (%.1f%%)\n" % (name, variant, metric, old, new,
+                                                                           (new - old) * 100.0 / old))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
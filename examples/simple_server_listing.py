@@ -1,41 +1,21 @@
 import os, sys
-import time, socket
 sys.path.insert(0, os.path.abspath('../'))
 
 try:
-    from libopenttd.query.master import send as m_send, recv as m_recv, MasterServerSocket
-    from libopenttd.query.server import send as s_send, recv as s_recv
-    from libopenttd.packets import constants
+    from libopenttd.query import Crawler
 except ImportError:
     print "Somehow we were unable to load libopenttd, please make sure it's in python's path."
     raise
 
 from collections import defaultdict
 
-def millis():
-    return int(round(time.time() * 1000))
-
-USES_POLL = USES_EPOLL = False
-try:
-    from select import epoll as poll, EPOLLIN as POLLIN, \
-                       EPOLLOUT as POLLOUT, EPOLLERR as POLLERR, \
-                       EPOLLHUP as POLLHUP, EPOLLPRI as POLLPRI
-    POLL_MOD   = 1.0
-    USES_EPOLL = True
-except ImportError:
-    try:
-        from select import poll, POLLIN, POLLOUT, POLLERR, POLLHUP, POLLPRI
-        POLL_MOD   = 1000.0
-        USES_POLL  = True
-    except ImportError:
-        raise
-POLL_MOD = 1000.0 / POLL_MOD
-
 from optparse import OptionParser
 
 PARSER = OptionParser()
 PARSER.add_option("-t", "--timeout", action="store", type="int", dest="timeout", default=5000, 
     help="The amount of time (in ms) to wait (in total) for packets to arrive")
+PARSER.add_option("-c", "--concurrency", action="store", type="int", dest="concurrency", default=256,
+    help="The most servers probed at the same time")
 PARSER.add_option("-d", "--debug", action="store_true", dest="debug", default=False)
 PARSER.add_option("-a", "--attempts", action="store", type="int", dest="attempts", default=2)
 
@@ -47,12 +27,11 @@ log = nodebug
 options = object()
 
 def quick_info():
-    log("EPOLL Available: %r", USES_EPOLL)
     log("Timeout        : %s", options.timeout)
 
 def statistics(servers):
-    noinfo = [x for x in servers if not x.has_info]
-    info = [x.info for x in servers if x.has_info]
+    noinfo = [x for x in servers if x.info is None]
+    info = [x.info for x in servers if x.info is not None]
     responding_servers = len(info)
 
     clientcount = [x.clients_on for x in info]
@@ -118,105 +97,15 @@ def main():
     options = opts
     log = debug if options.debug else nodebug
     quick_info()
-    listing = ServerList(float(options.timeout), log, float(options.attempts))
+    crawler = Crawler(max_in_flight = options.concurrency, attempts = options.attempts)
     log("Querying master server for servers")
-    listing.run()
-    statistics(listing.serverlist.values())
-
-
-
-class ServerInfo(object):
-    def __init__(self, addr):
-        self.addr = addr
-        self.info = None
-        self.added = millis()
-
-    @property
-    def age(self):
-        return millis() - self.added
-
-    @property
-    def has_info(self):
-        return self.info is not None
-
-class ServerList(object):
-    def __init__(self, timeout = 5000.0, logger = nodebug, attempts = 2.0):
-        self.poll = poll()
-        self.sock = MasterServerSocket()
-        self.poll.register(self.sock.fileno(), POLLIN | POLLOUT | POLLHUP | POLLERR | POLLPRI)
-
-        self.msu_addr = (socket.gethostbyname(constants.NETWORK_MASTER_SERVER_HOST), 
-                        constants.NETWORK_MASTER_SERVER_PORT)
-
-        self.serverlist = {}
-        self.max_wait = float(timeout)
-        self.log = logger
-        self.attempts = attempts
-
-    def run(self):
-        start = now = millis()
-        timeout = self.max_wait
-        self.sock.send_packet(self.msu_addr, m_send.ServerList())
-        left = int(self.max_wait / 1000) - 1
-        while timeout > 0:
-            now = millis()
-            timeout = self.max_wait - (now - start)
-            seconds = int(timeout / 1000)
-            if seconds < left:
-                left = seconds
-                self.log("Progress:")
-                self.log("  %d servers in listing", len(self.serverlist))
-                self.log("  %d still to check", len([x for x in self.serverlist.values() if not x.has_info]))
-            timeleft = min(timeout, 10)
-            events = self.poll.poll(timeleft / POLL_MOD)
-            for fileno, event in events:
-                if fileno != self.sock.fileno():
-                    continue
-                if (event & POLLIN) or (event & POLLPRI):
-                    self.sock.process_recv()
-                if (event & POLLOUT):
-                    self.sock.process_send()
-                if (event & POLLERR) or (event & POLLHUP):
-                    break
-            packets = self.sock.process_packets()
-            self.process_packets(packets)
-            self.process_stale()
-            time.sleep(0.0001)
-
-    def process_stale(self):
-        for item in self.serverlist.values():
-            if item.has_info:
-                continue
-            if item.age > self.max_wait / self.attempts:
-                item.added = millis()
-                self.sock.send_packet(item.addr, s_send.ServerInformation())
-                break
-
-    def process_msu_packet(self, packet):
-        if isinstance(packet, m_recv.ServerList):
-            addr_list = [(str(item['ip']), item['port']) for item in packet.addresses]
-            for addr in addr_list:
-                if addr not in self.serverlist:
-                    self.serverlist[addr] = ServerInfo(addr)
-                    self.sock.send_packet(addr, s_send.ServerInformation())
-
-    def process_server_packet(self, addr, packet):
-        info = self.serverlist.get(addr, None)
-        if not info:
-            print "Unknown addr: %s:%s" % info
-            return
-        if not isinstance(packet, s_recv.GameInformation):
-            print "Unwanted packet received: %s" % packet
-            return
-        info.info = packet
-
-    def process_packets(self, packets):
-        for addr, packet in packets:
-            if addr == self.msu_addr:
-                self.process_msu_packet(packet)
-            else:
-                self.process_server_packet(addr, packet)
-
+    servers = []
+    for result in crawler.crawl(options.timeout / 1000.0):
+        servers.append(result)
+        if result.info is not None:
+            log("%s:%d %s", result.address[0], result.address[1], result.info.name)
+    crawler.close()
+    statistics(servers)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,2 +1,17 @@
-from .base import AdminSocket, AdminPacket
+from .base import AdminSocket, AdminServerSocket, AdminPacket
 import send, recv
+from .session import AdminSession, SessionState
+from .state import GameState, Change
+from .pool import AdminPool
+from .fleet import AdminFleet
+from .rcon import RconClient, RconResult
+from .exceptions import AdminError, RconError, InvalidCmdLog, PollError
+from .ping import PingMonitor
+from .cmdlog import CmdLogStore
+from .cmdnames import CmdNamesCache, CommandNames
+from .messages import MessageDispatcher
+from .timeseries import TimeSeriesStore
+from .reconnect import ReconnectManager, Backoff
+from .poll import PollScheduler
+from .gamescript import GamescriptChannel
+from .proxy import AdminProxy, ProxyServer
@@ -10,3 +10,10 @@ class AdminSocket(packets.PacketSocket):
     DEFAULT_DIRECTION   = packets.Direction.RECV
     DEFAULT_PORT        = packets.constants.NETWORK_ADMIN_PORT
     DEFAULT_VERSION     = packets.constants.NETWORK_GAME_ADMIN_VERSION
+
+class AdminServerSocket(AdminSocket):
+    """
+    The server side of an admin connection; receives the packets in
+    admin.send and sends the ones in admin.recv.
+    """
+    DEFAULT_DIRECTION   = packets.Direction.SEND
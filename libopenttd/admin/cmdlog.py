@@ -0,0 +1,433 @@
+#
+# Columnar storage for CmdLogging packets.
+#
+# Rows are collected in memory, column by column, and written out as a
+# segment file once segment_rows rows have been collected. Every segment is
+# self contained:
+#
+#   header          magic "LOTTDCMD", UInt16 version, UInt32 rows,
+#                   UInt16 column count, UInt64 dictionary offset
+#   columns         (16s name, 1s typecode, UInt64 offset, UInt64 size,
+#                   double min, double max) * column count
+#   column data     one array per column, in native byte order, 8 byte aligned
+#   dictionaries    servers and texts: UInt32 count, (UInt16 length, utf-8) *
+#
+# The server and text columns hold ids into the dictionaries of the segment.
+# The min and max of each column let queries skip whole segments, and only
+# the columns a query filters on or returns are read from disk.
+#
+import io
+import mmap
+import os
+import time
+
+from array import array
+from struct import Struct
+
+from .exceptions import InvalidCmdLog
+from libopenttd.utils import six
+from libopenttd.utils.clock import monotonic
+from . import recv
+
+SEGMENT_MAGIC           = b'LOTTDCMD'
+SEGMENT_VERSION         = 1
+SEGMENT_SUFFIX          = '.cmdlog'
+
+SEGMENT_HEADER          = Struct('<8sHIHQ')
+COLUMN_ENTRY            = Struct('<16scQQdd')
+COUNT                   = Struct('<I')
+STRING_LENGTH           = Struct('<H')
+
+COLUMNS = (
+    ('walltime',    'd'),
+    ('server',      'H'),
+    ('client_id',   'I'),
+    ('company_id',  'B'),
+    ('command_id',  'H'),
+    ('param1',      'I'),
+    ('param2',      'I'),
+    ('tile',        'I'),
+    ('frame',       'I'),
+    ('text',        'I'),
+)
+COLUMN_NAMES = tuple([name for name, _ in COLUMNS])
+
+def _to_bytes(values):
+    return values.tostring() if six.PY2 else values.tobytes()
+
+def _from_bytes(typecode, data):
+    values = array(typecode)
+    values.fromstring(data) if six.PY2 else values.frombytes(data)
+    return values
+
+def _read_strings(data, offset):
+    count = COUNT.unpack_from(data, offset)[0]
+    offset += COUNT.size
+    strings = []
+    for _ in six.moves.range(count):
+        length = STRING_LENGTH.unpack_from(data, offset)[0]
+        offset += STRING_LENGTH.size
+        strings.append(data[offset:offset + length].decode('utf-8'))
+        offset += length
+    return strings, offset
+
+def _write_strings(fileobj, strings):
+    fileobj.write(COUNT.pack(len(strings)))
+    for value in strings:
+        encoded = value.encode('utf-8')[:0xFFFF]
+        fileobj.write(STRING_LENGTH.pack(len(encoded)))
+        fileobj.write(encoded)
+
+class Dictionary(object):
+    def __init__(self, values = ()):
+        self.values = list(values)
+        self.ids = dict([(value, number) for number, value in enumerate(self.values)])
+
+    def __len__(self):
+        return len(self.values)
+
+    def get_id(self, value):
+        number = self.ids.get(value)
+        if number is None:
+            number = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return number
+
+class Segment(object):
+    """
+    A set of rows stored column-wise, either still being filled in memory or
+    read back from a segment file.
+    """
+    def __init__(self):
+        self.columns = dict([(name, array(typecode)) for name, typecode in COLUMNS])
+        self.servers = Dictionary()
+        self.texts = Dictionary([u''])
+        self.bounds = {}
+        self.rows = 0
+
+    def __len__(self):
+        return self.rows
+
+    def append(self, walltime, server, packet):
+        columns = self.columns
+        params = list(packet.params or ()) + [0, 0]
+        columns['walltime'].append(walltime)
+        columns['server'].append(self.servers.get_id(server))
+        columns['client_id'].append(packet.client_id)
+        columns['company_id'].append(packet.company_id)
+        columns['command_id'].append(packet.command_id)
+        columns['param1'].append(params[0])
+        columns['param2'].append(params[1])
+        columns['tile'].append(packet.tile)
+        columns['frame'].append(packet.frame)
+        columns['text'].append(self.texts.get_id(packet.text or u''))
+        self.rows += 1
+
+    def get_column(self, name):
+        return self.columns[name]
+
+    def get_bounds(self, name):
+        bounds = self.bounds.get(name)
+        if bounds is None and self.rows:
+            column = self.get_column(name)
+            bounds = (min(column), max(column))
+        return bounds
+
+    def get_servers(self):
+        return self.servers.values
+
+    def get_texts(self):
+        return self.texts.values
+
+    def write(self, fileobj):
+        names = COLUMN_NAMES
+        offset = SEGMENT_HEADER.size + COLUMN_ENTRY.size * len(names)
+        entries = []
+        for name, typecode in COLUMNS:
+            offset += -offset % 8
+            size = len(self.columns[name]) * self.columns[name].itemsize
+            low, high = self.get_bounds(name) or (0, 0)
+            entries.append((name, typecode, offset, size, low, high))
+            offset += size
+
+        fileobj.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, self.rows, len(names), offset))
+        for name, typecode, offset, size, low, high in entries:
+            fileobj.write(COLUMN_ENTRY.pack(name.encode('ascii'), typecode.encode('ascii'), offset, size, low, high))
+        for name, typecode, offset, size, low, high in entries:
+            fileobj.write(b'\0' * (offset - fileobj.tell()))
+            fileobj.write(_to_bytes(self.columns[name]))
+        _write_strings(fileobj, self.servers.values)
+        _write_strings(fileobj, self.texts.values)
+
+class SegmentFile(Segment):
+    """
+    Segment read from disk, columns are only read when first asked for.
+    """
+    def __init__(self, path):
+        self.path = path
+        with io.open(path, 'rb') as fileobj:
+            size = os.fstat(fileobj.fileno()).st_size
+            if size < SEGMENT_HEADER.size:
+                raise InvalidCmdLog("Segment '%s' is truncated" % path)
+            self.data = mmap.mmap(fileobj.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, version, rows, count, dictionary_offset = SEGMENT_HEADER.unpack_from(self.data, 0)
+        if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+            raise InvalidCmdLog("'%s' is not a command log segment" % path)
+        if dictionary_offset > size:
+            raise InvalidCmdLog("Segment '%s' is truncated" % path)
+        self.rows = rows
+        self.entries = {}
+        self.bounds = {}
+        for number in six.moves.range(count):
+            name, typecode, offset, length, low, high = COLUMN_ENTRY.unpack_from(
+                self.data, SEGMENT_HEADER.size + number * COLUMN_ENTRY.size)
+            name = name.rstrip(b'\0').decode('ascii')
+            self.entries[name] = (typecode.decode('ascii'), offset, length)
+            self.bounds[name] = (low, high)
+        self.columns = {}
+        self.dictionary_offset = dictionary_offset
+        self._servers = self._texts = None
+
+    def close(self):
+        self.data.close()
+
+    def get_column(self, name):
+        column = self.columns.get(name)
+        if column is None:
+            typecode, offset, length = self.entries[name]
+            column = self.columns[name] = _from_bytes(typecode, self.data[offset:offset + length])
+        return column
+
+    def load_dictionaries(self):
+        self._servers, offset = _read_strings(self.data, self.dictionary_offset)
+        self._texts, _ = _read_strings(self.data, offset)
+
+    def get_servers(self):
+        if self._servers is None:
+            self.load_dictionaries()
+        return self._servers
+
+    def get_texts(self):
+        if self._texts is None:
+            self.load_dictionaries()
+        return self._texts
+
+class CmdLogStore(object):
+    """
+    Stores CmdLogging packets from any number of servers in columnar segment
+    files in directory.
+
+    At most segment_rows rows are held in memory; a full segment is written
+    out and forgotten. Written segments are fsynced in batches, once
+    fsync_segments of them are waiting or fsync_interval seconds have passed,
+    whichever comes first. Rows of a quiet server don't wait for a full
+    segment either: flush_due() writes out what was collected once
+    fsync_interval passed, it is checked on every append and, when attached
+    to an AdminPool, from a timer on the pool.
+
+    query() only reads the columns it filters on or returns, and skips
+    segments whose column bounds exclude the filters altogether.
+    """
+    SEGMENT_ROWS = 64 * 1024
+
+    def __init__(self, directory, segment_rows = None, fsync_segments = 8, fsync_interval = 5.0):
+        self.directory = directory
+        self.segment_rows = segment_rows or self.SEGMENT_ROWS
+        self.fsync_segments = fsync_segments
+        self.fsync_interval = fsync_interval
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.segment_paths = self.find_segments()
+        self.next_number = self.get_segment_number(self.segment_paths[-1]) + 1 if self.segment_paths else 0
+        self.segment = Segment()
+        self.unsynced = []
+        self.last_sync = monotonic()
+        self.timers = {}
+
+    #
+    # Writing
+    #
+    def find_segments(self):
+        names = sorted([name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX)])
+        return [os.path.join(self.directory, name) for name in names]
+
+    @classmethod
+    def get_segment_number(cls, path):
+        return int(os.path.basename(path)[:-len(SEGMENT_SUFFIX)])
+
+    def attach(self, session):
+        """
+        Stores the CmdLogging packets received by an AdminSession or by every
+        session of an AdminPool. Rows are tagged with the session key, or its
+        address when it has none.
+        """
+        session.on(recv.CmdLogging, self.handle)
+        if hasattr(session, 'call_later') and session not in self.timers:
+            self.tick(session)
+
+    def detach(self, session):
+        session.off(recv.CmdLogging, self.handle)
+        timer = self.timers.pop(session, None)
+        if timer is not None:
+            timer.cancel()
+
+    def tick(self, pool):
+        self.timers[pool] = pool.call_later(self.flush_due(), self.tick, pool)
+
+    def handle(self, session, packet):
+        server = session.key if session.key is not None else '%s:%s' % session.address
+        self.append(server, packet)
+
+    def append(self, server, packet, walltime = None):
+        self.segment.append(walltime if walltime is not None else time.time(), six.text_type(server), packet)
+        if len(self.segment) >= self.segment_rows:
+            self.write_segment()
+        else:
+            self.flush_due()
+
+    def flush_due(self, now = None):
+        """
+        Flushes the rows and segments waiting when fsync_interval passed
+        since the last sync. Returns the amount of seconds until it is due
+        again.
+        """
+        if now is None:
+            now = monotonic()
+        elapsed = now - self.last_sync
+        if elapsed < self.fsync_interval:
+            return self.fsync_interval - elapsed
+        if len(self.segment) or self.unsynced:
+            self.flush(now)
+        else:
+            # Nothing to flush, the interval starts with the next row.
+            self.last_sync = now
+        return self.fsync_interval
+
+    def write_segment(self):
+        segment, self.segment = self.segment, Segment()
+        if not len(segment):
+            return
+        path = os.path.join(self.directory, '%08d%s' % (self.next_number, SEGMENT_SUFFIX))
+        self.next_number += 1
+        fileobj = io.open(path, 'wb')
+        segment.write(fileobj)
+        fileobj.flush()
+        self.unsynced.append(fileobj)
+        self.segment_paths.append(path)
+        if len(self.unsynced) >= self.fsync_segments or monotonic() - self.last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self, now = None):
+        for fileobj in self.unsynced:
+            os.fsync(fileobj.fileno())
+            fileobj.close()
+        if self.unsynced and hasattr(os, 'O_DIRECTORY'):
+            fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self.unsynced = []
+        self.last_sync = monotonic() if now is None else now
+
+    def flush(self, now = None):
+        """
+        Writes out the rows collected so far as a (smaller) segment and syncs
+        all segments to disk.
+        """
+        self.write_segment()
+        self.sync(now)
+
+    def close(self):
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers = {}
+        self.flush()
+
+    #
+    # Reading
+    #
+    def iter_segments(self):
+        for path in self.segment_paths:
+            try:
+                segment = SegmentFile(path)
+            except InvalidCmdLog:
+                # Left behind half written by a crash, nothing to be found in it.
+                continue
+            try:
+                yield segment
+            finally:
+                segment.close()
+        if len(self.segment):
+            yield self.segment
+
+    def query(self, columns = None, server = None, client_id = None, company_id = None, command_id = None,
+              tile_range = None, start = None, end = None):
+        """
+        Yields a dictionary with the requested columns (all by default) for
+        every row matching the filters. tile_range is an inclusive (low, high)
+        tuple and start and end limit the wall clock time.
+        """
+        columns = tuple(columns or COLUMN_NAMES)
+        filters = []
+        if client_id is not None:
+            filters.append(('client_id', client_id, client_id))
+        if company_id is not None:
+            filters.append(('company_id', company_id, company_id))
+        if command_id is not None:
+            filters.append(('command_id', command_id, command_id))
+        if tile_range is not None:
+            filters.append(('tile', tile_range[0], tile_range[1]))
+        if start is not None or end is not None:
+            filters.append(('walltime', start if start is not None else float('-inf'),
+                            end if end is not None else float('inf')))
+
+        for segment in self.iter_segments():
+            if not self.may_match(segment, filters):
+                continue
+            rows = self.filter_segment(segment, filters, server)
+            if rows is None or not rows:
+                continue
+            values = [(name, segment.get_column(name)) for name in columns]
+            servers = segment.get_servers() if 'server' in columns else None
+            texts = segment.get_texts() if 'text' in columns else None
+            for row in rows:
+                result = dict([(name, column[row]) for name, column in values])
+                if servers is not None:
+                    result['server'] = servers[result['server']]
+                if texts is not None:
+                    result['text'] = texts[result['text']]
+                yield result
+
+    @classmethod
+    def may_match(cls, segment, filters):
+        for name, low, high in filters:
+            bounds = segment.get_bounds(name)
+            if bounds is None or bounds[1] < low or bounds[0] > high:
+                return False
+        return True
+
+    @classmethod
+    def filter_segment(cls, segment, filters, server):
+        rows = None
+        if server is not None:
+            servers = segment.get_servers()
+            if server not in servers:
+                return None
+            filters = [('server', servers.index(server), servers.index(server))] + list(filters)
+        for name, low, high in filters:
+            column = segment.get_column(name)
+            if rows is None:
+                if low == high:
+                    rows = [row for row, value in enumerate(column) if value == low]
+                else:
+                    rows = [row for row, value in enumerate(column) if low <= value <= high]
+            elif low == high:
+                rows = [row for row in rows if column[row] == low]
+            else:
+                rows = [row for row in rows if low <= column[row] <= high]
+            if not rows:
+                break
+        if rows is None:
+            rows = six.moves.range(len(segment))
+        return rows
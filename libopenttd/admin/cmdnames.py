@@ -0,0 +1,172 @@
+import io
+import os
+
+from libopenttd.packets.enums import UpdateType
+from libopenttd.utils import six
+from . import recv
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+class CommandNames(object):
+    """
+    Command id to name lookup table of a single server revision, stored as a
+    list indexed by command id.
+    """
+    __slots__ = ('revision', 'names', 'ids')
+
+    def __init__(self, revision, names = ()):
+        self.revision = revision
+        self.names = list(names)
+        self.ids = dict([(name, command_id) for command_id, name in enumerate(self.names) if name is not None])
+
+    @classmethod
+    def from_dict(cls, revision, commands):
+        names = [None] * (max(commands) + 1 if commands else 0)
+        for command_id, name in six.iteritems(commands):
+            names[command_id] = name
+        return cls(revision, names)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, command_id):
+        name = self.get(command_id)
+        if name is None:
+            raise KeyError(command_id)
+        return name
+
+    def __contains__(self, command_id):
+        return self.get(command_id) is not None
+
+    def get(self, command_id, default = None):
+        if 0 <= command_id < len(self.names):
+            name = self.names[command_id]
+            if name is not None:
+                return name
+        return default
+
+    def get_id(self, name, default = None):
+        return self.ids.get(name, default)
+
+    def __repr__(self):
+        return '<CommandNames %s (%d commands)>' % (self.revision, len(self))
+
+class NamesCollector(object):
+    """
+    Collects the CmdNames packets of one session. The server may split the
+    names over any number of packets, a Ping/Pong barrier sent right after the
+    poll tells when the last one has arrived.
+    """
+    def __init__(self, cache, session, revision):
+        self.cache = cache
+        self.session = session
+        self.revision = revision
+        self.commands = {}
+
+        polled = UpdateType.NAMES in session.subscriptions
+        session.on(recv.CmdNames, self.handle_names)
+        session.on('disconnected', self.handle_disconnected)
+        if polled:
+            # Someone else already had us subscribed, so on() didn't poll.
+            session.poll(UpdateType.NAMES)
+        session.barrier(self.finish)
+
+    def detach(self):
+        self.session.off(recv.CmdNames, self.handle_names)
+        self.session.off('disconnected', self.handle_disconnected)
+        self.cache.collectors.pop(self.session, None)
+
+    def handle_names(self, session, packet):
+        self.commands.update(packet.commands or {})
+
+    def handle_disconnected(self, session):
+        self.detach()
+
+    def finish(self, session):
+        self.detach()
+        table = CommandNames.from_dict(self.revision, self.commands)
+        self.cache.add(table)
+        self.cache.set_names(session, table)
+
+class CmdNamesCache(object):
+    """
+    Command name tables by server revision (the version sent in Welcome),
+    optionally persisted as JSON at path.
+
+    Attached sessions only poll the names when their revision isn't cached
+    yet, on_names callbacks are called as callback(session, table) once the
+    table of a session is known, which is straight after the handshake for
+    cached revisions.
+    """
+    def __init__(self, path = None):
+        self.path = path
+        self.tables = {}
+        self.session_tables = {}
+        self.collectors = {}
+        self.listeners = []
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self.tables)
+
+    def __contains__(self, revision):
+        return revision in self.tables
+
+    def get(self, revision):
+        return self.tables.get(revision)
+
+    def add(self, table):
+        self.tables[table.revision] = table
+        if self.path is not None:
+            self.save()
+
+    def load(self):
+        with io.open(self.path, 'rb') as fileobj:
+            data = json.loads(fileobj.read().decode('utf-8'))
+        self.tables = dict([(revision, CommandNames(revision, names)) for revision, names in six.iteritems(data)])
+
+    def save(self):
+        data = dict([(revision, table.names) for revision, table in six.iteritems(self.tables)])
+        tmp_path = '%s.tmp' % self.path
+        with io.open(tmp_path, 'wb') as fileobj:
+            fileobj.write(json.dumps(data, sort_keys = True).encode('utf-8'))
+        os.rename(tmp_path, self.path)
+
+    #
+    # Session integration
+    #
+    def on_names(self, listener):
+        self.listeners.append(listener)
+        return listener
+
+    def attach(self, session):
+        session.on('ready', self.handle_ready)
+        if session.ready:
+            self.handle_ready(session)
+
+    def detach(self, session):
+        session.off('ready', self.handle_ready)
+        collector = self.collectors.get(session)
+        if collector is not None:
+            collector.detach()
+        self.session_tables.pop(session, None)
+
+    def handle_ready(self, session):
+        revision = session.welcome.version
+        table = self.tables.get(revision)
+        if table is not None:
+            self.set_names(session, table)
+        elif session not in self.collectors:
+            self.collectors[session] = NamesCollector(self, session, revision)
+
+    def set_names(self, session, table):
+        self.session_tables[session] = table
+        for listener in self.listeners:
+            listener(session, table)
+
+    def get_names(self, session):
+        return self.session_tables.get(session)
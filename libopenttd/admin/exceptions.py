@@ -0,0 +1,11 @@
+class AdminError(Exception):
+    pass
+
+class RconError(AdminError):
+    pass
+
+class InvalidCmdLog(AdminError):
+    pass
+
+class PollError(AdminError):
+    pass
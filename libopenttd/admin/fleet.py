@@ -0,0 +1,324 @@
+import bisect
+import hashlib
+import multiprocessing
+import select
+
+from collections import defaultdict
+
+from .pool import AdminPool
+from .reconnect import ReconnectManager
+from .session import SESSION_EVENTS
+from .state import GameState
+from libopenttd.utils import six
+
+class HashRing(object):
+    """
+    Consistent hash ring, maps keys to nodes such that adding or removing a
+    node only moves the keys of that node.
+    """
+    def __init__(self, nodes = (), replicas = 128):
+        self.replicas = replicas
+        self.ring = []
+        self.nodes = {}
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(set(six.itervalues(self.nodes)))
+
+    @classmethod
+    def hash(cls, key):
+        return int(hashlib.md5(six.text_type(key).encode('utf-8')).hexdigest()[:16], 16)
+
+    def add(self, node):
+        for replica in six.moves.range(self.replicas):
+            point = self.hash('%s#%d' % (node, replica))
+            self.nodes[point] = node
+            bisect.insort(self.ring, point)
+
+    def remove(self, node):
+        self.ring = [point for point in self.ring if self.nodes[point] != node]
+        self.nodes = dict([(point, self.nodes[point]) for point in self.ring])
+
+    def get_node(self, key):
+        if not self.ring:
+            return None
+        position = bisect.bisect(self.ring, self.hash(key)) % len(self.ring)
+        return self.nodes[self.ring[position]]
+
+class FleetWorker(object):
+    """
+    Runs inside a worker process: an AdminPool for the servers assigned to
+    the worker, which forwards the wanted packets, session events and (when
+    track_state is set) GameState changes to the supervisor.
+
+    Everything forwarded during one loop iteration is sent as a single batch
+    of (kind, key, payload) tuples.
+    """
+    def __init__(self, conn, packets = (), track_state = False, reconnect_interval = 30.0):
+        self.conn = conn
+        self.packets = set(packets)
+        self.track_state = track_state
+        self.reconnect_interval = reconnect_interval
+        self.pool = AdminPool()
+        self.reconnector = ReconnectManager(self.pool, cap = reconnect_interval)
+        self.states = {}
+        self.outbox = []
+        self.running = False
+
+        self.commands = {
+            'add':      self.command_add,
+            'remove':   self.command_remove,
+            'send':     self.command_send,
+            'on':       self.command_on,
+            'stop':     self.command_stop,
+        }
+
+    def forward_packet(self, session, packet):
+        self.outbox.append(('packet', session.key, packet))
+
+    def forward_event(self, event):
+        def _inner(session):
+            self.outbox.append(('event', session.key, event))
+        return _inner
+
+    def forward_changes(self, key):
+        def _inner(change):
+            self.outbox.append(('change', key, change))
+        return _inner
+
+    def command_add(self, key, host, port, password, kwargs):
+        session = self.pool.add(key, host, port, password, **kwargs)
+        if self.track_state:
+            state = self.states[key] = GameState()
+            state.on_change(self.forward_changes(key))
+            state.attach(session)
+        self.reconnector.connect(key)
+
+    def command_remove(self, key):
+        if key in self.pool:
+            self.pool.remove(key)
+        self.states.pop(key, None)
+
+    def command_send(self, key, packet):
+        session = self.pool.sessions.get(key)
+        if session is not None and session.socket is not None:
+            session.send_packet(packet)
+
+    def command_on(self, packets):
+        packets = set(packets) - self.packets
+        if packets:
+            self.packets.update(packets)
+            self.pool.on(tuple(packets), self.forward_packet)
+
+    def command_stop(self):
+        self.running = False
+
+    def handle_commands(self):
+        try:
+            while self.conn.poll():
+                message = self.conn.recv()
+                self.commands[message[0]](*message[1:])
+        except EOFError:
+            # The supervisor went away, there is nobody left to work for.
+            self.running = False
+
+    def run(self):
+        self.running = True
+        if self.packets:
+            self.pool.on(tuple(self.packets), self.forward_packet)
+        for event in SESSION_EVENTS:
+            self.pool.on(event, self.forward_event(event))
+        self.pool.add_reader(self.conn, self.handle_commands)
+        try:
+            while self.running:
+                self.pool.run_once()
+                if self.outbox:
+                    batch, self.outbox = self.outbox, []
+                    self.conn.send(batch)
+        finally:
+            self.pool.close()
+            self.conn.close()
+
+def run_worker(conn, packets, track_state, reconnect_interval):
+    FleetWorker(conn, packets, track_state, reconnect_interval).run()
+
+class AdminFleet(object):
+    """
+    Spreads admin connections over a number of worker processes, each
+    running its own AdminPool, and collects what they receive in this
+    process.
+
+    Servers are assigned to workers with a consistent hash of their key, so
+    a server always lands on the same worker, also when that worker is
+    restarted after dying. Workers send (kind, key, payload) tuples back over
+    a pipe, where kind is 'packet' (payload is the decoded packet), 'event'
+    (payload is 'ready' or 'disconnected') or 'change' (payload is a GameState
+    Change, only when track_state is set).
+
+    Handlers registered with on() are called as handler(key, packet) for
+    packets, handler(key) for events and handler(key, change) for 'change'.
+    Workers reconnect dropped servers by themselves, reconnect_interval is
+    the longest they wait between attempts.
+    """
+    worker_class = multiprocessing.Process
+
+    def __init__(self, workers = None, track_state = False, reconnect_interval = 30.0):
+        self.worker_count = workers or multiprocessing.cpu_count()
+        self.track_state = track_state
+        self.reconnect_interval = reconnect_interval
+        self.ring = HashRing(range(self.worker_count))
+        self.servers = {}
+        self.workers = {}
+        self.conns = {}
+        self.handlers = defaultdict(list)
+        self.dispatch_table = {}
+        self.event_handlers = defaultdict(list)
+        self.packets = set()
+
+    def __len__(self):
+        return len(self.servers)
+
+    @property
+    def started(self):
+        return bool(self.workers)
+
+    def get_worker(self, key):
+        return self.ring.get_node(key)
+
+    #
+    # Handlers
+    #
+    def on(self, key, handler = None):
+        if handler is None:
+            def _inner(func):
+                self.on(key, func)
+                return func
+            return _inner
+        if isinstance(key, six.string_types):
+            if key not in SESSION_EVENTS + ('change', ):
+                raise KeyError("Unknown fleet event '%s'" % key)
+            self.event_handlers[key].append(handler)
+            return handler
+        packets = key if isinstance(key, (list, tuple, set)) else [key]
+        for packet in packets:
+            self.handlers[packet.pid].append(handler)
+        self.dispatch_table = dict([(pid, tuple(handlers)) for pid, handlers in six.iteritems(self.handlers)])
+        new = set(packets) - self.packets
+        if new:
+            self.packets.update(new)
+            self.broadcast('on', tuple(new))
+        return handler
+
+    #
+    # Workers
+    #
+    def start(self):
+        for number in six.moves.range(self.worker_count):
+            self.start_worker(number)
+
+    def start_worker(self, number):
+        parent, child = multiprocessing.Pipe()
+        process = self.worker_class(target = run_worker,
+                                    args = (child, tuple(self.packets), self.track_state, self.reconnect_interval))
+        process.daemon = True
+        process.start()
+        child.close()
+        self.workers[number] = process
+        self.conns[number] = parent
+        for key, config in six.iteritems(self.servers):
+            if self.get_worker(key) == number:
+                parent.send(('add', key) + config)
+
+    def check_workers(self):
+        """
+        Restarts workers that died, their servers are added to the new worker.
+        Returns the numbers of the restarted workers.
+        """
+        restarted = []
+        for number, process in list(self.workers.items()):
+            if not process.is_alive():
+                self.conns.pop(number).close()
+                process.join()
+                self.start_worker(number)
+                restarted.append(number)
+        return restarted
+
+    def stop(self, timeout = 5.0):
+        self.broadcast('stop')
+        for number, process in six.iteritems(self.workers):
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+            self.conns[number].close()
+        self.workers = {}
+        self.conns = {}
+
+    def broadcast(self, *message):
+        for conn in six.itervalues(self.conns):
+            conn.send(message)
+
+    def send_to_worker(self, key, *message):
+        conn = self.conns.get(self.get_worker(key))
+        if conn is not None:
+            conn.send(message)
+
+    #
+    # Servers
+    #
+    def add(self, key, host, port = None, password = '', **kwargs):
+        if key in self.servers:
+            raise KeyError("A server named '%s' is already in the fleet" % (key, ))
+        config = self.servers[key] = (host, port, password, kwargs)
+        self.send_to_worker(key, 'add', key, *config)
+
+    def remove(self, key):
+        del self.servers[key]
+        self.send_to_worker(key, 'remove', key)
+
+    def send_packet(self, key, packet):
+        self.send_to_worker(key, 'send', key, packet)
+
+    #
+    # Consuming
+    #
+    def receive(self, timeout = None):
+        """
+        Waits up to timeout seconds for messages from the workers and returns
+        them as a list of (kind, key, payload) tuples.
+        """
+        conns = list(six.itervalues(self.conns))
+        if not conns:
+            return []
+        readable, _, _ = select.select(conns, [], [], timeout)
+        messages = []
+        for conn in readable:
+            try:
+                while conn.poll():
+                    messages.extend(conn.recv())
+            except (EOFError, IOError):
+                # The worker died, check_workers() will bring it back.
+                continue
+        return messages
+
+    def dispatch(self, kind, key, payload):
+        if kind == 'packet':
+            for handler in self.dispatch_table.get(payload.pid, ()):
+                handler(key, payload)
+        elif kind == 'event':
+            for handler in self.event_handlers[payload]:
+                handler(key)
+        elif kind == 'change':
+            for handler in self.event_handlers['change']:
+                handler(key, payload)
+
+    def run_once(self, timeout = None):
+        messages = self.receive(timeout)
+        for message in messages:
+            self.dispatch(*message)
+        self.check_workers()
+        return len(messages)
+
+    def run(self, timeout = 1.0):
+        while self.workers:
+            self.run_once(timeout)
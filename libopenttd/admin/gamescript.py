@@ -0,0 +1,203 @@
+from collections import defaultdict, OrderedDict
+
+from libopenttd.packets.constants import NETWORK_GAMESCRIPT_JSON_LENGTH
+from libopenttd.packets.enums import UpdateType
+from libopenttd.packets.fields import JsonField, RawJson, LazyJson
+from libopenttd.packets.packetsocket import FRAME_HEADER
+from libopenttd.utils import six
+from . import send, recv
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+# Envelopes wrapping what doesn't fit a Gamescript packet one to one. A
+#  batch holds several messages, a fragment a piece of one serialized
+#  message that is too large for a single packet.
+BATCH_KEY       = '__batch__'
+SEQUENCE_KEY    = '__seq__'
+BATCH_FORMAT    = '{"%s":[%%s]}' % BATCH_KEY
+FRAGMENT_FORMAT = '{"%s":%%d,"__part__":%%d,"__parts__":%%d,"__data__":%%s}' % SEQUENCE_KEY
+
+# recv.Gamescript decodes its data right away, the channel reads the frames
+#  itself and decodes them with this field instead.
+LAZY_JSON = JsonField(lazy = True)
+
+def serialize(message):
+    if isinstance(message, RawJson):
+        return message
+    if isinstance(message, LazyJson):
+        return message.to_raw()
+    return RawJson(json.dumps(message, separators = (',', ':')))
+
+class GamescriptChannel(object):
+    """
+    Exchanges JSON messages with the game script of an AdminSession.
+
+    Every message is serialized exactly once. Queued messages are packed
+    into as few Gamescript packets as fit within limit, several small ones
+    in a batch envelope. A message too large for one packet is split into
+    numbered fragments. A message sent on its own and small enough goes out
+    unchanged, so scripts that know nothing of the envelopes still work for
+    those.
+
+    Received messages are LazyJson values, only decoded when used; the
+    channel handles the undecoded Gamescript frames for that, handlers of
+    recv.Gamescript on the session still get the decoded packet.
+    Fragments come from the script and are checked: invalid ones are
+    ignored, messages of more than max_parts fragments are refused, and at
+    most max_partial messages are assembled at a time, the oldest giving
+    way to newer ones.
+    Handlers are registered with on() for a value of the top level route_key
+    and are called as handler(session, message). The key is peeked at
+    without decoding the message. Handlers registered for None get every
+    message.
+    """
+    def __init__(self, session, route_key = 'event', limit = NETWORK_GAMESCRIPT_JSON_LENGTH, max_parts = 256,
+                 max_partial = 8):
+        self.session = session
+        self.route_key = route_key
+        self.max_parts = max_parts
+        self.max_partial = max_partial
+        # JsonField wants the string, including its '\0', to stay below limit.
+        self.max_length = limit - 2
+        self.queue = []
+        self.queued_length = 0
+        self.sequence = 0
+        self.fragments = OrderedDict()
+        self.handlers = defaultdict(list)
+
+        session.on_frames(recv.Gamescript, self.handle_frame)
+        session.subscribe(UpdateType.GAMESCRIPT)
+        session.on('disconnected', self.handle_disconnected)
+
+    def close(self):
+        self.session.off_frames(recv.Gamescript, self.handle_frame)
+        self.session.off('disconnected', self.handle_disconnected)
+
+    #
+    # Sending
+    #
+    def send(self, message):
+        """
+        Queues message, which is anything json.dumps takes or RawJson. Queued
+        messages are sent by flush(), or earlier when the queue fills a
+        packet.
+        """
+        raw = serialize(message)
+        if len(raw) > self.max_length:
+            self.flush()
+            self.send_fragments(raw)
+            return
+        # Batch overhead is the envelope plus a comma per message.
+        if self.queue and len(BATCH_FORMAT) - 2 + self.queued_length + len(self.queue) + len(raw) > self.max_length:
+            self.flush()
+        self.queue.append(raw)
+        self.queued_length += len(raw)
+
+    def send_many(self, messages):
+        for message in messages:
+            self.send(message)
+        self.flush()
+
+    def flush(self):
+        if not self.queue:
+            return
+        if len(self.queue) == 1:
+            data = self.queue[0]
+        else:
+            data = RawJson(BATCH_FORMAT % ','.join(self.queue))
+        self.queue = []
+        self.queued_length = 0
+        self.session.send_packet(send.Gamescript(data = data))
+
+    def split(self, raw):
+        """
+        Returns the fragments of raw, each a JSON string short enough to
+        fit a packet once escaped.
+        """
+        budget = self.max_length - len(FRAGMENT_FORMAT % (0xFFFFFFFF, 99999, 99999, ''))
+        # Cut the text rather than its UTF-8 bytes, so no cut splits a character.
+        text = raw.decode('utf-8')
+        chunks = []
+        position = 0
+        while position < len(text):
+            chunk = text[position:position + budget]
+            encoded = json.dumps(chunk)
+            while len(encoded) > budget:
+                # Escapes make the encoded text longer, shrink in proportion.
+                chunk = chunk[:len(chunk) * budget // len(encoded)]
+                encoded = json.dumps(chunk)
+            chunks.append(encoded)
+            position += len(chunk)
+        return chunks
+
+    def send_fragments(self, raw):
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        chunks = self.split(raw)
+        for part, chunk in enumerate(chunks):
+            data = RawJson(FRAGMENT_FORMAT % (self.sequence, part, len(chunks), chunk))
+            self.session.send_packet(send.Gamescript(data = data))
+
+    #
+    # Receiving
+    #
+    def on(self, value, handler = None):
+        if handler is None:
+            def _inner(func):
+                self.on(value, func)
+                return func
+            return _inner
+        self.handlers[value].append(handler)
+        return handler
+
+    def off(self, value, handler):
+        self.handlers[value] = [item for item in self.handlers[value] if item != handler]
+
+    def handle_frame(self, session, pid, frame):
+        self.handle_message(session, LAZY_JSON.to_python(frame[FRAME_HEADER.size:].tobytes()))
+
+    def handle_message(self, session, message):
+        batch = message.peek_lazy(BATCH_KEY)
+        if batch is not None:
+            for item in batch.items():
+                self.dispatch(session, item)
+        elif message.peek(SEQUENCE_KEY) is not None:
+            self.handle_fragment(session, message)
+        else:
+            self.dispatch(session, message)
+
+    def handle_fragment(self, session, message):
+        try:
+            sequence, part, count, data = (message[SEQUENCE_KEY], message['__part__'], message['__parts__'],
+                                           message['__data__'])
+        except (KeyError, TypeError, ValueError):
+            return
+        if not all([isinstance(value, six.integer_types) for value in (sequence, part, count)]) or \
+                not isinstance(data, six.string_types):
+            return
+        if not 0 < count <= self.max_parts or not 0 <= part < count:
+            return
+        parts = self.fragments.get(sequence)
+        if parts is None or part == 0 or len(parts) != count:
+            self.fragments.pop(sequence, None)
+            while len(self.fragments) >= self.max_partial:
+                self.fragments.popitem(last = False)
+            parts = self.fragments[sequence] = [None] * count
+        parts[part] = data
+        if None not in parts:
+            del self.fragments[sequence]
+            self.dispatch(session, LazyJson(''.join(parts)))
+
+    def dispatch(self, session, message):
+        route = message.peek(self.route_key) if self.route_key is not None else None
+        handlers = self.handlers.get(route, []) if route is not None else []
+        for handler in handlers + self.handlers.get(None, []):
+            handler(session, message)
+        return len(handlers)
+
+    def handle_disconnected(self, session):
+        self.queue = []
+        self.queued_length = 0
+        self.fragments = OrderedDict()
@@ -0,0 +1,239 @@
+import re
+
+from collections import defaultdict
+from itertools import compress, repeat
+from operator import is_not
+
+from libopenttd.utils import six
+from . import recv
+
+CHAT_KEYS = ('action', 'dest_type', 'client_id')
+
+class Subscription(object):
+    __slots__ = ('callback', 'kind', 'group_key', 'regex')
+
+    def __init__(self, callback, kind, group_key, regex):
+        self.callback = callback
+        self.kind = kind
+        self.group_key = group_key
+        self.regex = regex
+
+    def __repr__(self):
+        return '<Subscription %s %r>' % (self.kind, self.group_key)
+
+class SubscriberGroup(object):
+    """
+    Subscriptions sharing the same exact-match filters. The distinct regexes
+    of those with one are combined into as few regexes as possible, each a
+    series of optional lookaheads that capture when their pattern occurs in
+    the message, so a single match tells which subscriptions match without
+    searching their regexes one by one. Patterns with groups are left out,
+    as their group numbers and backreferences would shift within the
+    combined regex, and are searched on their own, as are patterns that
+    don't combine.
+    """
+    # Python 2's re supports at most 100 groups per regex.
+    MAX_COMBINED = 99
+
+    def __init__(self):
+        self.plain = []
+        self.filtered = []
+        self._combined = []
+        self._separate = []
+        self._positions = {}
+        self._dirty = False
+
+    def __len__(self):
+        return len(self.plain) + len(self.filtered)
+
+    def add(self, subscription):
+        if subscription.regex is None:
+            self.plain.append(subscription)
+        else:
+            self.filtered.append(subscription)
+            self._dirty = True
+
+    def remove(self, subscription):
+        if subscription.regex is None:
+            self.plain.remove(subscription)
+        else:
+            self.filtered.remove(subscription)
+            self._dirty = True
+
+    @classmethod
+    def combine(cls, patterns, flags):
+        # A pattern occurs somewhere in the message when it matches after some
+        #  prefix of it; the empty prefix keeps ^ and \A working.
+        return re.compile('\\A' + ''.join(['(?:(?=[\\s\\S]*?(%s)))?' % pattern for pattern in patterns]), flags)
+
+    def build(self):
+        self._dirty = False
+        self._combined = []
+        self._separate = []
+        self._positions = dict([(subscription, number) for number, subscription in enumerate(self.filtered)])
+        # The subscriptions of every distinct (pattern, flags), by flags.
+        by_flags = defaultdict(list)
+        subscribers = {}
+        for subscription in self.filtered:
+            regex = subscription.regex
+            if regex.groups:
+                self._separate.append(subscription)
+                continue
+            key = (regex.pattern, regex.flags)
+            if key not in subscribers:
+                subscribers[key] = []
+                by_flags[regex.flags].append(regex.pattern)
+            subscribers[key].append(subscription)
+        for flags, patterns in six.iteritems(by_flags):
+            for start in range(0, len(patterns), self.MAX_COMBINED):
+                chunk = patterns[start:start + self.MAX_COMBINED]
+                entries = [subscribers[(pattern, flags)] for pattern in chunk]
+                try:
+                    self._combined.append((self.combine(chunk, flags), entries))
+                except re.error:
+                    # Searched one by one then.
+                    self._separate.extend([subscription for entry in entries for subscription in entry])
+
+    def match(self, message, result):
+        result.extend(self.plain)
+        if not self.filtered:
+            return
+        if self._dirty:
+            self.build()
+        matched = []
+        for regex, entries in self._combined:
+            # Always matches, the groups of the patterns that occur are set.
+            groups = regex.match(message).groups()
+            for entry in compress(entries, six.moves.map(is_not, groups, repeat(None))):
+                matched.extend(entry)
+        for subscription in self._separate:
+            if subscription.regex.search(message) is not None:
+                matched.append(subscription)
+        matched.sort(key = self._positions.__getitem__)
+        result.extend(matched)
+
+class MessageDispatcher(object):
+    """
+    Delivers Chat and Console packets to the subscribers whose filters match.
+
+    Chat subscriptions are grouped by their exact (action, dest_type,
+    client_id) filter, with None for "any". A message is looked up once for
+    each combination of filtered keys in use, so the cost of a message does
+    not grow with the number of subscribers that don't match it. Console
+    subscriptions are indexed by the length and value of their origin prefix.
+    Regex filters on the message are only tried within the matching groups.
+
+    Callbacks are called as callback(session, packet).
+    """
+    def __init__(self):
+        self.chat_groups = {}
+        self.chat_masks = defaultdict(int)
+        self.console_groups = defaultdict(dict)
+        self.subscriptions = []
+
+    def __len__(self):
+        return len(self.subscriptions)
+
+    @classmethod
+    def compile(cls, pattern):
+        if pattern is None or hasattr(pattern, 'search'):
+            return pattern
+        return re.compile(pattern)
+
+    #
+    # Subscriptions
+    #
+    def subscribe_chat(self, callback, action = None, dest_type = None, client_id = None, pattern = None):
+        group_key = (action, dest_type, client_id)
+        subscription = Subscription(callback, 'chat', group_key, self.compile(pattern))
+        group = self.chat_groups.get(group_key)
+        if group is None:
+            group = self.chat_groups[group_key] = SubscriberGroup()
+        group.add(subscription)
+        self.chat_masks[self.get_mask(group_key)] += 1
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def subscribe_console(self, callback, origin = None, pattern = None):
+        group_key = origin or ''
+        subscription = Subscription(callback, 'console', group_key, self.compile(pattern))
+        groups = self.console_groups[len(group_key)]
+        group = groups.get(group_key)
+        if group is None:
+            group = groups[group_key] = SubscriberGroup()
+        group.add(subscription)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscriptions.remove(subscription)
+        group_key = subscription.group_key
+        if subscription.kind == 'chat':
+            group = self.chat_groups[group_key]
+            group.remove(subscription)
+            if not len(group):
+                del self.chat_groups[group_key]
+            mask = self.get_mask(group_key)
+            self.chat_masks[mask] -= 1
+            if not self.chat_masks[mask]:
+                del self.chat_masks[mask]
+        else:
+            groups = self.console_groups[len(group_key)]
+            group = groups[group_key]
+            group.remove(subscription)
+            if not len(group):
+                del groups[group_key]
+                if not groups:
+                    del self.console_groups[len(group_key)]
+
+    @classmethod
+    def get_mask(cls, group_key):
+        return tuple([value is not None for value in group_key])
+
+    #
+    # Matching
+    #
+    def match_chat(self, packet):
+        result = []
+        values = (packet.action, packet.dest_type, packet.client_id)
+        message = packet.message or ''
+        for mask in self.chat_masks:
+            group_key = tuple([value if used else None for value, used in zip(values, mask)])
+            group = self.chat_groups.get(group_key)
+            if group is not None:
+                group.match(message, result)
+        return result
+
+    def match_console(self, packet):
+        result = []
+        origin = packet.origin or ''
+        message = packet.message or ''
+        for length, groups in six.iteritems(self.console_groups):
+            if length > len(origin):
+                continue
+            group = groups.get(origin[:length])
+            if group is not None:
+                group.match(message, result)
+        return result
+
+    def dispatch(self, session, packet):
+        if isinstance(packet, recv.Chat):
+            subscriptions = self.match_chat(packet)
+        else:
+            subscriptions = self.match_console(packet)
+        for subscription in subscriptions:
+            subscription.callback(session, packet)
+        return len(subscriptions)
+
+    #
+    # Session integration
+    #
+    def attach(self, session):
+        """
+        Dispatches the Chat and Console packets of an AdminSession, or of
+        every session in an AdminPool.
+        """
+        session.on([recv.Chat, recv.Console], self.dispatch)
+
+    def detach(self, session):
+        session.off([recv.Chat, recv.Console], self.dispatch)
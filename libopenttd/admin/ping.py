@@ -0,0 +1,166 @@
+from bisect import bisect_left
+from collections import deque
+
+from libopenttd.utils.clock import monotonic
+from . import send, recv
+
+# Upper bounds (in seconds) of the round trip time histogram buckets, the last
+#  bucket holds everything slower.
+RTT_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+class PingMonitor(object):
+    """
+    Measures round trip time and liveness of an AdminSession with Ping and
+    Pong packets.
+
+    Every interval seconds a Ping with the next payload is sent, Pongs are
+    matched against the pings still outstanding. The round trip time is kept
+    as an exponentially weighted moving average (srtt, with rttvar as its
+    mean deviation, like TCP does) and as a histogram over RTT_BUCKETS.
+
+    status is 'unknown' until the first Pong arrives, 'slow' when the last
+    round trip or the oldest outstanding ping took longer than slow_after,
+    and 'dead' once a ping has gone unanswered for timeout seconds, at which
+    point the on_dead callbacks are called with the monitor. A Pong arriving
+    after that brings it back to life and calls the on_alive callbacks.
+
+    tick() has to be called regularly, it returns the amount of seconds until
+    it wants to be called again. AdminPool.monitor() takes care of that.
+    """
+    def __init__(self, session, interval = 5.0, timeout = 15.0, slow_after = 1.0, alpha = 0.125, beta = 0.25):
+        self.session = session
+        self.interval = interval
+        self.timeout = timeout
+        self.slow_after = slow_after
+        self.alpha = alpha
+        self.beta = beta
+        self.on_dead = []
+        self.on_alive = []
+
+        self.payload = 0
+        self.outstanding = deque()
+        self.last_sent = None
+        self.dead = False
+        self.reset_stats()
+
+        session.on(recv.Pong, self.handle_pong)
+        session.on('ready', self.handle_ready)
+
+    def close(self):
+        self.session.off(recv.Pong, self.handle_pong)
+        self.session.off('ready', self.handle_ready)
+
+    def reset_stats(self):
+        self.srtt = None
+        self.rttvar = None
+        self.last_rtt = None
+        self.histogram = [0] * (len(RTT_BUCKETS) + 1)
+        self.samples = 0
+        self.lost = 0
+
+    def handle_ready(self, session):
+        self.outstanding.clear()
+        self.last_sent = None
+        self.dead = False
+
+    def handle_pong(self, session, packet):
+        if not any([payload == packet.payload for payload, _ in self.outstanding]):
+            # Answer to a Ping someone else sent, like a session barrier.
+            return
+        now = monotonic()
+        # Pongs come back in the order the pings were sent, so any ping sent
+        #  before the answered one is not going to be answered anymore.
+        while self.outstanding:
+            payload, sent = self.outstanding.popleft()
+            if payload == packet.payload:
+                self.add_sample(now - sent)
+                break
+            self.lost += 1
+        if self.dead:
+            self.dead = False
+            for callback in list(self.on_alive):
+                callback(self)
+
+    def add_sample(self, rtt):
+        self.last_rtt = rtt
+        self.samples += 1
+        self.histogram[bisect_left(RTT_BUCKETS, rtt)] += 1
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.0
+        else:
+            self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - rtt)
+            self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+
+    def send_ping(self, now):
+        self.payload = self.session.next_ping_payload()
+        self.outstanding.append((self.payload, now))
+        self.last_sent = now
+        self.session.send_packet(send.Ping(payload = self.payload))
+
+    def get_waiting(self, now = None):
+        """
+        Returns how long the oldest unanswered ping has been waiting.
+        """
+        if not self.outstanding:
+            return 0.0
+        return (now if now is not None else monotonic()) - self.outstanding[0][1]
+
+    def tick(self, now = None):
+        if now is None:
+            now = monotonic()
+        if not self.session.ready:
+            return self.interval
+        if not self.dead and self.get_waiting(now) >= self.timeout:
+            self.dead = True
+            for callback in list(self.on_dead):
+                callback(self)
+            return self.interval
+        if self.last_sent is None or now - self.last_sent >= self.interval:
+            self.send_ping(now)
+            next_tick = self.interval
+        else:
+            next_tick = self.interval - (now - self.last_sent)
+        if self.outstanding:
+            next_tick = min(next_tick, max(self.timeout - self.get_waiting(now), 0))
+        return next_tick
+
+    @property
+    def status(self):
+        if self.dead or not self.session.ready:
+            return 'dead'
+        waiting = self.get_waiting()
+        if waiting >= self.timeout:
+            return 'dead'
+        if self.last_rtt is None:
+            return 'unknown'
+        if self.last_rtt >= self.slow_after or waiting >= self.slow_after:
+            return 'slow'
+        return 'ok'
+
+    def percentile(self, fraction):
+        """
+        Estimates the round trip time below which the given fraction of the
+        samples fall, as the upper bound of the histogram bucket it lands in.
+        """
+        if not self.samples:
+            return None
+        wanted = fraction * self.samples
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if seen >= wanted and count:
+                return RTT_BUCKETS[bucket] if bucket < len(RTT_BUCKETS) else float('inf')
+        return float('inf')
+
+    def get_stats(self):
+        return {
+            'status':       self.status,
+            'srtt':         self.srtt,
+            'rttvar':       self.rttvar,
+            'last_rtt':     self.last_rtt,
+            'samples':      self.samples,
+            'lost':         self.lost,
+            'outstanding':  len(self.outstanding),
+            'histogram':    list(self.histogram),
+        }
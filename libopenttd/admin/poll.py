@@ -0,0 +1,245 @@
+from libopenttd.packets.enums import UpdateType, PollExtra
+from libopenttd.utils.clock import monotonic
+from libopenttd.utils.futures import Future
+from .exceptions import PollError
+from . import send, recv
+
+# Packets the server answers a poll with, per update type, and the field
+#  holding the id poll_extra selects on. Date polls have no id.
+POLL_RESPONSES = {
+    UpdateType.DATE:            (recv.Date, None),
+    UpdateType.CLIENT_INFO:     (recv.ClientInfo, 'client_id'),
+    UpdateType.COMPANY_INFO:    (recv.CompanyInfo, 'company_id'),
+    UpdateType.COMPANY_ECONOMY: (recv.CompanyEconomy, 'company_id'),
+    UpdateType.COMPANY_STATS:   (recv.CompanyStats, 'company_id'),
+}
+
+RESPONSE_TYPES = dict([(packet.pid, update_type) for update_type, (packet, _) in POLL_RESPONSES.items()])
+
+class TokenBucket(object):
+    """
+    Allows bursts of up to burst actions, refilled at rate per second.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now = None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now if now is not None else monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        self.refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def get_wait(self, now):
+        self.refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+class PollBatch(object):
+    """
+    Polls sent together, resolved by the barrier sent after them. requests
+    holds (poll_type, extra, future) for every future the polls answer.
+    """
+    __slots__ = ('requests', 'packets')
+
+    def __init__(self):
+        self.requests = []
+        self.packets = {}
+
+    def add(self, poll_type, extra, future):
+        self.requests.append((poll_type, extra, future))
+        self.packets.setdefault(poll_type, [])
+
+class ServerPolls(object):
+    """
+    Rate limit of one server and the polls waiting to be sent to it: per
+    poll type the future of every distinct poll_extra, in the order the poll
+    types were requested.
+    """
+    __slots__ = ('bucket', 'pending', 'order', 'timer')
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.pending = {}
+        self.order = []
+        self.timer = None
+
+    def __len__(self):
+        return sum([len(requests) for requests in self.pending.values()])
+
+class PollScheduler(object):
+    """
+    Sends Poll packets to the servers of an AdminPool on behalf of any number
+    of callers.
+
+    poll() returns a Future that resolves to the list of packets the server
+    answered with, filtered on the polled id unless PollExtra.ALL was
+    polled. Requests are held for window seconds, during which identical
+    requests share a single Future. When at least upgrade_threshold ids of
+    one update type are pending, or ALL is pending as well, they are all
+    answered by a single poll for ALL. Each server gets at most burst polls
+    at once and rate polls per second after that, the rest waits.
+
+    The server answers packets in order, so a Ping sent after the polls
+    tells when all responses have arrived. Futures fail with PollError when
+    the connection is lost before then.
+    """
+    def __init__(self, pool, window = 0.05, rate = 5.0, burst = 10, upgrade_threshold = 4):
+        self.pool = pool
+        self.window = window
+        self.rate = rate
+        self.burst = burst
+        self.upgrade_threshold = upgrade_threshold
+        self.servers = {}
+        self.in_flight = {}
+
+    def __len__(self):
+        return sum([len(server) for server in self.servers.values()])
+
+    def close(self):
+        for session in list(self.in_flight):
+            self.detach(session)
+        for server in self.servers.values():
+            if server.timer is not None:
+                server.timer.cancel()
+            self.fail(server, PollError("Poll scheduler closed"))
+        self.servers = {}
+
+    #
+    # Requests
+    #
+    def poll(self, key, poll_type, extra = PollExtra.ALL):
+        if poll_type not in POLL_RESPONSES:
+            raise PollError("Update type %s can't be polled" % UpdateType.get_name(poll_type))
+        session = self.pool.sessions.get(key)
+        if session is None or not session.ready:
+            raise PollError("Session '%s' is not connected" % (key, ))
+        if session not in self.in_flight:
+            self.attach(session)
+        if POLL_RESPONSES[poll_type][1] is None:
+            extra = PollExtra.ALL
+
+        server = self.servers.get(key)
+        if server is None:
+            server = self.servers[key] = ServerPolls(TokenBucket(self.rate, self.burst))
+        requests = server.pending.get(poll_type)
+        if requests is None:
+            requests = server.pending[poll_type] = {}
+            server.order.append(poll_type)
+        future = requests.get(extra)
+        if future is None or future.cancelled():
+            future = requests[extra] = Future()
+        if server.timer is None:
+            server.timer = self.pool.call_later(self.window, self.flush, key)
+        return future
+
+    def get_polls(self, requests):
+        """
+        Returns the poll_extra values to send for the requests of one poll
+        type, as a list of (extra, [(extra, future), ...]) for the futures
+        every poll answers.
+        """
+        if PollExtra.ALL in requests or len(requests) >= self.upgrade_threshold:
+            return [(PollExtra.ALL, list(requests.items()))]
+        return [(extra, [(extra, future)]) for extra, future in sorted(requests.items())]
+
+    def flush(self, key):
+        """
+        Sends the pending polls of a server as far as its rate limit allows,
+        the rest is sent once the limit allows again.
+        """
+        server = self.servers.get(key)
+        if server is None:
+            return
+        server.timer = None
+        session = self.pool.sessions.get(key)
+        if session is None or not session.ready:
+            del self.servers[key]
+            self.fail(server, PollError("Session '%s' is not connected" % (key, )))
+            return
+
+        now = monotonic()
+        batch = PollBatch()
+        while server.order:
+            poll_type = server.order[0]
+            requests = server.pending[poll_type]
+            for extra, future in list(requests.items()):
+                if future.cancelled():
+                    del requests[extra]
+            for extra, answered in self.get_polls(requests):
+                if not server.bucket.take(now):
+                    break
+                session.send_packet(send.Poll(poll_type = poll_type, poll_extra = extra))
+                for wanted, future in answered:
+                    del requests[wanted]
+                    if future.set_running_or_notify_cancel():
+                        batch.add(poll_type, wanted, future)
+            if requests:
+                break
+            del server.pending[poll_type]
+            server.order.pop(0)
+
+        if batch.requests:
+            self.in_flight[session].append(batch)
+            session.barrier(lambda session: self.resolve(session, batch))
+        if server.order:
+            server.timer = self.pool.call_later(server.bucket.get_wait(now), self.flush, key)
+
+    def resolve(self, session, batch):
+        self.in_flight[session].remove(batch)
+        for poll_type, extra, future in batch.requests:
+            packets = batch.packets[poll_type]
+            if extra != PollExtra.ALL:
+                field = POLL_RESPONSES[poll_type][1]
+                packets = [packet for packet in packets if getattr(packet, field) == extra]
+            future.set_result(packets)
+
+    def fail(self, server, exception):
+        for requests in server.pending.values():
+            for future in requests.values():
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(exception)
+        server.pending = {}
+        server.order = []
+
+    #
+    # Session integration
+    #
+    def attach(self, session):
+        self.in_flight[session] = []
+        packets = [packet for packet, _ in POLL_RESPONSES.values()]
+        session.on(packets, self.handle_response, subscribe = False)
+        session.on('disconnected', self.handle_disconnected)
+
+    def detach(self, session):
+        packets = [packet for packet, _ in POLL_RESPONSES.values()]
+        session.off(packets, self.handle_response)
+        session.off('disconnected', self.handle_disconnected)
+        self.handle_disconnected(session)
+        del self.in_flight[session]
+
+    def handle_response(self, session, packet):
+        poll_type = RESPONSE_TYPES[packet.pid]
+        for batch in self.in_flight[session]:
+            if poll_type in batch.packets:
+                batch.packets[poll_type].append(packet)
+
+    def handle_disconnected(self, session):
+        batches, self.in_flight[session] = self.in_flight[session], []
+        exception = PollError("Connection lost before the poll was answered")
+        for batch in batches:
+            for _, _, future in batch.requests:
+                future.set_exception(exception)
+        if self.pool.sessions.get(session.key) is session and session.key in self.servers:
+            server = self.servers.pop(session.key)
+            if server.timer is not None:
+                server.timer.cancel()
+            self.fail(server, exception)
@@ -0,0 +1,522 @@
+import heapq
+import itertools
+import os
+import socket
+import threading
+
+from collections import deque
+
+from .ping import PingMonitor
+from .session import AdminSession
+from libopenttd.packets.packetsocket import resolve_address
+from libopenttd.utils import six
+from libopenttd.utils.clock import monotonic, perf_counter
+from libopenttd.utils.poller import Poller, READ, WRITE, ERROR
+
+class Timer(object):
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class ServerMetrics(object):
+    __slots__ = ('packets', 'bytes', 'connects', 'disconnects', 'failures', 'last_activity')
+
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.connects = 0
+        self.disconnects = 0
+        self.failures = 0
+        self.last_activity = None
+
+    def as_dict(self):
+        return dict([(name, getattr(self, name)) for name in self.__slots__])
+
+class AdminPool(object):
+    """
+    Runs any number of AdminSessions, each to its own server with its own
+    password and subscriptions, on a single poll loop.
+
+    Every session that has data waiting gets exactly one read of at most
+    READ_BUFFER_SIZE bytes per loop iteration, after which the packets that
+    completed are handled, so a busy server can never hold up the others for
+    more than one buffer's worth of packets. The order in which ready
+    sessions are handled rotates every iteration.
+
+    The loop only wakes up for socket activity and for timers scheduled with
+    call_later, idle connections cost nothing but their file descriptor.
+    Other file descriptors can be watched with add_reader and add_writer.
+    Connecting never blocks the loop, see connect().
+    """
+    session_class = AdminSession
+    connect_timeout = 10.0
+
+    def __init__(self):
+        self.sessions = {}
+        self.poller = Poller()
+        self.fds = {}
+        self.registered = {}
+        self.readers = {}
+        self.writers = {}
+        self.timers = []
+        self.timer_counter = itertools.count()
+        self.handlers = []
+        self.metrics = {}
+        self.monitors = {}
+        self.connect_timers = {}
+        self.connect_failed = []
+        self.lookups = set()
+        self.lookups_done = deque()
+        self.wakeup = None
+        self.wakeup_lock = threading.Lock()
+        self.turn = 0
+        self.running = False
+
+        self.loops = 0
+        self.busy_time = 0.0
+        self.started = monotonic()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, key):
+        return key in self.sessions
+
+    def __getitem__(self, key):
+        return self.sessions[key]
+
+    def __iter__(self):
+        return iter(self.sessions)
+
+    #
+    # Sessions
+    #
+    def add(self, key, host, port = None, password = '', **kwargs):
+        """
+        Creates a session for the server at host:port and adds it as key.
+        """
+        return self.add_session(key, self.session_class(host, port, password, **kwargs))
+
+    def add_session(self, key, session):
+        if key in self.sessions:
+            raise KeyError("A session named '%s' is already in the pool" % (key, ))
+        session.key = key
+        self.sessions[key] = session
+        self.metrics[key] = ServerMetrics()
+        session.on('ready', self.handle_ready)
+        session.on('disconnected', self.handle_disconnected)
+        for packet, handler in self.handlers:
+            session.on(packet, handler)
+        if session.socket is not None:
+            self.watch(session)
+        return session
+
+    def remove(self, key, quit = True):
+        session = self.sessions.pop(key)
+        self.lookups.discard(session)
+        self.cancel_connect_timer(session)
+        self.unwatch(session)
+        session.close(quit = quit)
+        session.off('ready', self.handle_ready)
+        session.off('disconnected', self.handle_disconnected)
+        for packet, handler in self.handlers:
+            session.off(packet, handler)
+        del self.metrics[key]
+        monitor = self.monitors.pop(key, None)
+        if monitor is not None:
+            monitor.close()
+        return session
+
+    def on(self, key, handler = None):
+        """
+        Registers handler on every session in the pool, including sessions
+        that are added later. Takes the same arguments as AdminSession.on.
+        """
+        if handler is None:
+            def _inner(func):
+                self.on(key, func)
+                return func
+            return _inner
+        self.handlers.append((key, handler))
+        for session in six.itervalues(self.sessions):
+            session.on(key, handler)
+        return handler
+
+    def off(self, key, handler):
+        self.handlers = [item for item in self.handlers if item != (key, handler)]
+        for session in six.itervalues(self.sessions):
+            session.off(key, handler)
+
+    def connect(self, key = None):
+        """
+        Starts connecting the session named key, or every disconnected
+        session when no key is given, without blocking. Connections that fail,
+        straight away or later on, are reported to the connect_failed
+        listeners as listener(session, error). Returns the sessions that
+        failed straight away.
+
+        Hostnames are looked up in a thread first, see start_lookup.
+        """
+        if key is not None:
+            sessions = [self.sessions[key]]
+        else:
+            sessions = [session for session in six.itervalues(self.sessions)
+                        if session.socket is None and session not in self.lookups]
+        failed = []
+        for session in sessions:
+            if session in self.lookups:
+                continue
+            self.unwatch(session)
+            address = resolve_address(session.address, session.socket_class.DEFAULT_FAMILY, numeric = True)
+            if address is None:
+                self.start_lookup(session)
+            elif not self.start_connect(session, address):
+                failed.append(session)
+        return failed
+
+    def start_connect(self, session, address):
+        try:
+            connected = session.start_connect(address)
+        except socket.error as exc:
+            self.handle_connect_failed(session, exc)
+            return False
+        if connected:
+            self.handle_connected(session)
+        else:
+            self.watch(session, WRITE)
+            self.connect_timers[session] = self.call_later(self.connect_timeout, self.check_connect, session)
+        return True
+
+    def start_lookup(self, session):
+        """
+        Looks up the hostname of session in a thread, getaddrinfo can take
+        seconds. The thread wakes up the loop through a pipe once it's done,
+        and finish_lookups starts connecting.
+        """
+        if self.wakeup is None:
+            self.wakeup = os.pipe()
+        if not self.lookups:
+            self.add_reader(self.wakeup[0], self.finish_lookups)
+        self.lookups.add(session)
+        thread = threading.Thread(target = self.lookup,
+                                  args = (session, session.address, session.socket_class.DEFAULT_FAMILY))
+        thread.daemon = True
+        thread.start()
+
+    def lookup(self, session, address, family):
+        # Runs in the lookup thread.
+        try:
+            result = resolve_address(address, family)
+        except socket.error as exc:
+            result = exc
+        self.lookups_done.append((session, result))
+        with self.wakeup_lock:
+            # The pool may have been closed meanwhile.
+            if self.wakeup is not None:
+                os.write(self.wakeup[1], b'\0')
+
+    def finish_lookups(self):
+        os.read(self.wakeup[0], 4096)
+        while self.lookups_done:
+            session, result = self.lookups_done.popleft()
+            if session not in self.lookups:
+                # Removed from the pool while being looked up.
+                continue
+            self.lookups.discard(session)
+            if isinstance(result, socket.error):
+                self.handle_connect_failed(session, result)
+            else:
+                self.start_connect(session, result)
+        if not self.lookups:
+            self.remove_reader(self.wakeup[0])
+
+    def finish_connect(self, session):
+        self.cancel_connect_timer(session)
+        # The session closes its socket when connecting failed, so stop
+        #  watching it first; handle_connected watches it again.
+        self.unwatch(session)
+        try:
+            session.finish_connect()
+        except socket.error as exc:
+            self.handle_connect_failed(session, exc)
+            return
+        self.handle_connected(session)
+
+    def check_connect(self, session):
+        self.connect_timers.pop(session, None)
+        if session.connecting:
+            self.handle_connect_failed(session, socket.timeout("Connection timed out"))
+
+    def cancel_connect_timer(self, session):
+        timer = self.connect_timers.pop(session, None)
+        if timer is not None:
+            timer.cancel()
+
+    def handle_connected(self, session):
+        metrics = self.metrics.get(session.key)
+        if metrics is not None:
+            metrics.connects += 1
+        self.watch(session)
+
+    def handle_connect_failed(self, session, error):
+        self.cancel_connect_timer(session)
+        # Forget the file descriptor before closing it, it may be reused right away.
+        self.unwatch(session)
+        session.close(quit = False)
+        metrics = self.metrics.get(session.key)
+        if metrics is not None:
+            metrics.failures += 1
+        for listener in list(self.connect_failed):
+            listener(session, error)
+
+    def close(self):
+        for session in list(six.itervalues(self.sessions)):
+            session.close()
+        self.lookups.clear()
+        self.poller.close()
+        with self.wakeup_lock:
+            if self.wakeup is not None:
+                for fd in self.wakeup:
+                    os.close(fd)
+                self.wakeup = None
+        self.running = False
+
+    def monitor(self, key, reconnect = True, **kwargs):
+        """
+        Starts tracking round trip time and liveness of the session named key
+        with a PingMonitor, which is returned. With reconnect set, a session
+        that stops answering pings is closed and connected again.
+        """
+        session = self.sessions[key]
+        monitor = self.monitors.get(key)
+        if monitor is not None:
+            monitor.close()
+        monitor = self.monitors[key] = PingMonitor(session, **kwargs)
+        if reconnect:
+            monitor.on_dead.append(self.handle_dead)
+        self.tick_monitor(monitor)
+        return monitor
+
+    def tick_monitor(self, monitor):
+        if self.monitors.get(monitor.session.key) is monitor:
+            self.call_later(monitor.tick(), self.tick_monitor, monitor)
+
+    def handle_dead(self, monitor):
+        key = monitor.session.key
+        monitor.session.close(quit = False)
+        if key in self.sessions:
+            self.connect(key)
+
+    def handle_ready(self, session):
+        self.metrics[session.key].last_activity = monotonic()
+
+    def handle_disconnected(self, session):
+        self.metrics[session.key].disconnects += 1
+        self.unwatch(session)
+
+    #
+    # File descriptors
+    #
+    def watch(self, session, events = READ):
+        self.unwatch(session)
+        fd = session.fileno()
+        self.fds[fd] = session
+        self.registered[session] = (fd, events)
+        self.poller.register(fd, events)
+
+    def unwatch(self, session):
+        entry = self.registered.pop(session, None)
+        if entry is None:
+            return
+        self.fds.pop(entry[0], None)
+        self.poller.unregister(entry[0])
+
+    def update_interest(self, session):
+        entry = self.registered.get(session)
+        if entry is None:
+            return
+        fd, events = entry
+        if session.connecting:
+            wanted = WRITE
+        elif session.wants_write:
+            wanted = READ | WRITE
+        else:
+            wanted = READ
+        if wanted != events:
+            self.registered[session] = (fd, wanted)
+            self.poller.modify(fd, wanted)
+
+    def add_reader(self, fd, callback, *args):
+        """
+        Calls callback(*args) whenever fd (a file descriptor or an object
+        with a fileno method) becomes readable.
+        """
+        if not isinstance(fd, six.integer_types):
+            fd = fd.fileno()
+        self.readers[fd] = (callback, args)
+        self.update_fd(fd)
+
+    def remove_reader(self, fd):
+        if not isinstance(fd, six.integer_types):
+            fd = fd.fileno()
+        if self.readers.pop(fd, None) is not None:
+            self.update_fd(fd)
+
+    def add_writer(self, fd, callback, *args):
+        """
+        Calls callback(*args) whenever fd (a file descriptor or an object
+        with a fileno method) becomes writable, until remove_writer.
+        """
+        if not isinstance(fd, six.integer_types):
+            fd = fd.fileno()
+        self.writers[fd] = (callback, args)
+        self.update_fd(fd)
+
+    def remove_writer(self, fd):
+        if not isinstance(fd, six.integer_types):
+            fd = fd.fileno()
+        if self.writers.pop(fd, None) is not None:
+            self.update_fd(fd)
+
+    def update_fd(self, fd):
+        events = (READ if fd in self.readers else 0) | (WRITE if fd in self.writers else 0)
+        if not events:
+            self.poller.unregister(fd)
+        elif fd in self.poller:
+            self.poller.modify(fd, events)
+        else:
+            self.poller.register(fd, events)
+
+    #
+    # Timers
+    #
+    def call_later(self, delay, callback, *args):
+        """
+        Calls callback(*args) from the loop after delay seconds. Returns a
+        Timer that can be cancelled.
+        """
+        timer = Timer(monotonic() + delay, callback, args)
+        heapq.heappush(self.timers, (timer.deadline, next(self.timer_counter), timer))
+        return timer
+
+    def run_timers(self, now):
+        timers = self.timers
+        while timers and timers[0][0] <= now:
+            timer = heapq.heappop(timers)[2]
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+        while timers and timers[0][2].cancelled:
+            heapq.heappop(timers)
+
+    def get_wait(self, timeout, now):
+        wait = timeout
+        if self.timers:
+            until = max(self.timers[0][0] - now, 0)
+            if wait is None or until < wait:
+                wait = until
+        return wait
+
+    #
+    # Loop
+    #
+    def run_once(self, timeout = None):
+        """
+        Waits up to timeout seconds for socket activity or the next timer,
+        whichever comes first, and handles it. Returns the amount of packets
+        handled.
+        """
+        self.run_timers(monotonic())
+        for session in list(self.registered):
+            self.update_interest(session)
+
+        events = self.poller.poll(self.get_wait(timeout, monotonic()))
+        self.loops += 1
+        if not events:
+            return 0
+        started = perf_counter()
+
+        ready = []
+        for fd, flags in events:
+            writer = self.writers.get(fd)
+            if writer is not None and flags & (WRITE | ERROR):
+                writer[0](*writer[1])
+            reader = self.readers.get(fd)
+            if reader is not None and (flags & (READ | ERROR) or writer is None):
+                reader[0](*reader[1])
+            if reader is not None or writer is not None:
+                continue
+            session = self.fds.get(fd)
+            if session is None:
+                continue
+            if session.connecting:
+                if flags & (WRITE | ERROR):
+                    self.finish_connect(session)
+                continue
+            if flags & WRITE:
+                session.process_send()
+            if flags & (READ | ERROR) and session.socket is not None:
+                ready.append(session)
+
+        handled = 0
+        if ready:
+            self.turn += 1
+            offset = self.turn % len(ready)
+            now = monotonic()
+            for session in ready[offset:] + ready[:offset]:
+                if session.socket is None:
+                    continue
+                metrics = self.metrics.get(session.key)
+                read = session.process_recv()
+                count = session.process_packets()
+                if metrics is not None:
+                    metrics.bytes += read
+                    metrics.packets += count
+                    metrics.last_activity = now
+                handled += count
+                if session.wants_write:
+                    session.process_send()
+
+        self.busy_time += perf_counter() - started
+        return handled
+
+    def run(self, timeout = None):
+        """
+        Runs the loop until stop() is called or there is nothing left to wait
+        for.
+        """
+        self.running = True
+        while self.running and (self.registered or self.readers or self.writers or self.timers):
+            self.run_once(timeout)
+        self.running = False
+
+    def stop(self):
+        self.running = False
+
+    #
+    # Metrics
+    #
+    def get_metrics(self):
+        """
+        Returns pool wide totals, along with the metrics of each server.
+        """
+        servers = dict([(key, metrics.as_dict()) for key, metrics in six.iteritems(self.metrics)])
+        for key, monitor in six.iteritems(self.monitors):
+            servers[key]['ping'] = monitor.get_stats()
+        return {
+            'sessions':     len(self.sessions),
+            'connected':    len([1 for session in six.itervalues(self.sessions) if session.connected]),
+            'ready':        len([1 for session in six.itervalues(self.sessions) if session.ready]),
+            'packets':      sum([metrics.packets for metrics in six.itervalues(self.metrics)]),
+            'bytes':        sum([metrics.bytes for metrics in six.itervalues(self.metrics)]),
+            'loops':        self.loops,
+            'busy_time':    self.busy_time,
+            'uptime':       monotonic() - self.started,
+            'servers':      servers,
+        }
@@ -0,0 +1,465 @@
+import errno
+import socket
+
+from collections import deque
+
+from libopenttd.packets.enums import UpdateType, UpdateFrequency, PollExtra, ErrorCode
+from libopenttd.packets.fields import gamedate_to_datetime, datetime_to_gamedate
+from libopenttd.packets.packetsocket import encode_packet
+from libopenttd.utils import six
+from libopenttd.utils.enums import EnumHelper
+from .base import AdminServerSocket
+from .session import PACKET_UPDATE_TYPES, FREQUENCY_PREFERENCE
+from .state import GameState, CLIENT_FIELDS, COMPANY_FIELDS, ECONOMY_FIELDS, STATS_FIELDS
+from . import send, recv
+
+# Upstream packets every client gets, whatever it subscribed to.
+BROADCAST_PIDS = frozenset([recv.NewGame.pid, recv.Shutdown.pid])
+
+PID_UPDATE_TYPES = dict([(packet.pid, update_type) for packet, update_type in six.iteritems(PACKET_UPDATE_TYPES)])
+
+FORWARDED_PACKETS = tuple(PACKET_UPDATE_TYPES) + (recv.NewGame, recv.Shutdown, recv.Rcon, recv.RconEnd)
+
+# Client packets the proxy handles itself, everything else is passed on.
+CLIENT_PIDS = frozenset([packet.pid for packet in (send.Join, send.Quit, send.UpdateFrequency, send.Poll,
+                                                   send.Ping)])
+
+PERIODIC_FREQUENCIES = frozenset([UpdateFrequency.DAILY, UpdateFrequency.WEEKLY, UpdateFrequency.MONTHLY,
+                                  UpdateFrequency.QUARTERLY, UpdateFrequency.ANUALLY])
+
+def get_period(date, frequency):
+    """
+    Returns which period of frequency the game date falls in. The server
+    sends periodic updates on the first day of every period, weeks start on
+    the days where date % 7 == 3.
+    """
+    if frequency == UpdateFrequency.DAILY:
+        return date
+    if frequency == UpdateFrequency.WEEKLY:
+        return (date - 3) // 7
+    day = gamedate_to_datetime(date)
+    if frequency == UpdateFrequency.MONTHLY:
+        return day.year * 12 + day.month - 1
+    if frequency == UpdateFrequency.QUARTERLY:
+        return day.year * 4 + (day.month - 1) // 3
+    return day.year
+
+class ClientState(EnumHelper):
+    AUTHENTICATING      = 0x00  #< Connected, waiting for Join.
+    WAITING             = 0x01  #< Joined, waiting for the upstream session to be ready.
+    ACTIVE              = 0x02  #< Protocol and Welcome sent.
+
+class ProxyClient(object):
+    """
+    A downstream admin connection to the proxy.
+
+    The socket is non-blocking, whatever it doesn't take right away is kept
+    in pending until flush() gets it out. on_pending(client) is called
+    whenever a send leaves data pending.
+    """
+    def __init__(self, sock, on_pending = None):
+        self.socket = sock
+        self.socket.setblocking(0)
+        self.on_pending = on_pending
+        self.state = ClientState.AUTHENTICATING
+        self.name = None
+        self.subscriptions = {}
+        self.periods = {}
+        self.pending = deque()
+        self.pending_size = 0
+
+    def __repr__(self):
+        return '<ProxyClient %s (%s)>' % (self.name, ClientState.get_name(self.state))
+
+    @property
+    def active(self):
+        return self.state == ClientState.ACTIVE
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def send_packet(self, packet):
+        self.send_frame(encode_packet(packet, self.socket.extra_info))
+
+    def send_frame(self, frame):
+        if not self.socket.connected:
+            return
+        if isinstance(frame, memoryview):
+            frame = frame.tobytes()
+        self.pending.append(frame)
+        self.pending_size += len(frame)
+        if len(self.pending) == 1:
+            self.flush()
+        if self.pending and self.on_pending is not None:
+            self.on_pending(self)
+
+    def flush(self):
+        """
+        Sends as much of the pending data as the socket takes without
+        blocking, returns whether anything is left.
+        """
+        while self.pending and self.socket.connected:
+            data = self.pending[0]
+            try:
+                sent = self.socket.send(data)
+            except socket.error as exc:
+                if exc.args and exc.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                self.socket._connected = False
+                break
+            self.pending_size -= sent
+            if sent < len(data):
+                self.pending[0] = data[sent:]
+                break
+            self.pending.popleft()
+        return bool(self.pending)
+
+class ProxyServer(object):
+    """
+    Serves the admin protocol to any number of local clients on behalf of a
+    single upstream AdminSession.
+
+    Clients join with the proxy's own password and are welcomed with the
+    Protocol and Welcome of the upstream server. Their subscriptions are
+    merged: the upstream session subscribes to every update type a client
+    wants, at the most frequent frequency any of them (or the session
+    itself) asked for, and each upstream frame is passed on to every client
+    subscribed to it without being decoded. A client that asked for a less
+    frequent period than the upstream one only gets the updates sent on the
+    first game day of each of its periods, the game date is known from the
+    daily Date updates the state mirror subscribes to. Subscriptions are
+    never dropped upstream when clients leave.
+
+    Client sockets never block the pool: what a client doesn't read right
+    away is queued and sent when its socket becomes writable, and a client
+    that lets more than max_pending bytes queue up is dropped.
+
+    Polls are answered from a GameState mirror of the upstream server, which
+    is synchronised once after every (re)connect, so they never reach the
+    server. Command names are polled upstream once and cached. Rcon output
+    goes back to the client that sent the command, output of commands sent
+    by anything else on the session (like an RconClient) is left alone; the
+    session counts the rcon commands sent and answered, which tells them
+    apart. Pings are answered by the proxy, and the frames of everything
+    else clients send are passed upstream as they are.
+    """
+    def __init__(self, pool, session, address = ('127.0.0.1', 0), password = '', backlog = 16,
+                 max_pending = 1 << 20):
+        self.pool = pool
+        self.max_pending = max_pending
+        self.session = session
+        self.password = password
+        self.clients = []
+        self.rcon_owners = deque()
+        self.frequencies = {}
+        self.date = None
+        self.synced = False
+        self.pending_polls = []
+        self.names = None
+        self.names_waiters = None
+        self.names_collected = []
+
+        self.state = GameState()
+        self.state.attach(session)
+        session.on_frames(FORWARDED_PACKETS, self.handle_upstream)
+        session.on('ready', self.handle_ready)
+        session.on('disconnected', self.handle_disconnected)
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(address)
+        self.listener.listen(backlog)
+        self.address = self.listener.getsockname()
+        pool.add_reader(self.listener, self.accept)
+        if session.ready:
+            self.handle_ready(session)
+
+    def close(self):
+        for client in list(self.clients):
+            self.drop(client)
+        self.pool.remove_reader(self.listener)
+        self.listener.close()
+        self.state.detach(self.session)
+        self.session.off_frames(FORWARDED_PACKETS, self.handle_upstream)
+        self.session.off('ready', self.handle_ready)
+        self.session.off('disconnected', self.handle_disconnected)
+
+    #
+    # Downstream connections
+    #
+    def accept(self):
+        try:
+            conn, addr = self.listener.accept()
+        except socket.error:
+            return
+        client = ProxyClient(AdminServerSocket.from_socket(conn, addr), self.handle_pending)
+        self.clients.append(client)
+        self.pool.add_reader(client, self.handle_client, client)
+
+    def handle_pending(self, client):
+        if client not in self.clients:
+            return
+        if client.pending_size > self.max_pending:
+            # It stopped reading, drop it from the loop rather than in the middle of a send.
+            client.socket._connected = False
+            self.pool.call_later(0, self.drop, client)
+        else:
+            self.pool.add_writer(client, self.handle_writable, client)
+
+    def handle_writable(self, client):
+        if not client.flush():
+            self.pool.remove_writer(client)
+        if not client.socket.connected:
+            self.drop(client)
+
+    def drop(self, client):
+        if client not in self.clients:
+            return
+        self.clients.remove(client)
+        self.pool.remove_reader(client)
+        self.pool.remove_writer(client)
+        client.socket.close()
+        # Keep the positions, the server still answers their commands.
+        for owner in self.rcon_owners:
+            if owner[1] is client:
+                owner[1] = None
+        self.pending_polls = [item for item in self.pending_polls if item[0] is not client]
+        if self.names_waiters is not None and client in self.names_waiters:
+            self.names_waiters.remove(client)
+
+    def handle_client(self, client):
+        try:
+            client.socket.process_recv()
+        except socket.error as exc:
+            if not exc.args or exc.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                client.socket._connected = False
+        for pid, frame in client.socket.process_frames():
+            if client not in self.clients:
+                return
+            if pid in CLIENT_PIDS or not client.active:
+                packet = client.socket.decode_frame(pid, frame)
+                if packet is not None:
+                    self.handle_client_packet(client, packet)
+            else:
+                if pid == send.Rcon.pid:
+                    self.rcon_owners.append([self.session.rcon_sent, client])
+                self.session.send_frame(frame)
+        if not client.socket.connected:
+            self.drop(client)
+
+    def handle_client_packet(self, client, packet):
+        if client.state == ClientState.AUTHENTICATING:
+            if not isinstance(packet, send.Join):
+                self.reject(client, ErrorCode.NOT_EXPECTED)
+            elif packet.password != self.password:
+                self.reject(client, ErrorCode.WRONG_PASSWORD)
+            else:
+                client.name = packet.name
+                client.state = ClientState.WAITING
+                if self.session.ready:
+                    self.welcome(client)
+        elif isinstance(packet, send.Quit):
+            self.drop(client)
+        elif not client.active:
+            return
+        elif isinstance(packet, send.UpdateFrequency):
+            client.subscriptions[packet.update_type] = packet.update_freq
+            client.periods.pop(packet.update_type, None)
+            if self.date is not None and packet.update_freq in PERIODIC_FREQUENCIES:
+                # Like the server, start with the next period.
+                client.periods[packet.update_type] = (get_period(self.date, packet.update_freq), None)
+            self.subscribe(packet.update_type)
+        elif isinstance(packet, send.Poll):
+            self.handle_poll(client, packet)
+        elif isinstance(packet, send.Ping):
+            client.send_packet(recv.Pong(payload = packet.payload))
+
+    def reject(self, client, errorcode):
+        client.send_packet(recv.Error(errorcode = errorcode))
+        self.drop(client)
+
+    def welcome(self, client):
+        client.send_packet(recv.Protocol(version = self.session.protocol_version, settings = self.session.supported))
+        client.send_packet(self.session.welcome)
+        client.state = ClientState.ACTIVE
+
+    def subscribe(self, update_type):
+        wanted = [client.subscriptions[update_type] for client in self.clients
+                  if update_type in client.subscriptions]
+        # Never go less frequent than what the session already gets.
+        wanted.append(self.session.subscriptions.get(update_type))
+        for frequency in FREQUENCY_PREFERENCE:
+            if frequency in wanted:
+                break
+        else:
+            return
+        if self.frequencies.get(update_type) != frequency:
+            self.frequencies[update_type] = frequency
+            self.session.subscribe(update_type, frequency)
+
+    #
+    # Polls
+    #
+    def handle_poll(self, client, packet):
+        if packet.poll_type == UpdateType.NAMES:
+            self.poll_names(client)
+        elif not self.synced:
+            self.pending_polls.append((client, packet))
+        else:
+            for response in self.answer_poll(packet.poll_type, packet.poll_extra):
+                client.send_packet(response)
+
+    def answer_poll(self, poll_type, extra):
+        """
+        Returns the packets the server would answer a poll with, built from
+        the state mirror.
+        """
+        state = self.state
+        if poll_type == UpdateType.DATE:
+            return [recv.Date(date = state.date)] if state.date is not None else []
+        if poll_type == UpdateType.CLIENT_INFO:
+            clients = state.clients.values() if extra == PollExtra.ALL else \
+                [state.clients[extra]] if extra in state.clients else []
+            return [recv.ClientInfo(client_id = client.client_id,
+                                    **dict([(name, getattr(client, name)) for name in CLIENT_FIELDS]))
+                    for client in sorted(clients, key = lambda client: client.client_id)
+                    if client.name is not None]
+        companies = state.companies.values() if extra == PollExtra.ALL else \
+            [state.companies[extra]] if extra in state.companies else []
+        companies = sorted(companies, key = lambda company: company.company_id)
+        if poll_type == UpdateType.COMPANY_INFO:
+            packet, names = recv.CompanyInfo, COMPANY_FIELDS
+        elif poll_type == UpdateType.COMPANY_ECONOMY:
+            packet, names = recv.CompanyEconomy, ECONOMY_FIELDS
+        elif poll_type == UpdateType.COMPANY_STATS:
+            packet, names = recv.CompanyStats, STATS_FIELDS
+        else:
+            return []
+        return [packet(company_id = company.company_id,
+                       **dict([(name, getattr(company, name)) for name in names]))
+                for company in companies if getattr(company, names[0]) is not None]
+
+    def poll_names(self, client):
+        if self.names is not None:
+            for frame in self.names:
+                client.send_frame(frame)
+            return
+        if self.names_waiters is None:
+            self.names_waiters = []
+            self.names_collected = []
+            self.session.poll(UpdateType.NAMES)
+            self.session.barrier(self.handle_names_done)
+        self.names_waiters.append(client)
+
+    def handle_names_done(self, session):
+        self.names, waiters = self.names_collected, self.names_waiters
+        self.names_waiters = None
+        for client in waiters:
+            self.poll_names(client)
+
+    def handle_synced(self, session):
+        self.synced = True
+        pending, self.pending_polls = self.pending_polls, []
+        for client, packet in pending:
+            self.handle_poll(client, packet)
+
+    #
+    # Upstream
+    #
+    def handle_ready(self, session):
+        self.synced = False
+        self.names = None
+        self.names_waiters = None
+        session.barrier(self.handle_synced)
+        for client in list(self.clients):
+            if client.state == ClientState.WAITING:
+                self.welcome(client)
+
+    def handle_disconnected(self, session):
+        self.synced = False
+        self.date = None
+        self.rcon_owners = deque()
+        for client in list(self.clients):
+            if client.active:
+                self.drop(client)
+
+    def wants_update(self, client, update_type):
+        """
+        Returns whether client gets the update of update_type that just came
+        in, based on the frequency it asked for.
+        """
+        frequency = client.subscriptions.get(update_type)
+        if frequency is None:
+            return False
+        if frequency not in PERIODIC_FREQUENCIES or self.date is None or \
+                frequency == self.session.subscriptions.get(update_type):
+            return True
+        period = get_period(self.date, frequency)
+        last = client.periods.get(update_type)
+        if last is None or last[0] != period:
+            # First update of a new period, everything sent today goes.
+            client.periods[update_type] = (period, self.date)
+            return True
+        return last[1] == self.date
+
+    def handle_upstream(self, session, pid, frame):
+        if pid in (recv.Rcon.pid, recv.RconEnd.pid):
+            # The oldest unanswered command is session.rcon_done, its answer
+            #  is only ours when the proxy sent it.
+            owners = self.rcon_owners
+            while owners and owners[0][0] < session.rcon_done:
+                owners.popleft()
+            if owners and owners[0][0] == session.rcon_done:
+                owner = owners[0][1]
+                if pid == recv.RconEnd.pid:
+                    owners.popleft()
+                if owner is not None:
+                    owner.send_frame(frame)
+            return
+        if pid == recv.CmdNames.pid:
+            if self.names_waiters is not None:
+                self.names_collected.append(frame.tobytes())
+            return
+        if pid == recv.Date.pid:
+            packet = session.socket.decode_frame(pid, frame)
+            if packet is not None:
+                self.date = datetime_to_gamedate(packet.date)
+        update_type = PID_UPDATE_TYPES.get(pid)
+        broadcast = pid in BROADCAST_PIDS
+        data = None
+        for client in list(self.clients):
+            if client.active and (broadcast or self.wants_update(client, update_type)):
+                if data is None:
+                    data = frame.tobytes()
+                client.send_frame(data)
+
+class AdminProxy(object):
+    """
+    Lets many local admin clients share the admin connections of an
+    AdminPool, each pool session is served on its own address by a
+    ProxyServer.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.servers = {}
+
+    def __len__(self):
+        return len(self.servers)
+
+    def listen(self, key, address = ('127.0.0.1', 0), password = ''):
+        """
+        Serves the session named key on address, returns the address that
+        is listened on.
+        """
+        if key in self.servers:
+            raise KeyError("The session '%s' is already served" % (key, ))
+        server = self.servers[key] = ProxyServer(self.pool, self.pool.sessions[key], address, password)
+        return server.address
+
+    def unlisten(self, key):
+        self.servers.pop(key).close()
+
+    def close(self):
+        for server in six.itervalues(self.servers):
+            server.close()
+        self.servers = {}
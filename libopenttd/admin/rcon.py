@@ -0,0 +1,112 @@
+from collections import deque, namedtuple
+
+from .exceptions import RconError
+from libopenttd.utils.futures import Future
+from . import send, recv
+
+class RconResult(namedtuple('RconResult', 'command lines')):
+    """
+    Output of a single rcon command, lines is a list of (colour, text)
+    tuples in the order the server sent them.
+    """
+    __slots__ = ()
+
+    @property
+    def text(self):
+        return '\n'.join([line for _, line in self.lines])
+
+class RconCommand(object):
+    __slots__ = ('command', 'future', 'lines')
+
+    def __init__(self, command):
+        self.command = command
+        self.future = Future()
+        self.lines = []
+
+class RconClient(object):
+    """
+    Runs rcon commands on an AdminSession, several at a time.
+
+    The server executes rcon commands in the order it receives them, sending
+    zero or more Rcon lines followed by an RconEnd that echoes the command.
+    Output is therefore assigned to the oldest command in flight, and the
+    echo is used to confirm which command an RconEnd finishes. At most
+    max_in_flight commands are sent ahead, the rest wait until earlier ones
+    complete.
+
+    execute() returns a Future that resolves to an RconResult, or fails with
+    RconError when the connection is lost before the command completed.
+    """
+    def __init__(self, session, max_in_flight = 16):
+        self.session = session
+        self.max_in_flight = max_in_flight
+        self.in_flight = deque()
+        self.queued = deque()
+
+        session.on(recv.Rcon, self.handle_rcon)
+        session.on(recv.RconEnd, self.handle_rcon_end)
+        session.on('disconnected', self.handle_disconnected)
+
+    def __len__(self):
+        return len(self.in_flight) + len(self.queued)
+
+    def close(self):
+        self.session.off(recv.Rcon, self.handle_rcon)
+        self.session.off(recv.RconEnd, self.handle_rcon_end)
+        self.session.off('disconnected', self.handle_disconnected)
+        self.fail_all(RconError("Rcon client closed"))
+
+    def execute(self, command):
+        if not self.session.ready:
+            raise RconError("Session is not connected")
+        item = RconCommand(command)
+        self.queued.append(item)
+        self.send_queued()
+        return item.future
+
+    def execute_many(self, commands):
+        return [self.execute(command) for command in commands]
+
+    def send_queued(self):
+        while self.queued and len(self.in_flight) < self.max_in_flight:
+            item = self.queued.popleft()
+            if not item.future.set_running_or_notify_cancel():
+                continue
+            self.in_flight.append(item)
+            self.session.send_packet(send.Rcon(command = item.command))
+
+    def handle_rcon(self, session, packet):
+        if self.in_flight:
+            self.in_flight[0].lines.append((packet.colour, packet.result))
+
+    def handle_rcon_end(self, session, packet):
+        if not self.in_flight:
+            return
+        # The echo should always match the oldest command, when it doesn't the
+        #  commands before the matching one never got an answer, and the lines
+        #  collected on them were the output of the matching one.
+        for position, item in enumerate(self.in_flight):
+            if item.command == packet.command:
+                break
+        else:
+            position = 0
+        lines = []
+        for _ in range(position):
+            item = self.in_flight.popleft()
+            lines.extend(item.lines)
+            item.future.set_exception(RconError("No response to rcon command '%s'" % item.command))
+        item = self.in_flight.popleft()
+        item.future.set_result(RconResult(item.command, lines + item.lines))
+        self.send_queued()
+
+    def handle_disconnected(self, session):
+        self.fail_all(RconError("Connection lost before the rcon command completed"))
+
+    def fail_all(self, exception):
+        pending, self.in_flight = list(self.in_flight), deque()
+        for item in self.queued:
+            if item.future.set_running_or_notify_cancel():
+                pending.append(item)
+        self.queued = deque()
+        for item in pending:
+            item.future.set_exception(exception)
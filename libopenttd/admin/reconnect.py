@@ -0,0 +1,117 @@
+import random
+
+class Backoff(object):
+    """
+    Jittered exponential backoff: the n-th delay is picked at random between
+    half and all of min(cap, base * factor ** n), so that many connections
+    dropped at the same time don't all come back at the same time.
+    """
+    __slots__ = ('base', 'cap', 'factor', 'attempts', 'random')
+
+    def __init__(self, base = 1.0, cap = 300.0, factor = 2.0, random = random.random): # pylint: disable=W0621
+        self.base = base
+        self.cap = cap
+        self.factor = factor
+        self.attempts = 0
+        self.random = random
+
+    def next_delay(self):
+        delay = min(self.cap, self.base * self.factor ** min(self.attempts, 64))
+        self.attempts += 1
+        return delay / 2.0 + self.random() * delay / 2.0
+
+    def reset(self):
+        self.attempts = 0
+
+class ReconnectManager(object):
+    """
+    Keeps the sessions of an AdminPool connected.
+
+    Sessions that disconnect, fail to connect (including the pool's connect
+    timeout) or don't finish the handshake within handshake_timeout seconds
+    are connected again after a per-session jittered exponential backoff,
+    which is reset once the session is ready again. Reconnected sessions run
+    the handshake and send their subscriptions again by themselves.
+
+    Everything runs on the pool's timers, nothing ever blocks the loop.
+    """
+    def __init__(self, pool, base = 1.0, cap = 300.0, factor = 2.0, handshake_timeout = 30.0):
+        self.pool = pool
+        self.base = base
+        self.cap = cap
+        self.factor = factor
+        self.handshake_timeout = handshake_timeout
+        self.backoffs = {}
+        self.timers = {}
+        self.handshake_timers = {}
+
+        pool.on('ready', self.handle_ready)
+        pool.on('disconnected', self.handle_disconnected)
+        pool.connect_failed.append(self.handle_connect_failed)
+
+    def close(self):
+        self.pool.off('ready', self.handle_ready)
+        self.pool.off('disconnected', self.handle_disconnected)
+        self.pool.connect_failed.remove(self.handle_connect_failed)
+        for timer in list(self.timers.values()) + list(self.handshake_timers.values()):
+            timer.cancel()
+        self.timers = {}
+        self.handshake_timers = {}
+
+    def get_backoff(self, key):
+        backoff = self.backoffs.get(key)
+        if backoff is None:
+            backoff = self.backoffs[key] = Backoff(self.base, self.cap, self.factor)
+        return backoff
+
+    def start(self):
+        """
+        Connects every session in the pool that isn't connected yet.
+        """
+        for key, session in list(self.pool.sessions.items()):
+            if session.socket is None:
+                self.connect(key)
+
+    def connect(self, key):
+        self.timers.pop(key, None)
+        session = self.pool.sessions.get(key)
+        if session is None or session.socket is not None:
+            return
+        self.cancel_handshake_timer(key)
+        self.pool.connect(key)
+        if session.socket is not None or session in self.pool.lookups:
+            self.handshake_timers[key] = self.pool.call_later(self.handshake_timeout, self.check_handshake, key)
+
+    def schedule(self, key):
+        if key in self.timers or key not in self.pool:
+            return
+        delay = self.get_backoff(key).next_delay()
+        self.timers[key] = self.pool.call_later(delay, self.connect, key)
+
+    def cancel_handshake_timer(self, key):
+        timer = self.handshake_timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+
+    def check_handshake(self, key):
+        # Only ever called for the current attempt, the timer is cancelled
+        #  when the attempt ends one way or another.
+        self.handshake_timers.pop(key, None)
+        session = self.pool.sessions.get(key)
+        if session is None or session.socket is None:
+            return
+        if not session.ready and not session.connecting:
+            # Connected, but the server never finished the handshake.
+            session.close(quit = False)
+
+    def handle_ready(self, session):
+        self.cancel_handshake_timer(session.key)
+        self.get_backoff(session.key).reset()
+
+    def handle_disconnected(self, session):
+        self.cancel_handshake_timer(session.key)
+        self.schedule(session.key)
+
+    def handle_connect_failed(self, session, error):
+        self.cancel_handshake_timer(session.key)
+        self.schedule(session.key)
@@ -0,0 +1,461 @@
+import select
+import socket
+
+from collections import defaultdict
+
+from .base import AdminSocket
+from libopenttd.packets.enums import UpdateType, UpdateFrequency
+from libopenttd.packets.packetsocket import FRAME_HEADER
+from libopenttd.utils import six
+from libopenttd.utils.enums import EnumHelper
+from . import send, recv
+
+# Which update type the server needs us to subscribe to before it sends us
+#  a certain packet.
+PACKET_UPDATE_TYPES = {
+    recv.Date:              UpdateType.DATE,
+    recv.ClientJoin:        UpdateType.CLIENT_INFO,
+    recv.ClientInfo:        UpdateType.CLIENT_INFO,
+    recv.ClientUpdate:      UpdateType.CLIENT_INFO,
+    recv.ClientQuit:        UpdateType.CLIENT_INFO,
+    recv.ClientError:       UpdateType.CLIENT_INFO,
+    recv.CompanyNew:        UpdateType.COMPANY_INFO,
+    recv.CompanyInfo:       UpdateType.COMPANY_INFO,
+    recv.CompanyUpdate:     UpdateType.COMPANY_INFO,
+    recv.CompanyRemove:     UpdateType.COMPANY_INFO,
+    recv.CompanyEconomy:    UpdateType.COMPANY_ECONOMY,
+    recv.CompanyStats:      UpdateType.COMPANY_STATS,
+    recv.Chat:              UpdateType.CHAT,
+    recv.Console:           UpdateType.CONSOLE,
+    recv.CmdNames:          UpdateType.NAMES,
+    recv.CmdLogging:        UpdateType.LOGGING,
+    recv.Gamescript:        UpdateType.GAMESCRIPT,
+}
+
+# Frequencies we prefer when the server supports more than one for an
+#  update type, most preferred first.
+FREQUENCY_PREFERENCE = (
+    UpdateFrequency.AUTOMATIC,
+    UpdateFrequency.DAILY,
+    UpdateFrequency.WEEKLY,
+    UpdateFrequency.MONTHLY,
+    UpdateFrequency.QUARTERLY,
+    UpdateFrequency.ANUALLY,
+)
+
+SESSION_EVENTS = ('ready', 'disconnected')
+
+# Packets the session handles itself, these are always decoded.
+SESSION_PIDS = frozenset([packet.pid for packet in (recv.Protocol, recv.Welcome, recv.Pong, recv.Error, recv.Full,
+                                                    recv.Banned, recv.Shutdown)])
+
+class SessionState(EnumHelper):
+    DISCONNECTED        = 0x00  #< Not connected to the server.
+    AUTHENTICATING      = 0x01  #< Join has been sent, waiting for Protocol and Welcome.
+    ACTIVE              = 0x02  #< Handshake done and subscriptions sent.
+    CONNECTING          = 0x03  #< Non-blocking connect in progress.
+
+class AdminSession(object):
+    """
+    A single admin connection, including the Join handshake and the update
+    subscriptions needed by the registered handlers.
+
+    Handlers are registered per packet class with on() and are called as
+    handler(session, packet). Packets are dispatched through a pid to
+    handlers table that is rebuilt whenever handlers change. Once the server
+    has sent Protocol and Welcome, the session subscribes to the update types
+    its handlers need, at the preferred frequency the server supports (see
+    frequencies and FREQUENCY_PREFERENCE). Update types that can only be
+    polled are polled once instead.
+
+    The 'ready' and 'disconnected' events can be listened to with on() as
+    well, their handlers are called as handler(session).
+    """
+    socket_class = AdminSocket
+
+    def __init__(self, host, port = None, password = '', name = 'libopenttd', version = 'libopenttd',
+                 frequencies = None):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.name = name
+        self.version = version
+        self.frequencies = dict(frequencies or {})
+        self.key = None
+
+        self.socket = None
+        self.state = SessionState.DISCONNECTED
+        self.handlers = defaultdict(list)
+        self.passive_handlers = defaultdict(list)
+        self.dispatch_table = {}
+        self.frame_handlers = {}
+        self.events = defaultdict(list)
+
+        self.protocol_version = None
+        self.supported = {}
+        self.welcome = None
+        self.error = None
+        self.subscriptions = {}
+        self.extra_update_types = set()
+        self.ping_payload = 0
+        self.barriers = {}
+        # Rcon commands sent and answered on this connection, the server
+        #  answers them in order.
+        self.rcon_sent = 0
+        self.rcon_done = 0
+
+    def __repr__(self):
+        return '<%s %s:%s (%s)>' % (self.__class__.__name__, self.host, self.port,
+                                   SessionState.get_name(self.state))
+
+    @property
+    def address(self):
+        return (self.host, self.port if self.port is not None else self.socket_class.DEFAULT_PORT)
+
+    @property
+    def connected(self):
+        return self.socket is not None and self.socket.connected
+
+    @property
+    def connecting(self):
+        return self.state == SessionState.CONNECTING
+
+    @property
+    def ready(self):
+        return self.state == SessionState.ACTIVE
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    #
+    # Handler registration
+    #
+    def on(self, key, handler = None, subscribe = True):
+        """
+        Registers handler for a packet class (or a list of them) or a session
+        event. Without a handler, returns a decorator.
+
+        With subscribe set to False the session doesn't subscribe to anything
+        for the handler, it only gets the packets that arrive anyway, such as
+        poll responses.
+        """
+        if handler is None:
+            def _inner(func):
+                self.on(key, func, subscribe)
+                return func
+            return _inner
+        if isinstance(key, six.string_types):
+            if key not in SESSION_EVENTS:
+                raise KeyError("Unknown session event '%s', expected one of: %s" % (key, ', '.join(SESSION_EVENTS)))
+            self.events[key].append(handler)
+            return handler
+        for packet in (key if isinstance(key, (list, tuple, set)) else [key]):
+            if not subscribe:
+                self.passive_handlers[packet].append(handler)
+                continue
+            self.handlers[packet].append(handler)
+            if self.ready:
+                self.subscribe_packet(packet)
+        self.build_dispatch_table()
+        return handler
+
+    def off(self, key, handler):
+        if isinstance(key, six.string_types):
+            self.events[key] = [item for item in self.events[key] if item != handler]
+            return
+        for packet in (key if isinstance(key, (list, tuple, set)) else [key]):
+            for handlers in (self.handlers, self.passive_handlers):
+                if packet in handlers:
+                    handlers[packet] = [item for item in handlers[packet] if item != handler]
+                    if not handlers[packet]:
+                        del handlers[packet]
+        self.build_dispatch_table()
+
+    def on_frames(self, key, handler):
+        """
+        Registers handler for the undecoded frames of a packet class (or a
+        list of them), called as handler(session, pid, frame) with the frame
+        as returned by PacketSocket.process_frames. Frames are only decoded
+        for packet handlers and the session itself. Like on() with subscribe
+        set to False, this doesn't subscribe to anything.
+        """
+        handlers = defaultdict(list, [(pid, list(items)) for pid, items in six.iteritems(self.frame_handlers)])
+        for packet in (key if isinstance(key, (list, tuple, set)) else [key]):
+            handlers[packet.pid].append(handler)
+        self.frame_handlers = dict([(pid, tuple(items)) for pid, items in six.iteritems(handlers)])
+        return handler
+
+    def off_frames(self, key, handler):
+        handlers = dict(self.frame_handlers)
+        for packet in (key if isinstance(key, (list, tuple, set)) else [key]):
+            items = tuple([item for item in handlers.get(packet.pid, ()) if item != handler])
+            if items:
+                handlers[packet.pid] = items
+            else:
+                handlers.pop(packet.pid, None)
+        self.frame_handlers = handlers
+
+    def build_dispatch_table(self):
+        table = defaultdict(list)
+        for handlers in (self.handlers, self.passive_handlers):
+            for packet, packet_handlers in six.iteritems(handlers):
+                table[packet.pid].extend(packet_handlers)
+        self.dispatch_table = dict([(pid, tuple(handlers)) for pid, handlers in six.iteritems(table)])
+
+    def fire(self, event):
+        for handler in list(self.events[event]):
+            handler(self)
+
+    #
+    # Connection handling
+    #
+    def create_socket(self):
+        return self.socket_class()
+
+    def connect(self):
+        """
+        Connects (blocking) to the server and sends Join, the rest of the
+        handshake happens while processing the packets the server sends back.
+        """
+        self.close()
+        self.socket = self.create_socket()
+        self.socket.connect(self.address)
+        self.start_handshake()
+        self.process_send()
+
+    def start_connect(self, address = None):
+        """
+        Starts connecting without blocking. Returns True when connected (and
+        Join queued) straight away, otherwise call finish_connect once the
+        socket is writable. address is the resolved address of the server,
+        without it a hostname is looked up first, which blocks.
+        """
+        self.close()
+        self.socket = self.create_socket()
+        self.state = SessionState.CONNECTING
+        try:
+            connected = self.socket.start_connect(address or self.address)
+        except socket.error:
+            self.close(quit = False)
+            raise
+        if connected:
+            self.start_handshake()
+        return connected
+
+    def finish_connect(self):
+        try:
+            self.socket.finish_connect()
+        except socket.error:
+            self.close(quit = False)
+            raise
+        self.start_handshake()
+        self.process_send()
+
+    def start_handshake(self):
+        self.protocol_version = None
+        self.supported = {}
+        self.welcome = None
+        self.error = None
+        self.subscriptions = {}
+        self.barriers = {}
+        self.rcon_sent = 0
+        self.rcon_done = 0
+        self.state = SessionState.AUTHENTICATING
+        self.send_packet(send.Join(password = self.password, name = self.name, version = self.version))
+
+    def close(self, quit = True):
+        if self.socket is None:
+            return
+        sock, self.socket = self.socket, None
+        if quit and sock.connected and self.state == SessionState.ACTIVE:
+            try:
+                sock.send_packet(send.Quit())
+                # A non-blocking socket gets a single try, the server may not be reading.
+                sock.process_send()
+                while not sock.nonblocking and sock.write_pending and sock.connected:
+                    sock.process_send()
+            except IOError:
+                pass
+        sock.close()
+        was_connected = self.state in (SessionState.AUTHENTICATING, SessionState.ACTIVE)
+        self.state = SessionState.DISCONNECTED
+        if was_connected:
+            self.fire('disconnected')
+
+    def send_packet(self, packet, *args, **kwargs):
+        if isinstance(packet, send.Rcon):
+            self.rcon_sent += 1
+        self.socket.send_packet(packet, *args, **kwargs)
+
+    def send_frame(self, frame):
+        if FRAME_HEADER.unpack_from(frame)[1] == send.Rcon.pid:
+            self.rcon_sent += 1
+        self.socket.send_frame(frame)
+
+    def next_ping_payload(self):
+        self.ping_payload = (self.ping_payload + 1) & 0xFFFFFFFF
+        return self.ping_payload
+
+    def barrier(self, callback):
+        """
+        Calls callback(session) once the server has handled everything sent
+        before. The server answers packets in order, so this is done by
+        sending a Ping and waiting for its Pong.
+        """
+        payload = self.next_ping_payload()
+        self.barriers[payload] = callback
+        self.send_packet(send.Ping(payload = payload))
+        return payload
+
+    #
+    # Subscriptions
+    #
+    def get_frequency(self, update_type):
+        """
+        Returns the frequency to subscribe to update_type with, based on what
+        the server supports. Returns POLL for update types that can only be
+        polled and None when the server doesn't support the update type.
+        """
+        supported = self.supported.get(update_type, 0)
+        wanted = self.frequencies.get(update_type)
+        if wanted is not None and supported & wanted == wanted:
+            return wanted
+        for frequency in FREQUENCY_PREFERENCE:
+            if supported & frequency:
+                return frequency
+        if supported & UpdateFrequency.POLL:
+            return UpdateFrequency.POLL
+        return None
+
+    def get_update_types(self):
+        update_types = set(self.extra_update_types)
+        for packet in self.handlers:
+            update_type = PACKET_UPDATE_TYPES.get(packet)
+            if update_type is not None:
+                update_types.add(update_type)
+        return update_types
+
+    def subscribe(self, update_type, frequency = None):
+        """
+        Subscribes to update_type, regardless of whether any handler needs it.
+        """
+        self.extra_update_types.add(update_type)
+        if frequency is not None:
+            self.frequencies[update_type] = frequency
+        if self.ready:
+            self.send_subscription(update_type)
+
+    def subscribe_packet(self, packet):
+        update_type = PACKET_UPDATE_TYPES.get(packet)
+        if update_type is not None and update_type not in self.subscriptions:
+            self.send_subscription(update_type)
+
+    def send_subscription(self, update_type):
+        frequency = self.get_frequency(update_type)
+        if frequency is None:
+            return
+        self.subscriptions[update_type] = frequency
+        if frequency == UpdateFrequency.POLL:
+            self.poll(update_type)
+        else:
+            self.send_packet(send.UpdateFrequency(update_type = update_type, update_freq = frequency))
+
+    def poll(self, update_type, extra = 0):
+        self.send_packet(send.Poll(poll_type = update_type, poll_extra = extra))
+
+    #
+    # Packet processing
+    #
+    def process_recv(self):
+        try:
+            read = self.socket.process_recv()
+        except socket.error:
+            read = 0
+            self.socket._connected = False
+        if not self.socket.connected:
+            # Handle whatever the server sent before closing the connection,
+            #  such as the Error telling us why.
+            self.process_packets()
+            self.close(quit = False)
+        return read
+
+    def process_send(self):
+        self.socket.process_send()
+        if not self.socket.connected:
+            self.close(quit = False)
+
+    def process_packets(self):
+        """
+        Handles the packets currently in the receive buffer, returns the
+        amount of packets handled.
+        """
+        if self.socket is None:
+            return 0
+        frames = self.socket.process_frames()
+        for pid, frame in frames:
+            for handler in self.frame_handlers.get(pid, ()):
+                handler(self, pid, frame)
+            # Only decode what somebody is going to look at.
+            if pid in self.dispatch_table or pid in SESSION_PIDS:
+                packet = self.socket.decode_frame(pid, frame)
+                if packet is not None:
+                    self.handle_packet(packet)
+            if pid == recv.RconEnd.pid:
+                self.rcon_done += 1
+            if self.socket is None:
+                break
+        return len(frames)
+
+    @property
+    def wants_write(self):
+        return self.socket is not None and self.socket.write_pending
+
+    def handle_packet(self, packet):
+        if self.state == SessionState.AUTHENTICATING:
+            self.handle_handshake(packet)
+        self.dispatch(packet)
+        if isinstance(packet, recv.Pong):
+            callback = self.barriers.pop(packet.payload, None)
+            if callback is not None:
+                callback(self)
+        if isinstance(packet, (recv.Error, recv.Full, recv.Banned, recv.Shutdown)):
+            if isinstance(packet, recv.Error):
+                self.error = packet.errorcode
+            self.close(quit = False)
+
+    def handle_handshake(self, packet):
+        if isinstance(packet, recv.Protocol):
+            self.protocol_version = packet.version
+            self.supported = dict(packet.settings or {})
+        elif isinstance(packet, recv.Welcome):
+            self.welcome = packet
+            self.state = SessionState.ACTIVE
+            for update_type in sorted(self.get_update_types()):
+                self.send_subscription(update_type)
+            self.fire('ready')
+
+    def dispatch(self, packet):
+        for handler in self.dispatch_table.get(packet.pid, ()):
+            handler(self, packet)
+
+    def run_once(self, timeout = None):
+        """
+        Waits up to timeout seconds for the socket to become readable (or
+        writable when there is data to send) and processes it.
+        """
+        if self.socket is None:
+            return 0
+        writers = [self.socket] if self.wants_write else []
+        readable, writable, _ = select.select([self.socket], writers, [], timeout)
+        if writable:
+            self.process_send()
+        if readable and self.socket is not None:
+            self.process_recv()
+        return self.process_packets()
+
+    def run(self, timeout = None):
+        """
+        Processes packets until the connection is closed.
+        """
+        while self.socket is not None:
+            self.run_once(timeout)
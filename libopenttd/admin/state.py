@@ -0,0 +1,256 @@
+import copy
+
+from collections import namedtuple, defaultdict
+
+from libopenttd.packets.enums import UpdateType, PollExtra
+from . import recv
+
+CLIENT_FIELDS = ('hostname', 'name', 'language', 'joindate', 'play_as')
+COMPANY_FIELDS = ('name', 'manager_name', 'colour', 'passworded', 'startyear', 'is_ai', 'bankrupcy_counter',
+                  'shareholder')
+COMPANY_UPDATE_FIELDS = ('name', 'manager_name', 'colour', 'passworded', 'bankrupcy_counter', 'shareholder')
+ECONOMY_FIELDS = ('money', 'current_loan', 'income', 'delivered', 'history')
+STATS_FIELDS = ('vehicles', 'stations')
+
+class Change(namedtuple('Change', 'kind table key changes')):
+    """
+    A single change to the game state. kind is one of 'added', 'updated',
+    'removed' or 'reset', table is 'clients', 'companies' or 'date', key is
+    the client or company id, and changes maps field names to (old, new)
+    tuples for the fields that actually changed.
+    """
+    __slots__ = ()
+
+class Client(object):
+    __slots__ = ('client_id',) + CLIENT_FIELDS
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        for name in CLIENT_FIELDS:
+            setattr(self, name, None)
+
+    def as_dict(self):
+        return dict([(name, getattr(self, name)) for name in self.__slots__])
+
+    def __repr__(self):
+        return '<Client %d: %s>' % (self.client_id, self.name)
+
+class Company(object):
+    __slots__ = ('company_id',) + COMPANY_FIELDS + ECONOMY_FIELDS + STATS_FIELDS
+
+    def __init__(self, company_id):
+        self.company_id = company_id
+        for name in COMPANY_FIELDS + ECONOMY_FIELDS + STATS_FIELDS:
+            setattr(self, name, None)
+
+    def as_dict(self):
+        return dict([(name, copy.deepcopy(getattr(self, name))) for name in self.__slots__])
+
+    def __repr__(self):
+        return '<Company %d: %s>' % (self.company_id, self.name)
+
+class GameState(object):
+    """
+    Local mirror of a game server's clients, companies and date, kept up to
+    date by applying admin packets as they come in.
+
+    Every packet is applied as a constant time update of the clients,
+    clients_by_company and companies tables. Listeners registered with
+    on_change are called with a Change for every change that was made.
+
+    Use attach() to feed the state from an AdminSession; it takes care of the
+    subscriptions and polls all clients and companies whenever the session
+    (re)connects.
+    """
+    def __init__(self):
+        self.clients = {}
+        self.clients_by_company = defaultdict(set)
+        self.companies = {}
+        self.date = None
+        self.listeners = []
+
+        self.appliers = {
+            recv.Date.pid:              self.apply_date,
+            recv.ClientJoin.pid:        self.apply_client_join,
+            recv.ClientInfo.pid:        self.apply_client_info,
+            recv.ClientUpdate.pid:      self.apply_client_update,
+            recv.ClientQuit.pid:        self.apply_client_quit,
+            recv.ClientError.pid:       self.apply_client_quit,
+            recv.CompanyNew.pid:        self.apply_company_new,
+            recv.CompanyInfo.pid:       self.apply_company_info,
+            recv.CompanyUpdate.pid:     self.apply_company_update,
+            recv.CompanyRemove.pid:     self.apply_company_remove,
+            recv.CompanyEconomy.pid:    self.apply_company_economy,
+            recv.CompanyStats.pid:      self.apply_company_stats,
+        }
+
+    PACKETS = (
+        recv.Date, recv.ClientJoin, recv.ClientInfo, recv.ClientUpdate, recv.ClientQuit, recv.ClientError,
+        recv.CompanyNew, recv.CompanyInfo, recv.CompanyUpdate, recv.CompanyRemove, recv.CompanyEconomy,
+        recv.CompanyStats,
+    )
+
+    POLL_ON_CONNECT = (
+        UpdateType.CLIENT_INFO,
+        UpdateType.COMPANY_INFO,
+        UpdateType.COMPANY_ECONOMY,
+        UpdateType.COMPANY_STATS,
+    )
+
+    #
+    # Listeners
+    #
+    def on_change(self, listener):
+        self.listeners.append(listener)
+        return listener
+
+    def emit(self, kind, table, key, changes):
+        if not self.listeners:
+            return
+        change = Change(kind, table, key, changes)
+        for listener in self.listeners:
+            listener(change)
+
+    #
+    # Session integration
+    #
+    def attach(self, session):
+        session.on(self.PACKETS, self.handle)
+        session.on('ready', self.handle_ready)
+        if session.ready:
+            self.handle_ready(session)
+
+    def detach(self, session):
+        session.off(self.PACKETS, self.handle)
+        session.off('ready', self.handle_ready)
+
+    def handle_ready(self, session):
+        self.reset()
+        for update_type in self.POLL_ON_CONNECT:
+            session.poll(update_type, PollExtra.ALL)
+
+    def handle(self, session, packet):
+        self.apply(packet)
+
+    def reset(self):
+        self.clients = {}
+        self.clients_by_company = defaultdict(set)
+        self.companies = {}
+        self.date = None
+        self.emit('reset', None, None, {})
+
+    #
+    # Packet application
+    #
+    def apply(self, packet):
+        applier = self.appliers.get(packet.pid)
+        if applier is None:
+            return False
+        applier(packet)
+        return True
+
+    def update_fields(self, obj, packet, names):
+        changes = {}
+        for name in names:
+            value = getattr(packet, name, None)
+            old = getattr(obj, name)
+            if value != old:
+                setattr(obj, name, value)
+                changes[name] = (old, value)
+        return changes
+
+    def apply_date(self, packet):
+        if packet.date != self.date:
+            old, self.date = self.date, packet.date
+            self.emit('updated', 'date', None, {'date': (old, packet.date)})
+
+    def get_client(self, client_id):
+        client = self.clients.get(client_id)
+        if client is None:
+            client = self.clients[client_id] = Client(client_id)
+            self.emit('added', 'clients', client_id, {})
+        return client
+
+    def move_client(self, client, old_company):
+        if old_company == client.play_as:
+            return
+        if old_company is not None:
+            members = self.clients_by_company.get(old_company)
+            if members is not None:
+                members.discard(client.client_id)
+                if not members:
+                    del self.clients_by_company[old_company]
+        if client.play_as is not None:
+            self.clients_by_company[client.play_as].add(client.client_id)
+
+    def apply_client_join(self, packet):
+        self.get_client(packet.client_id)
+
+    def apply_client_info(self, packet, names = CLIENT_FIELDS):
+        client = self.get_client(packet.client_id)
+        old_company = client.play_as
+        changes = self.update_fields(client, packet, names)
+        self.move_client(client, old_company)
+        if changes:
+            self.emit('updated', 'clients', client.client_id, changes)
+
+    def apply_client_update(self, packet):
+        self.apply_client_info(packet, ('name', 'play_as'))
+
+    def apply_client_quit(self, packet):
+        client = self.clients.pop(packet.client_id, None)
+        if client is None:
+            return
+        play_as, client.play_as = client.play_as, None
+        self.move_client(client, play_as)
+        self.emit('removed', 'clients', client.client_id, {})
+
+    def get_company(self, company_id):
+        company = self.companies.get(company_id)
+        if company is None:
+            company = self.companies[company_id] = Company(company_id)
+            self.emit('added', 'companies', company_id, {})
+        return company
+
+    def apply_company_new(self, packet):
+        self.get_company(packet.company_id)
+
+    def apply_company_fields(self, packet, names):
+        company = self.get_company(packet.company_id)
+        changes = self.update_fields(company, packet, names)
+        if changes:
+            self.emit('updated', 'companies', company.company_id, changes)
+
+    def apply_company_info(self, packet):
+        self.apply_company_fields(packet, COMPANY_FIELDS)
+
+    def apply_company_update(self, packet):
+        self.apply_company_fields(packet, COMPANY_UPDATE_FIELDS)
+
+    def apply_company_economy(self, packet):
+        self.apply_company_fields(packet, ECONOMY_FIELDS)
+
+    def apply_company_stats(self, packet):
+        self.apply_company_fields(packet, STATS_FIELDS)
+
+    def apply_company_remove(self, packet):
+        company = self.companies.pop(packet.company_id, None)
+        if company is None:
+            return
+        self.emit('removed', 'companies', company.company_id, {'reason': (None, packet.reason)})
+
+    #
+    # Queries
+    #
+    def get_company_clients(self, company_id):
+        return [self.clients[client_id] for client_id in self.clients_by_company.get(company_id, ())]
+
+    def snapshot(self):
+        """
+        Returns a copy of the current state as plain dictionaries.
+        """
+        return {
+            'date':         self.date,
+            'clients':      dict([(key, client.as_dict()) for key, client in self.clients.items()]),
+            'companies':    dict([(key, company.as_dict()) for key, company in self.companies.items()]),
+        }
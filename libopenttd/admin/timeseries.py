@@ -0,0 +1,265 @@
+from array import array
+from bisect import bisect_left
+
+from libopenttd.packets.fields import datetime_to_gamedate
+from libopenttd.utils import six
+from . import recv
+
+VEHICLE_TYPES = ('train', 'lorry', 'bus', 'plane', 'ship')
+
+def _money_typecode():
+    # Money is a signed 64 bit integer. Python 2 arrays have no 'q', but 'l'
+    #  is 64 bit on LP64 platforms; fall back to a double elsewhere.
+    for typecode in ('q', 'l'):
+        try:
+            if array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+    return 'd'
+
+MONEY_TYPECODE = _money_typecode()
+
+# Metrics kept per kind of series, with the array typecode they are stored in.
+SERIES_METRICS = {
+    'economy': (
+        ('money',               MONEY_TYPECODE),
+        ('current_loan',        MONEY_TYPECODE),
+        ('income',              MONEY_TYPECODE),
+        ('delivered',           'I'),
+        ('value',               MONEY_TYPECODE),
+        ('performance',         'H'),
+        ('quarter_delivered',   'I'),
+    ),
+    'stats': tuple([('vehicles_%s' % name, 'H') for name in VEHICLE_TYPES] +
+                   [('stations_%s' % name, 'H') for name in VEHICLE_TYPES]),
+}
+
+def _economy_row(packet):
+    history = packet.history[0] if packet.history else {}
+    return (packet.money, packet.current_loan, packet.income, packet.delivered,
+            history.get('value', 0), history.get('performance', 0), history.get('delivered', 0))
+
+def _stats_row(packet):
+    vehicles = packet.vehicles or {}
+    stations = packet.stations or {}
+    return tuple([vehicles.get(name, 0) for name in VEHICLE_TYPES] +
+                 [stations.get(name, 0) for name in VEHICLE_TYPES])
+
+class RingBuffer(object):
+    """
+    Fixed capacity array that overwrites its oldest value once full.
+    """
+    __slots__ = ('values', 'capacity', 'start', 'count')
+
+    def __init__(self, typecode, capacity):
+        self.values = array(typecode, [0]) * capacity
+        self.capacity = capacity
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, value):
+        if self.count < self.capacity:
+            self.values[(self.start + self.count) % self.capacity] = value
+            self.count += 1
+        else:
+            self.values[self.start] = value
+            self.start = (self.start + 1) % self.capacity
+
+    def clear(self):
+        self.start = 0
+        self.count = 0
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return self.values[(self.start + index) % self.capacity]
+
+    def __setitem__(self, index, value):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        self.values[(self.start + index) % self.capacity] = value
+
+    def to_list(self):
+        end = self.start + self.count
+        if end <= self.capacity:
+            return self.values[self.start:end].tolist()
+        return self.values[self.start:].tolist() + self.values[:end - self.capacity].tolist()
+
+class Series(object):
+    """
+    Samples of one kind ('economy' or 'stats') for one company, one ring
+    buffer per metric plus one with the game date of every sample.
+    """
+    def __init__(self, kind, capacity):
+        self.kind = kind
+        self.metrics = SERIES_METRICS[kind]
+        self.dates = RingBuffer('i', capacity)
+        self.columns = dict([(name, RingBuffer(typecode, capacity)) for name, typecode in self.metrics])
+
+    def __len__(self):
+        return len(self.dates)
+
+    def clear(self):
+        self.dates.clear()
+        for column in self.columns.values():
+            column.clear()
+
+    def add(self, date, row):
+        if len(self.dates) and self.dates[-1] > date:
+            # The server started a new game or loaded a save, the old samples
+            #  belong to another timeline.
+            self.clear()
+        if len(self.dates) and self.dates[-1] == date:
+            # A second sample on the same day replaces the first.
+            for (name, _), value in zip(self.metrics, row):
+                self.columns[name][-1] = value
+            return
+        self.dates.append(date)
+        for (name, _), value in zip(self.metrics, row):
+            self.columns[name].append(value)
+
+    def query(self, metrics = None, start = None, end = None, bucket = None, how = 'last'):
+        dates = self.dates.to_list()
+        low = bisect_left(dates, start) if start is not None else 0
+        high = bisect_left(dates, end) if end is not None else len(dates)
+        names = metrics or [name for name, _ in self.metrics]
+        result = {'date': dates[low:high]}
+        for name in names:
+            result[name] = self.columns[name].to_list()[low:high]
+        if bucket:
+            result = downsample(result, names, bucket, how)
+        return result
+
+def _mean(values):
+    return float(sum(values)) / len(values)
+
+AGGREGATES = {
+    'last':     lambda values: values[-1],
+    'first':    lambda values: values[0],
+    'mean':     _mean,
+    'min':      min,
+    'max':      max,
+}
+
+def downsample(columns, names, bucket, how = 'last'):
+    """
+    Reduces columns to one value per bucket days, aggregated with how. The
+    date of every bucket is the first day of that bucket.
+    """
+    aggregate = AGGREGATES[how]
+    groups = []
+    for index, date in enumerate(columns['date']):
+        start = date - date % bucket
+        if not groups or groups[-1][0] != start:
+            groups.append((start, []))
+        groups[-1][1].append(index)
+    result = {'date': [start for start, _ in groups]}
+    for name in names:
+        values = columns[name]
+        result[name] = [aggregate([values[index] for index in indices]) for _, indices in groups]
+    return result
+
+class TimeSeriesStore(object):
+    """
+    Fixed memory store of CompanyEconomy and CompanyStats samples, keyed by
+    (server, company_id).
+
+    Samples are timestamped with the game date (days since year 0, as sent
+    in DateField) the server last reported with a Date packet; convert with
+    libopenttd.packets.fields.gamedate_to_datetime where needed. Samples
+    received before the first Date of a server are dropped, and a series
+    starts over when the date goes backwards (a new game or a loaded save).
+    Every series holds at most capacity samples, older ones are overwritten.
+    """
+    CAPACITY = 1024
+
+    def __init__(self, capacity = None):
+        self.capacity = capacity or self.CAPACITY
+        self.series = {}
+        self.dates = {}
+
+    def __len__(self):
+        return len(self.series)
+
+    def get_series(self, server, company_id, kind):
+        key = (server, company_id, kind)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = Series(kind, self.capacity)
+        return series
+
+    def set_date(self, server, date):
+        if not isinstance(date, six.integer_types):
+            date = datetime_to_gamedate(date)
+        self.dates[server] = date
+
+    def add_economy(self, server, packet, date = None):
+        date = date if date is not None else self.dates.get(server)
+        if date is None:
+            return
+        self.get_series(server, packet.company_id, 'economy').add(date, _economy_row(packet))
+
+    def add_stats(self, server, packet, date = None):
+        date = date if date is not None else self.dates.get(server)
+        if date is None:
+            return
+        self.get_series(server, packet.company_id, 'stats').add(date, _stats_row(packet))
+
+    def remove_server(self, server):
+        for key in [key for key in self.series if key[0] == server]:
+            del self.series[key]
+        self.dates.pop(server, None)
+
+    def query(self, server, company_id, kind = 'economy', metrics = None, start = None, end = None,
+              bucket = None, how = 'last'):
+        """
+        Returns a dictionary with a 'date' list and a list per metric, for
+        the samples from start (inclusive) to end (exclusive). With bucket,
+        samples are downsampled to one per bucket days using how, which is
+        one of 'last', 'first', 'mean', 'min' and 'max'.
+        """
+        if start is not None and not isinstance(start, six.integer_types):
+            start = datetime_to_gamedate(start)
+        if end is not None and not isinstance(end, six.integer_types):
+            end = datetime_to_gamedate(end)
+        series = self.series.get((server, company_id, kind))
+        if series is None:
+            names = metrics or [name for name, _ in SERIES_METRICS[kind]]
+            return dict([('date', [])] + [(name, []) for name in names])
+        return series.query(metrics, start, end, bucket, how)
+
+    #
+    # Session integration
+    #
+    def attach(self, session):
+        """
+        Records the samples received by an AdminSession, or every session of
+        an AdminPool, under the session key (or address without one).
+        """
+        session.on(recv.Date, self.handle_date)
+        session.on([recv.CompanyEconomy, recv.CompanyStats], self.handle_sample)
+
+    def detach(self, session):
+        session.off(recv.Date, self.handle_date)
+        session.off([recv.CompanyEconomy, recv.CompanyStats], self.handle_sample)
+
+    @classmethod
+    def get_server(cls, session):
+        return session.key if session.key is not None else '%s:%s' % session.address
+
+    def handle_date(self, session, packet):
+        self.set_date(self.get_server(session), packet.date)
+
+    def handle_sample(self, session, packet):
+        if isinstance(packet, recv.CompanyEconomy):
+            self.add_economy(self.get_server(session), packet)
+        else:
+            self.add_stats(self.get_server(session), packet)
@@ -0,0 +1,5 @@
+from .base import CaptureRecord
+from .exceptions import InvalidCaptureFile
+from .writer import CaptureWriter
+from .index import CaptureIndex
+from .reader import CaptureReader, MappedCaptureReader, Replayer, replay
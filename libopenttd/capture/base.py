@@ -0,0 +1,130 @@
+#
+# Capture files are append-only recordings of framed OpenTTD packets.
+#
+# Layout (all values little-endian):
+#
+#   file header     magic "LOTTDCAP", UInt16 format version, UInt16 flags
+#   block *         block header followed by `size` bytes of records
+#
+#   block header    magic "BLCK", UInt32 size, UInt32 record count,
+#                   double first and last record timestamp (monotonic),
+#                   double wall clock and monotonic clock at block start
+#   record          double timestamp (monotonic), UInt8 direction,
+#                   UInt8 protocol, UInt8 peer host length, UInt16 peer port,
+#                   peer host, framed packet (its own UInt16 length first)
+#
+# Blocks are only written once they are complete, so the first/last
+# timestamps in their headers allow readers to skip whole blocks when looking
+# for a time range. Each block carries its own clock anchor, so recordings
+# appended to by different processes can still be converted to wall clock
+# time.
+#
+from collections import namedtuple
+from struct import Struct
+
+from .exceptions import InvalidCaptureFile
+
+CAPTURE_MAGIC           = b'LOTTDCAP'
+CAPTURE_VERSION         = 1
+BLOCK_MAGIC             = b'BLCK'
+
+FILE_HEADER             = Struct('<8sHH')
+BLOCK_HEADER            = Struct('<4sIIdddd')
+RECORD_HEADER           = Struct('<dBBBH')
+FRAME_LENGTH            = Struct('<H')
+
+FRAME_HEADER_SIZE       = 3 ###< UInt16 length + UInt8 packet id
+
+class CaptureRecord(namedtuple('CaptureRecord', 'timestamp walltime direction protocol peer frame')):
+    __slots__ = ()
+
+    @property
+    def pid(self):
+        return bytearray(self.frame[2:3])[0]
+
+    @property
+    def payload(self):
+        return self.frame[FRAME_HEADER_SIZE:]
+
+class BlockHeader(namedtuple('BlockHeader', 'offset size count first last anchor_wall anchor_mono')):
+    __slots__ = ()
+
+    @property
+    def data_offset(self):
+        return self.offset + BLOCK_HEADER.size
+
+    @property
+    def end_offset(self):
+        return self.data_offset + self.size
+
+    def to_walltime(self, timestamp):
+        return self.anchor_wall + (timestamp - self.anchor_mono)
+
+    def from_walltime(self, walltime):
+        return self.anchor_mono + (walltime - self.anchor_wall)
+
+def pack_peer(peer):
+    if not peer:
+        return b'', 0
+    host = peer[0]
+    if not isinstance(host, bytes):
+        host = host.encode('ascii')
+    return host, peer[1]
+
+def unpack_peer(host, port):
+    if not host:
+        return None
+    if not isinstance(host, str):
+        host = host.decode('ascii')
+    return (host, port)
+
+def read_file_header(fileobj):
+    data = fileobj.read(FILE_HEADER.size)
+    if len(data) != FILE_HEADER.size:
+        raise InvalidCaptureFile("File is too short to be a capture file")
+    magic, version, _ = FILE_HEADER.unpack(data)
+    if magic != CAPTURE_MAGIC:
+        raise InvalidCaptureFile("File is not a capture file")
+    if version != CAPTURE_VERSION:
+        raise InvalidCaptureFile("Unsupported capture file version %d" % version)
+    return version
+
+def read_block_header(fileobj, offset):
+    """
+    Reads the block header at offset, returns None when there is no complete
+    block at that position.
+    """
+    fileobj.seek(offset)
+    data = fileobj.read(BLOCK_HEADER.size)
+    if len(data) != BLOCK_HEADER.size:
+        return None
+    magic, size, count, first, last, anchor_wall, anchor_mono = BLOCK_HEADER.unpack(data)
+    if magic != BLOCK_MAGIC:
+        raise InvalidCaptureFile("Invalid block header at offset %d" % offset)
+    return BlockHeader(offset, size, count, first, last, anchor_wall, anchor_mono)
+
+def iter_block_headers(fileobj, file_size, offset = FILE_HEADER.size):
+    while offset < file_size:
+        header = read_block_header(fileobj, offset)
+        if header is None or header.end_offset > file_size:
+            # Incomplete trailing block, most likely from an interrupted writer.
+            return
+        yield header
+        offset = header.end_offset
+
+def iter_block_records(block, data, index = 0):
+    """
+    Yields (timestamp, direction, protocol, host, port, frame_start, frame_end)
+    for every record in a block, with offsets relative to data.
+    """
+    end = index + block.size
+    while index < end:
+        timestamp, direction, protocol, host_length, port = RECORD_HEADER.unpack_from(data, index)
+        index += RECORD_HEADER.size
+        host = data[index:index + host_length]
+        index += host_length
+        frame_length = FRAME_LENGTH.unpack_from(data, index)[0]
+        if frame_length < FRAME_HEADER_SIZE or index + frame_length > end:
+            raise InvalidCaptureFile("Invalid frame length %d in block at offset %d" % (frame_length, block.offset))
+        yield (timestamp, direction, protocol, host, port, index, index + frame_length)
+        index += frame_length
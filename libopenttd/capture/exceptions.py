@@ -0,0 +1,2 @@
+class InvalidCaptureFile(Exception):
+    pass
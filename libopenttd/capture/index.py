@@ -0,0 +1,293 @@
+#
+# Sidecar index for capture files.
+#
+# The index holds one entry per record, stored column-wise in arrays, plus
+# per-pid and per-peer posting lists of record numbers. It is written next to
+# the capture file (<capture>.idx) and remembers how much of the capture it
+# covers, so that it can be brought up to date by only indexing the blocks
+# that were appended since.
+#
+# Layout (all values little-endian, arrays in native byte order):
+#
+#   header          magic "LOTTDIDX", UInt16 version, UInt16 offset item size,
+#                   UInt64 covered capture size, UInt32 record count,
+#                   UInt8 sorted flag
+#   peers           UInt32 count, (UInt8 host length, host, UInt16 port) *
+#   columns         offset, length, walltime, pid, protocol, direction, peer
+#   pid postings    UInt32 count, (UInt8 protocol, UInt8 direction, UInt8 pid,
+#                   UInt32 length, record numbers) *
+#   peer postings   UInt32 count, (UInt32 peer, UInt32 length, record numbers) *
+#
+import io
+import os
+
+from array import array
+from bisect import bisect_left
+from heapq import merge
+from struct import Struct
+
+from .base import FILE_HEADER, read_file_header, iter_block_headers, iter_block_records, \
+    unpack_peer, pack_peer
+from .exceptions import InvalidCaptureFile
+from libopenttd.utils import six
+
+INDEX_MAGIC             = b'LOTTDIDX'
+INDEX_VERSION           = 1
+
+INDEX_HEADER            = Struct('<8sHHQIB')
+COUNT                   = Struct('<I')
+PEER_ENTRY              = Struct('<B')
+PEER_PORT               = Struct('<H')
+PID_POSTING             = Struct('<BBBI')
+PEER_POSTING            = Struct('<II')
+
+COLUMNS = (
+    ('offsets',     'L'),
+    ('lengths',     'H'),
+    ('walltimes',   'd'),
+    ('pids',        'B'),
+    ('protocols',   'B'),
+    ('directions',  'B'),
+    ('peers',       'I'),
+)
+
+def _read_array(fileobj, typecode, count):
+    values = array(typecode)
+    if count:
+        data = fileobj.read(values.itemsize * count)
+        if len(data) != values.itemsize * count:
+            raise InvalidCaptureFile("Index file is truncated")
+        values.fromstring(data) if six.PY2 else values.frombytes(data)
+    return values
+
+def _write_array(fileobj, values):
+    fileobj.write(values.tostring() if six.PY2 else values.tobytes())
+
+class CaptureIndex(object):
+    """
+    Index by pid, peer and time over the records of a capture file.
+
+    Record numbers are positions in the index columns; offsets[n] and
+    lengths[n] locate the frame of record n inside the capture file.
+    """
+    def __init__(self):
+        for name, typecode in COLUMNS:
+            setattr(self, name, array(typecode))
+        self.peer_table = []
+        self.peer_ids = {}
+        self.pid_postings = {}
+        self.peer_postings = {}
+        self.covered = FILE_HEADER.size
+        self.sorted = True
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @classmethod
+    def index_path(cls, path):
+        return '%s.idx' % path
+
+    @classmethod
+    def for_capture(cls, path, data = None, save = True):
+        """
+        Loads the sidecar index of the capture file at path, (re)building or
+        updating it when it is missing or out of date.
+        """
+        index_path = cls.index_path(path)
+        index = None
+        if os.path.exists(index_path):
+            try:
+                index = cls.load(index_path)
+            except InvalidCaptureFile:
+                index = None
+        if index is None:
+            index = cls()
+        size = os.path.getsize(path)
+        if index.covered > size:
+            index = cls()
+        if index.covered < size:
+            if data is None:
+                with io.open(path, 'rb') as fileobj:
+                    read_file_header(fileobj)
+                    index.update(fileobj, size)
+            else:
+                index.update(data, size)
+            if save:
+                index.save(index_path)
+        return index
+
+    def get_peer_id(self, peer):
+        peer_id = self.peer_ids.get(peer)
+        if peer_id is None:
+            peer_id = self.peer_ids[peer] = len(self.peer_table)
+            self.peer_table.append(peer)
+        return peer_id
+
+    def add(self, offset, length, walltime, pid, protocol, direction, peer):
+        number = len(self.offsets)
+        if self.sorted and number and walltime < self.walltimes[-1]:
+            self.sorted = False
+        peer_id = self.get_peer_id(peer)
+        self.offsets.append(offset)
+        self.lengths.append(length)
+        self.walltimes.append(walltime)
+        self.pids.append(pid)
+        self.protocols.append(protocol)
+        self.directions.append(direction)
+        self.peers.append(peer_id)
+        key = (protocol, direction, pid)
+        postings = self.pid_postings.get(key)
+        if postings is None:
+            postings = self.pid_postings[key] = array('I')
+        postings.append(number)
+        postings = self.peer_postings.get(peer_id)
+        if postings is None:
+            postings = self.peer_postings[peer_id] = array('I')
+        postings.append(number)
+
+    def update(self, data, size):
+        """
+        Indexes the blocks that were appended since the index was last
+        updated. data is either a capture file object or its mmap.
+        """
+        for block in iter_block_headers(data, size, self.covered):
+            data.seek(block.data_offset)
+            chunk = data.read(block.size)
+            for timestamp, direction, protocol, host, port, start, end in iter_block_records(block, chunk):
+                self.add(block.data_offset + start, end - start, block.to_walltime(timestamp),
+                         bytearray(chunk[start + 2:start + 3])[0], protocol, direction, unpack_peer(host, port))
+            self.covered = block.end_offset
+
+    def time_range(self, start = None, end = None):
+        """
+        Returns the (first, last + 1) record numbers that may fall within the
+        given wall clock range.
+        """
+        if not self.sorted:
+            return 0, len(self)
+        low = bisect_left(self.walltimes, start) if start is not None else 0
+        high = bisect_left(self.walltimes, end) if end is not None else len(self)
+        return low, high
+
+    def query(self, pids = None, peer = None, start = None, end = None, protocol = None, direction = None):
+        """
+        Yields the record numbers matching all given filters, in file order.
+
+        pids is a list of packet ids or packet classes, peer a (host, port)
+        tuple and start and end are wall clock timestamps. Only the posting
+        lists and columns needed for the filters are consulted.
+        """
+        low, high = self.time_range(start, end)
+        peer_id = None
+        if peer is not None:
+            peer_id = self.peer_ids.get(peer)
+            if peer_id is None:
+                return
+
+        if pids is not None:
+            lists = []
+            for key, postings in six.iteritems(self.pid_postings):
+                if not self._match_pid(key, pids, protocol, direction):
+                    continue
+                lists.append(self._slice(postings, low, high))
+            candidates = merge(*lists)
+        elif peer_id is not None:
+            candidates = self._slice(self.peer_postings.get(peer_id, ()), low, high)
+        else:
+            candidates = six.moves.range(low, high)
+
+        check_time = not self.sorted and (start is not None or end is not None)
+        for number in candidates:
+            if peer_id is not None and self.peers[number] != peer_id:
+                continue
+            if pids is None:
+                if protocol is not None and self.protocols[number] != protocol:
+                    continue
+                if direction is not None and self.directions[number] != direction:
+                    continue
+            if check_time:
+                walltime = self.walltimes[number]
+                if (start is not None and walltime < start) or (end is not None and walltime >= end):
+                    continue
+            yield number
+
+    @classmethod
+    def _match_pid(cls, key, pids, protocol, direction):
+        key_protocol, key_direction, key_pid = key
+        if protocol is not None and key_protocol != protocol:
+            return False
+        if direction is not None and key_direction != direction:
+            return False
+        for pid in pids:
+            if isinstance(pid, six.integer_types):
+                if pid == key_pid:
+                    return True
+                continue
+            opts = pid._meta
+            if pid.pid != key_pid or opts.protocol != key_protocol:
+                continue
+            if opts.direction & key_direction:
+                return True
+        return False
+
+    @classmethod
+    def _slice(cls, postings, low, high):
+        return postings[bisect_left(postings, low):bisect_left(postings, high)]
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with io.open(path, 'rb') as fileobj:
+            data = fileobj.read(INDEX_HEADER.size)
+            if len(data) != INDEX_HEADER.size:
+                raise InvalidCaptureFile("Index file is truncated")
+            magic, version, itemsize, covered, count, is_sorted = INDEX_HEADER.unpack(data)
+            if magic != INDEX_MAGIC or version != INDEX_VERSION or itemsize != index.offsets.itemsize:
+                raise InvalidCaptureFile("Index file is not compatible")
+            index.covered = covered
+            index.sorted = bool(is_sorted)
+
+            for _ in six.moves.range(COUNT.unpack(fileobj.read(COUNT.size))[0]):
+                length = PEER_ENTRY.unpack(fileobj.read(PEER_ENTRY.size))[0]
+                host = fileobj.read(length)
+                port = PEER_PORT.unpack(fileobj.read(PEER_PORT.size))[0]
+                index.get_peer_id(unpack_peer(host, port))
+
+            for name, typecode in COLUMNS:
+                setattr(index, name, _read_array(fileobj, typecode, count))
+
+            for _ in six.moves.range(COUNT.unpack(fileobj.read(COUNT.size))[0]):
+                protocol, direction, pid, length = PID_POSTING.unpack(fileobj.read(PID_POSTING.size))
+                index.pid_postings[(protocol, direction, pid)] = _read_array(fileobj, 'I', length)
+
+            for _ in six.moves.range(COUNT.unpack(fileobj.read(COUNT.size))[0]):
+                peer_id, length = PEER_POSTING.unpack(fileobj.read(PEER_POSTING.size))
+                index.peer_postings[peer_id] = _read_array(fileobj, 'I', length)
+        return index
+
+    def save(self, path):
+        # Write to a temporary file first, so readers never see a partial index.
+        tmp_path = '%s.tmp' % path
+        with io.open(tmp_path, 'wb') as fileobj:
+            fileobj.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, self.offsets.itemsize,
+                                            self.covered, len(self), int(self.sorted)))
+            fileobj.write(COUNT.pack(len(self.peer_table)))
+            for peer in self.peer_table:
+                host, port = pack_peer(peer)
+                fileobj.write(PEER_ENTRY.pack(len(host)))
+                fileobj.write(host)
+                fileobj.write(PEER_PORT.pack(port))
+
+            for name, _ in COLUMNS:
+                _write_array(fileobj, getattr(self, name))
+
+            fileobj.write(COUNT.pack(len(self.pid_postings)))
+            for (protocol, direction, pid), postings in sorted(six.iteritems(self.pid_postings)):
+                fileobj.write(PID_POSTING.pack(protocol, direction, pid, len(postings)))
+                _write_array(fileobj, postings)
+
+            fileobj.write(COUNT.pack(len(self.peer_postings)))
+            for peer_id, postings in sorted(six.iteritems(self.peer_postings)):
+                fileobj.write(PEER_POSTING.pack(peer_id, len(postings)))
+                _write_array(fileobj, postings)
+        os.rename(tmp_path, path)
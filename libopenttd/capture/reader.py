@@ -0,0 +1,194 @@
+import io
+import mmap
+import os
+import time
+
+from .base import CaptureRecord, FRAME_HEADER_SIZE, read_file_header, iter_block_headers, iter_block_records, \
+    unpack_peer
+from .index import CaptureIndex
+from libopenttd.packets.base import ProtocolInformation
+from libopenttd.packets.packetsocket import OpenTTDPacket, decode_packet
+from libopenttd.packets.registry import registry
+from libopenttd.utils import six
+from libopenttd.utils.clock import monotonic
+
+class CaptureReader(object):
+    """
+    Sequential reader for capture files written by CaptureWriter.
+
+    start and end are wall clock timestamps (as returned by time.time()),
+    blocks that fall completely outside of the requested range are skipped
+    without being read.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fileobj = io.open(path, 'rb')
+        read_file_header(self.fileobj)
+
+    def blocks(self, start = None, end = None):
+        self.fileobj.seek(0, os.SEEK_END)
+        size = self.fileobj.tell()
+        for block in list(iter_block_headers(self.fileobj, size)):
+            if start is not None and block.to_walltime(block.last) < start:
+                continue
+            if end is not None and block.to_walltime(block.first) >= end:
+                continue
+            yield block
+
+    def records(self, start = None, end = None):
+        for block in self.blocks(start, end):
+            self.fileobj.seek(block.data_offset)
+            data = self.fileobj.read(block.size)
+            for timestamp, direction, protocol, host, port, frame_start, frame_end in iter_block_records(block, data):
+                walltime = block.to_walltime(timestamp)
+                if start is not None and walltime < start:
+                    continue
+                if end is not None and walltime >= end:
+                    continue
+                yield CaptureRecord(timestamp, walltime, direction, protocol, unpack_peer(host, port),
+                                    data[frame_start:frame_end])
+
+    def __iter__(self):
+        return self.records()
+
+    def close(self):
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+class Replayer(object):
+    """
+    Feeds the records of a capture back through the packet decoding path.
+
+    With speed set to None frames are decoded as fast as possible, otherwise
+    the original timing between records is reproduced, sped up by the given
+    factor. Iterating a Replayer yields (record, packet) tuples, where packet
+    is None for frames that could not be decoded.
+    """
+    def __init__(self, records, speed = None, version = 0):
+        self.records = records
+        self.speed = speed
+        self.version = version
+        self.registries = {}
+        self.extra_info = {}
+
+    def get_registry(self, protocol, direction):
+        key = (protocol, direction)
+        packet_registry = self.registries.get(key)
+        if packet_registry is None:
+            packet_registry = self.registries[key] = registry.get_packets_dict(protocol, direction)
+        return packet_registry
+
+    def get_extra(self, record):
+        key = (record.protocol, record.direction, record.peer)
+        extra = self.extra_info.get(key)
+        if extra is None:
+            extra = self.extra_info[key] = ProtocolInformation(self.version)
+        return extra
+
+    def decode(self, record):
+        frame = record.frame
+        info = OpenTTDPacket.manager.from_data(bytes(frame[:FRAME_HEADER_SIZE]))
+        return decode_packet(self.get_registry(record.protocol, record.direction), info.packet_id,
+                             bytes(frame[FRAME_HEADER_SIZE:info.length]), self.get_extra(record))
+
+    def __iter__(self):
+        first = started = None
+        for record in self.records:
+            if self.speed:
+                if first is None:
+                    first, started = record.timestamp, monotonic()
+                delay = (record.timestamp - first) / self.speed - (monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            yield record, self.decode(record)
+
+def replay(path, speed = None, start = None, end = None, version = 0):
+    with CaptureReader(path) as reader:
+        for item in Replayer(reader.records(start, end), speed, version):
+            yield item
+
+class MappedCaptureReader(object):
+    """
+    Random access reader for large capture files.
+
+    The capture is memory-mapped and queried through its sidecar index
+    (see CaptureIndex), so only the pages holding matching frames are ever
+    touched. Frames are returned as zero-copy views into the mapping, and
+    packets are decoded directly from the mapping as well. The index only
+    keeps wall clock times, so the timestamp of returned records is None.
+    """
+    def __init__(self, path, save_index = True, version = 0):
+        self.path = path
+        self.save_index = save_index
+        self.replayer = Replayer((), version = version)
+        self._open()
+
+    def _open(self):
+        path = self.path
+        self.fileobj = io.open(path, 'rb')
+        read_file_header(self.fileobj)
+        self.mmap = mmap.mmap(self.fileobj.fileno(), 0, access = mmap.ACCESS_READ)
+        if six.PY2:
+            self._view = lambda start, end: buffer(self.mmap, start, end - start) # pylint: disable=E0602
+        else:
+            view = memoryview(self.mmap)
+            self._view = lambda start, end: view[start:end]
+        self.index = CaptureIndex.for_capture(path, self.mmap, self.save_index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def refresh(self):
+        """
+        Picks up records that were appended to the capture since it was opened.
+        """
+        self.close()
+        self._open()
+
+    def get_record(self, number):
+        index = self.index
+        offset = index.offsets[number]
+        return CaptureRecord(None, index.walltimes[number], index.directions[number], index.protocols[number],
+                             index.peer_table[index.peers[number]],
+                             self._view(offset, offset + index.lengths[number]))
+
+    def get_packet(self, number):
+        index = self.index
+        record = self.get_record(number)
+        replayer = self.replayer
+        # Decode a copy of just the payload: a short frame must not run into the next record, and the
+        #  string fields need a real string (py2 buffers have no find).
+        offset = index.offsets[number]
+        return decode_packet(replayer.get_registry(record.protocol, record.direction), index.pids[number],
+                             self.mmap[offset + FRAME_HEADER_SIZE:offset + index.lengths[number]],
+                             replayer.get_extra(record))
+
+    def records(self, pids = None, peer = None, start = None, end = None, protocol = None, direction = None):
+        for number in self.index.query(pids, peer, start, end, protocol, direction):
+            yield self.get_record(number)
+
+    def packets(self, pids = None, peer = None, start = None, end = None, protocol = None, direction = None):
+        """
+        Yields (record, packet) for all records matching the given filters,
+        see CaptureIndex.query for their meaning.
+        """
+        for number in self.index.query(pids, peer, start, end, protocol, direction):
+            yield self.get_record(number), self.get_packet(number)
+
+    def __iter__(self):
+        return self.records()
+
+    def close(self):
+        self.mmap.close()
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
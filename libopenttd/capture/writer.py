@@ -0,0 +1,110 @@
+import io
+import os
+import time
+
+from threading import Lock
+
+from .base import CAPTURE_MAGIC, CAPTURE_VERSION, BLOCK_MAGIC, FILE_HEADER, BLOCK_HEADER, RECORD_HEADER, \
+    FRAME_HEADER_SIZE, read_file_header, iter_block_headers, pack_peer
+from libopenttd.utils.clock import monotonic
+
+class CaptureWriter(object):
+    """
+    Appends framed packets to a capture file.
+
+    Records are collected in an in-memory block, which is written out as a
+    whole once it holds BLOCK_SIZE bytes or BLOCK_RECORDS records, or when
+    flush or close is called. A CaptureWriter can be set as the capture
+    attribute of a PacketSocket or PacketUDPSocket to record its traffic.
+    """
+    BLOCK_SIZE      = 64 * 1024
+    BLOCK_RECORDS   = 4096
+
+    def __init__(self, path, block_size = None, block_records = None):
+        self.path = path
+        self.block_size = block_size or self.BLOCK_SIZE
+        self.block_records = block_records or self.BLOCK_RECORDS
+        self.lock = Lock()
+        self.fileobj = self._open(path)
+        self._reset_block()
+
+    def _open(self, path):
+        fileobj = io.open(path, 'a+b')
+        fileobj.seek(0, os.SEEK_END)
+        size = fileobj.tell()
+        if size == 0:
+            fileobj.write(FILE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, 0))
+            fileobj.flush()
+            return fileobj
+        fileobj.seek(0)
+        read_file_header(fileobj)
+        end = FILE_HEADER.size
+        for block in iter_block_headers(fileobj, size):
+            end = block.end_offset
+        if end != size:
+            # Drop the incomplete block an interrupted writer left behind,
+            #  otherwise everything we append would be unreadable.
+            fileobj.truncate(end)
+        fileobj.seek(0, os.SEEK_END)
+        return fileobj
+
+    def _reset_block(self):
+        self.block = bytearray()
+        self.block_count = 0
+        self.block_first = 0.0
+        self.block_last = 0.0
+        self.anchor_wall = time.time()
+        self.anchor_mono = monotonic()
+
+    @property
+    def closed(self):
+        return self.fileobj is None
+
+    def record(self, direction, protocol, peer, frame, timestamp = None):
+        if len(frame) < FRAME_HEADER_SIZE:
+            return
+        if timestamp is None:
+            timestamp = monotonic()
+        host, port = pack_peer(peer)
+        with self.lock:
+            if self.fileobj is None:
+                return
+            if not self.block_count:
+                self.block_first = timestamp
+            self.block_last = timestamp
+            self.block.extend(RECORD_HEADER.pack(timestamp, direction, protocol, len(host), port))
+            self.block.extend(host)
+            self.block.extend(frame)
+            self.block_count += 1
+            if len(self.block) >= self.block_size or self.block_count >= self.block_records:
+                self._write_block()
+
+    def _write_block(self):
+        if not self.block_count:
+            return
+        self.fileobj.write(BLOCK_HEADER.pack(BLOCK_MAGIC, len(self.block), self.block_count,
+                                             self.block_first, self.block_last,
+                                             self.anchor_wall, self.anchor_mono))
+        self.fileobj.write(self.block)
+        self._reset_block()
+
+    def flush(self):
+        with self.lock:
+            if self.fileobj is None:
+                return
+            self._write_block()
+            self.fileobj.flush()
+
+    def close(self):
+        with self.lock:
+            if self.fileobj is None:
+                return
+            self._write_block()
+            self.fileobj.close()
+            self.fileobj = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
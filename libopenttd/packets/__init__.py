@@ -9,6 +9,7 @@ from .fields import Field, StringField, StructField, CharField, BooleanField, UB
 from .packet import Packet
 from .registry import registry
 from .packetsocket import PacketSocket, PacketUDPSocket
+from .hooks import hooks
 
 import constants
 import enums
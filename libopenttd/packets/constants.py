@@ -36,3 +36,4 @@ NETWORK_GAMESCRIPT_JSON_LENGTH  = SEND_MTU - 3 ###< The maximum length of a game
 NETWORK_CHAT_LENGTH             =  900  ###< The maximum length of a chat message, in bytes including '\0'
 
 NETWORK_GRF_NAME_LENGTH         =   80  ###< Maximum length of the name of a GRF
+NETWORK_MAX_GRF_COUNT           =   62  ###< Maximum number of GRFs that can be sent
@@ -4,9 +4,14 @@ from .exceptions import InvalidReturnCount, InvalidFieldData, InvalidPacketLayou
 from libopenttd.utils import six, force_text, ipaddr
 from libopenttd.utils.six.moves import range
 
+import re
+
 from struct import Struct
 from datetime import datetime, timedelta
 
+if six.PY3:
+    from sys import intern # pylint: disable=W0622
+
 GAMEDATE_BASE_DATE = datetime(1, 1, 1)
 GAMEDATE_BASE_OFFSET = 366
 
@@ -146,15 +151,181 @@ class StringField(Field):
             index = end+1
         return index - start
 
+class RawJson(six.binary_type):
+    """
+    Already serialized JSON, JsonField sends it as is instead of dumping it
+    again.
+    """
+    __slots__ = ()
+
+_JSON_STRING = re.compile(r'"(?:[^"\\]|\\.)*"')
+_JSON_SCALAR = re.compile(r'[^,:\]}\s]*')
+_JSON_SPACE = re.compile(r'\s*')
+
+def skip_json_value(raw, index):
+    """
+    Returns the index just past the JSON value starting at index, without
+    decoding it.
+    """
+    char = raw[index:index + 1]
+    if char == '"':
+        return _JSON_STRING.match(raw, index).end()
+    if char not in ('{', '['):
+        return _JSON_SCALAR.match(raw, index).end()
+    depth = 0
+    while True:
+        char = raw[index]
+        if char == '"':
+            index = _JSON_STRING.match(raw, index).end()
+            continue
+        if char in '{[':
+            depth += 1
+        elif char in '}]':
+            depth -= 1
+            if not depth:
+                return index + 1
+        index += 1
+
+class LazyJson(object):
+    """
+    JSON received by a lazy JsonField, only decoded once its value is used.
+    It can be used like the decoded value for item access, iteration and
+    comparison.
+
+    peek() looks up a top level key of an object without decoding the rest,
+    so messages can be routed on it cheaply.
+    """
+    __slots__ = ('raw', '_value', '_decoded')
+
+    decoder = json.JSONDecoder()
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._value = None
+        self._decoded = False
+
+    @property
+    def value(self):
+        if not self._decoded:
+            self._value = json.loads(self.raw)
+            self._decoded = True
+        return self._value
+
+    def find(self, key):
+        """
+        Returns the (start, end) position in raw of the value of a top level
+        key of an object, or None when there is no such key.
+        """
+        raw = self.raw
+        index = _JSON_SPACE.match(raw).end()
+        if raw[index:index + 1] != '{':
+            return None
+        index += 1
+        try:
+            while True:
+                index = _JSON_SPACE.match(raw, index).end()
+                if raw[index:index + 1] != '"':
+                    return None
+                name, index = self.decoder.raw_decode(raw, index)
+                index = _JSON_SPACE.match(raw, index).end() + 1 # the ':'
+                index = _JSON_SPACE.match(raw, index).end()
+                end = skip_json_value(raw, index)
+                if end == index:
+                    return None
+                if name == key:
+                    return index, end
+                index = _JSON_SPACE.match(raw, end).end()
+                if raw[index:index + 1] != ',':
+                    return None
+                index += 1
+        except (ValueError, IndexError, AttributeError):
+            # Malformed, leave the complaining to a full decode.
+            return None
+
+    def peek(self, key, default = None):
+        if self._decoded:
+            return self._value.get(key, default) if isinstance(self._value, dict) else default
+        span = self.find(key)
+        if span is None:
+            return default
+        return json.loads(self.raw[span[0]:span[1]])
+
+    def peek_lazy(self, key):
+        """
+        Like peek, but returns the value as LazyJson (or None).
+        """
+        span = self.find(key)
+        if span is None:
+            return None
+        return LazyJson(self.raw[span[0]:span[1]])
+
+    def items(self):
+        """
+        Yields the top level elements of an array as LazyJson, without
+        decoding them.
+        """
+        raw = self.raw
+        index = _JSON_SPACE.match(raw).end()
+        if raw[index:index + 1] != '[':
+            raise ValueError("Not a JSON array")
+        index = _JSON_SPACE.match(raw, index + 1).end()
+        while raw[index:index + 1] not in (']', ''):
+            end = skip_json_value(raw, index)
+            yield LazyJson(raw[index:end])
+            index = _JSON_SPACE.match(raw, end).end()
+            if raw[index:index + 1] == ',':
+                index = _JSON_SPACE.match(raw, index + 1).end()
+
+    def to_raw(self):
+        return RawJson(self.raw.encode('utf-8') if isinstance(self.raw, six.text_type) else self.raw)
+
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def get(self, key, default = None):
+        return self.value.get(key, default)
+
+    def __contains__(self, key):
+        return key in self.value
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyJson):
+            other = other.value
+        return self.value == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<LazyJson %s>' % (self.raw[:60], )
+
 class JsonField(StringField):
+    def __init__(self, *args, **kwargs):
+        lazy = kwargs.pop('lazy', False)
+        super(JsonField, self).__init__(*args, **kwargs)
+        self.lazy = lazy
+
     def from_python(self, value):
-        value = json.dumps(value)
+        if isinstance(value, LazyJson):
+            value = value.to_raw()
+        elif not isinstance(value, RawJson):
+            value = json.dumps(value)
         return super(JsonField, self).from_python(value)
 
     def to_python(self, value):
-        if isinstance(value, six.string_types):
+        if isinstance(value, LazyJson):
+            pass
+        elif isinstance(value, six.string_types):
             value = super(JsonField, self).to_python(value)
-            value = json.loads(value)
+            value = LazyJson(value) if self.lazy else json.loads(value)
         elif isinstance(value, (list, dict, tuple, set)):
             pass
         else:
@@ -536,8 +707,30 @@ class MD5Field(StructField):
     consume_amount = 16
     struct_type = 'B' * 16
 
+    # Decoded digests by their bytes, so every packet naming the same GRF
+    #  shares one interned string instead of formatting a new one.
+    _strings = {}
+    STRING_CACHE_SIZE = 8192
+
     def to_python(self, value):
-        return ''.join(['%02X' % val for val in value])
+        return self.get_string(value)
+
+    @classmethod
+    def get_string(cls, value):
+        string = MD5Field._strings.get(value)
+        if string is None:
+            if len(MD5Field._strings) >= MD5Field.STRING_CACHE_SIZE:
+                MD5Field._strings.clear()
+            string = MD5Field._strings[value] = intern(''.join(['%02X' % val for val in value]))
+        return string
+
+    @classmethod
+    def intern_string(cls, string):
+        """
+        Returns the same string decoding the digest from a packet gives, for
+        digests (in hex) that come from elsewhere.
+        """
+        return cls.get_string(tuple([int(string[i:i+2], 16) for i in range(0, len(string), 2)]))
 
     def from_python(self, value):
         return [int(value[i:i+2], 16) for i in range(0, len(value), 2)]
@@ -0,0 +1,154 @@
+#
+# Instrumentation hooks around the packet hot paths.
+#
+# Hooks are installed by replacing the instrumented method on its class with a
+# wrapper when the first hook for a point is registered, and by putting the
+# original method back once the last one is removed. With no hooks registered
+# the hot paths therefore run exactly the code they would without this module.
+#
+import random
+
+from functools import wraps
+
+from .base import PacketManager
+from .packetsocket import BufferedSocket, BufferedUDPSocket
+from libopenttd.utils import six
+from libopenttd.utils.clock import perf_counter
+
+HOOK_POINTS = {
+    'decode':   [(PacketManager, 'from_data')],
+    'encode':   [(PacketManager, 'to_data')],
+    'recv':     [(BufferedSocket, 'read_buffer_fill'), (BufferedUDPSocket, 'read_buffer_fill')],
+    'send':     [(BufferedSocket, 'write_buffer_flush'), (BufferedUDPSocket, 'write_buffer_flush')],
+}
+
+def _sample_interval(sample_rate):
+    if sample_rate is None or sample_rate >= 1.0:
+        return 1
+    if sample_rate <= 0:
+        raise ValueError("sample_rate should be larger than 0")
+    return int(round(1.0 / sample_rate))
+
+def _next_countdown(interval):
+    # Randomise around the interval so that periodic traffic patterns can't
+    #  line up with the sampler, while keeping the average rate intact.
+    if interval == 1:
+        return 1
+    return random.randint(1, 2 * interval - 1)
+
+class Hook(object):
+    def __init__(self, callback, sample_rate = None):
+        self.callback = callback
+        self.interval = _sample_interval(sample_rate)
+        self.countdown = _next_countdown(self.interval)
+
+class HookPoint(object):
+    """
+    Keeps track of the hooks registered for a single point, and of the amount
+    of calls left until the next call that should be timed.
+    """
+    def __init__(self, name, targets):
+        self.name = name
+        self.targets = targets
+        self.hooks = []
+        self.originals = {}
+        self.countdown = 0
+        self.skipped = 0
+
+    @property
+    def installed(self):
+        return len(self.originals) > 0
+
+    def update_countdown(self):
+        self.countdown = min([hook.countdown for hook in self.hooks])
+        self.skipped = 0
+
+    def fire(self, target, result, elapsed):
+        calls = self.skipped
+        for hook in self.hooks:
+            hook.countdown -= calls
+            if hook.countdown > 0:
+                continue
+            hook.countdown = _next_countdown(hook.interval)
+            hook.callback(self.name, target, result, elapsed)
+        self.update_countdown()
+
+    def make_wrapper(self, original):
+        point = self
+
+        @wraps(original)
+        def wrapper(target, *args, **kwargs):
+            point.skipped += 1
+            if point.skipped < point.countdown:
+                return original(target, *args, **kwargs)
+            start = perf_counter()
+            result = original(target, *args, **kwargs)
+            point.fire(target, result, perf_counter() - start)
+            return result
+        return wrapper
+
+    def install(self):
+        for cls, name in self.targets:
+            original = cls.__dict__[name]
+            self.originals[(cls, name)] = original
+            setattr(cls, name, self.make_wrapper(original))
+
+    def uninstall(self):
+        for (cls, name), original in six.iteritems(self.originals):
+            setattr(cls, name, original)
+        self.originals = {}
+
+class HookRegistry(object):
+    """
+    Registry of instrumentation hooks for the decode, encode, recv and send
+    hot paths.
+
+    Callbacks are called as ``callback(point, target, result, elapsed)``, where
+    target is the PacketManager or socket the call was made on, result is the
+    return value of the instrumented call and elapsed is its duration in
+    seconds. A sample_rate below 1 only times and reports that fraction of the
+    calls; the other calls go straight to the original method.
+    """
+    def __init__(self):
+        self.points = dict([(name, HookPoint(name, targets)) for name, targets in six.iteritems(HOOK_POINTS)])
+
+    def get_point(self, point):
+        if point not in self.points:
+            raise KeyError("Unknown hook point '%s', expected one of: %s" % (point, ', '.join(sorted(self.points))))
+        return self.points[point]
+
+    def register(self, point, callback, sample_rate = None):
+        hook_point = self.get_point(point)
+        hook_point.hooks.append(Hook(callback, sample_rate))
+        hook_point.update_countdown()
+        if not hook_point.installed:
+            hook_point.install()
+        return callback
+
+    def unregister(self, point, callback):
+        hook_point = self.get_point(point)
+        hook_point.hooks = [hook for hook in hook_point.hooks if hook.callback != callback]
+        if hook_point.hooks:
+            hook_point.update_countdown()
+        elif hook_point.installed:
+            hook_point.uninstall()
+
+    def clear(self, point = None):
+        points = [self.get_point(point)] if point is not None else list(self.points.values())
+        for hook_point in points:
+            hook_point.hooks = []
+            if hook_point.installed:
+                hook_point.uninstall()
+
+    def is_active(self, point):
+        return self.get_point(point).installed
+
+    def hook(self, point, sample_rate = None):
+        """
+        Decorator version of register.
+        """
+        def _inner(callback):
+            return self.register(point, callback, sample_rate)
+        return _inner
+
+hooks = HookRegistry() #pylint: disable=C0103
@@ -1,4 +1,6 @@
+import errno
 import io
+import os
 import socket
 import time
 
@@ -9,6 +11,10 @@ import fields
 from .enums import Protocol, Direction
 from .registry import registry
 
+# Errors of a non-blocking socket that only mean "try again later".
+RETRY_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+from struct import Struct
 from threading import Lock
 from collections import defaultdict
 
@@ -23,6 +29,51 @@ class OpenTTDPacket(Packet):
         protocol = Protocol.NONE
         direction = Direction.BOTH
 
+# The OpenTTDPacket header, for reading it without the packet machinery.
+FRAME_HEADER = Struct('<HB')
+
+def decode_packet(packet_registry, packet_id, packet_data, extra, index = 0):
+    """
+    Decodes the payload of a single framed packet using the packet class
+    registered for packet_id, returns None if the packet isn't understood.
+
+    index allows decoding a payload that starts somewhere inside a larger
+    buffer (such as a memory-mapped capture file) without copying it first.
+    """
+    packet = packet_registry.get(packet_id)
+    if not packet:
+        # We don't understand this packet.. maybe we should log this.
+        # TODO: Add Logging
+        return None
+    try:
+        return packet.manager.from_data(packet_data, index, extra = extra)
+    except: # pylint: disable=W0702
+        return None
+
+def resolve_address(address, family = socket.AF_INET, numeric = False):
+    """
+    Returns the socket address to connect to for a (host, port) tuple. Looking
+    up a hostname blocks, with numeric set only IP addresses are accepted and
+    None is returned for anything else.
+    """
+    flags = socket.AI_NUMERICHOST if numeric else 0
+    try:
+        infos = socket.getaddrinfo(address[0], address[1], family, socket.SOCK_STREAM, 0, flags)
+    except socket.gaierror:
+        if numeric:
+            return None
+        raise
+    return infos[0][4]
+
+def encode_packet(packet, extra):
+    """
+    Encodes a packet and prefixes it with its OpenTTD packet header, the
+    result can be written to the wire as-is.
+    """
+    data = packet.write(extra=extra)
+    info = OpenTTDPacket(length = len(data) + OpenTTDPacket.get_packet_size(), packet_id = packet.pid)
+    return '%s%s' % (info.write(), data)
+
 class SocketBuffer(object):
     def __init__(self,  write_buffer_size, inactivity_time = 60.0):
         self._write_size = write_buffer_size
@@ -124,6 +175,9 @@ class BufferedSocket(socket.socket):
         super(BufferedSocket, self).__init__(*args, **kwargs)
         self.buffer = SocketBuffer(self.WRITE_BUFFER_QUEUE_SIZE)
         self._connected = False
+        self._connecting = False
+        self._nonblocking = False
+        self.write_remainder = None
         self.read_lock = Lock()
         self.read_buf = bytearray(self.READ_BUFFER_SIZE)
 
@@ -131,6 +185,57 @@ class BufferedSocket(socket.socket):
     def connected(self):
         return self._connected
 
+    @property
+    def connecting(self):
+        return self._connecting
+
+    @property
+    def nonblocking(self):
+        return self._nonblocking
+
+    @property
+    def write_pending(self):
+        return self.write_remainder is not None or self.buffer.write_avail
+
+    def start_connect(self, address):
+        """
+        Starts connecting without blocking. Returns True when the connection
+        was made straight away, otherwise wait for the socket to become
+        writable and call finish_connect.
+
+        Only connecting is non-blocking: a hostname is looked up first, which
+        does block. Pass an IP address (see resolve_address) to avoid that.
+
+        A socket connected this way is driven by a poll loop, which must never
+        block, so it stays non-blocking and its write queue is unbounded:
+        process_send sends what the socket takes and keeps the rest until
+        the socket is writable again.
+        """
+        address = resolve_address(address, self.family)
+        self.buffer = SocketBuffer(0)
+        self.write_remainder = None
+        self._nonblocking = True
+        self.setblocking(0)
+        err = self.connect_ex(address)
+        if err == 0:
+            self._connected = True
+            return True
+        if err not in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, errno.EINTR):
+            raise socket.error(err, os.strerror(err))
+        self._connecting = True
+        return False
+
+    def finish_connect(self):
+        """
+        Completes a connection started with start_connect, raises
+        socket.error when it failed.
+        """
+        self._connecting = False
+        err = self.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err != 0:
+            raise socket.error(err, os.strerror(err))
+        self._connected = True
+
     def connect(self, *args, **kwargs):
         ret = None
         try:
@@ -146,6 +251,8 @@ class BufferedSocket(socket.socket):
         self.buffer.queue_write(data)
 
     def write_buffer_flush(self):
+        if self._nonblocking:
+            return self.write_buffer_send()
         i = 0
         while self.buffer.write_avail:
             i += 1
@@ -162,10 +269,46 @@ class BufferedSocket(socket.socket):
             if i >= self.PACKET_BURST_SIZE and self.PACKET_BURST_SIZE != 0:
                 break
 
+    def write_buffer_send(self):
+        """
+        write_buffer_flush for non-blocking sockets, sends at most
+        PACKET_BURST_SIZE packets. What the socket doesn't take is kept in
+        write_remainder and sent first next time.
+        """
+        i = 0
+        while self.write_remainder is not None or self.buffer.write_avail:
+            data = self.write_remainder
+            if data is None:
+                if i >= self.PACKET_BURST_SIZE and self.PACKET_BURST_SIZE != 0:
+                    break
+                i += 1
+                data = self.buffer.dequeue_write()
+                if not data:
+                    break
+                self.buffer.dequeue_done()
+            try:
+                sent = self.send(data)
+            except socket.error as exc:
+                if exc.args and exc.args[0] in RETRY_ERRNOS:
+                    self.write_remainder = data
+                else:
+                    self.write_remainder = None
+                    self._connected = False
+                break
+            if sent < len(data):
+                self.write_remainder = data[sent:]
+                break
+            self.write_remainder = None
+
     def read_buffer_fill(self):
         read = 0
         with self.read_lock:
-            read = self.recv_into(self.read_buf)
+            try:
+                read = self.recv_into(self.read_buf)
+            except socket.error as exc:
+                if self._nonblocking and exc.args and exc.args[0] in RETRY_ERRNOS:
+                    return 0
+                raise
             if read == 0:
                 self._connected = False
                 return 0
@@ -182,7 +325,7 @@ class PacketSocket(BufferedSocket):
     DEFAULT_PORT        = -1
     DEFAULT_VERSION     = 0
 
-    def __init__(self, family = None, _type = None, protocol = None, direction = None):
+    def __init__(self, family = None, _type = None, protocol = None, direction = None, _sock = None):
         if family is None:
             family = self.DEFAULT_FAMILY
         if _type is None:
@@ -191,21 +334,47 @@ class PacketSocket(BufferedSocket):
             protocol = self.DEFAULT_PROTOCOL
         if direction is None:
             direction = self.DEFAULT_DIRECTION
-        super(PacketSocket, self).__init__(family, _type)
+        if _sock is None:
+            super(PacketSocket, self).__init__(family, _type)
+        else:
+            super(PacketSocket, self).__init__(family, _type, 0, _sock)
 
         self.openttd_protocol = protocol
         self.openttd_direction = direction
         self.packet_registry = registry.get_packets_dict(protocol, direction)
 
         self.extra_info = ProtocolInformation(self.DEFAULT_VERSION)
+        self.peer = None
+        self.capture = None
+
+    @classmethod
+    def from_socket(cls, sock, peer = None, protocol = None, direction = None):
+        """
+        Wraps an already connected socket, such as one returned by accept()
+        on a listening socket, so that it can be used to send and receive
+        packets. The original socket object should no longer be used.
+        """
+        obj = cls(sock.family, sock.type, protocol, direction, getattr(sock, '_sock', sock))
+        obj.peer = peer
+        obj._connected = True
+        return obj
 
     def connect(self, ip, port = None): # pylint: disable=W0221
         if not (isinstance(ip, tuple) and len(ip) == 2):
             if port is None:
                 port = self.DEFAULT_PORT
             ip = (ip, port)
+        self.peer = ip
         return super(PacketSocket, self).connect(ip)
 
+    def start_connect(self, ip, port = None): # pylint: disable=W0221
+        if not (isinstance(ip, tuple) and len(ip) == 2):
+            if port is None:
+                port = self.DEFAULT_PORT
+            ip = (ip, port)
+        self.peer = ip
+        return super(PacketSocket, self).start_connect(ip)
+
     def process_recv(self):
         return self.read_buffer_fill()
 
@@ -216,40 +385,69 @@ class PacketSocket(BufferedSocket):
     def process_send(self):
         return self.write_buffer_flush()
 
-    def process_packets(self):
-        header_size = OpenTTDPacket.get_packet_size()
+    def process_frames(self):
+        """
+        Returns the complete packets in the receive buffer as (pid, frame)
+        tuples without decoding them. frame is a memoryview of the whole
+        packet, header included, so it can be handed to send_frame of another
+        socket as is, or decoded with decode_frame when needed.
+        """
+        header_size = FRAME_HEADER.size
         if self.buffer.read_avail < header_size:
             return []
-        packets = []
+        frames = []
         with self.buffer as data:
             while self.buffer.read_avail >= header_size: # While enough data available for a header.
-                info = OpenTTDPacket.manager.from_data(
-                    data[self.buffer.index:self.buffer.index+header_size].tobytes()
-                    )
-                if self.buffer.read_avail < info.length:
+                index = self.buffer.index
+                length, packet_id = FRAME_HEADER.unpack(data[index:index + header_size].tobytes())
+                if length < header_size:
+                    # Garbage, there is no way to find the next packet.
+                    self._connected = False
+                    break
+                if self.buffer.read_avail < length:
                     # Not enough data in buffer to parse the full packet
                     break
-                packet_data = data[self.buffer.index + header_size:self.buffer.index + info.length]
-                self.buffer.index += info.length
-                packet = self.packet_registry.get(info.packet_id)
-                if not packet:
-                    # We don't understand this packet.. maybe we should log this.
-                    # TODO: Add Logging
-                    continue
-                try:
-                    obj = packet.manager.from_data(packet_data.tobytes(), extra = self.extra_info)
-                except: # pylint: disable=W0702
-                    continue
-                packets.append(obj)
+                frame = data[index:index + length]
+                if self.capture is not None:
+                    self.capture.record(Direction.RECV, self.openttd_protocol, self.peer, frame)
+                self.buffer.index += length
+                frames.append((packet_id, frame))
+        return frames
+
+    def decode_frame(self, packet_id, frame):
+        """
+        Decodes a frame returned by process_frames, returns None if the
+        packet isn't understood.
+        """
+        return decode_packet(self.packet_registry, packet_id, frame[FRAME_HEADER.size:].tobytes(), self.extra_info)
+
+    def process_packets(self):
+        packets = []
+        for packet_id, frame in self.process_frames():
+            obj = self.decode_frame(packet_id, frame)
+            if obj is None:
+                continue
+            packets.append(obj)
         return packets
 
+    def send_frame(self, frame):
+        """
+        Queues an already framed packet, such as one returned by
+        process_frames, without encoding anything.
+        """
+        if isinstance(frame, memoryview):
+            frame = frame.tobytes()
+        if self.capture is not None:
+            self.capture.record(Direction.SEND, self.openttd_protocol, self.peer, frame)
+        self.queue_write(frame)
+
     def send_packet(self, packet, *args, **kwargs):
         if isinstance(packet, type):
             packet = packet(*args, **kwargs)
 
-        data = packet.write(extra=self.extra_info)
-        info = OpenTTDPacket(length = len(data) + OpenTTDPacket.get_packet_size(), packet_id = packet.pid)
-        data = '%s%s' % (info.write(), data)
+        data = encode_packet(packet, self.extra_info)
+        if self.capture is not None:
+            self.capture.record(Direction.SEND, self.openttd_protocol, self.peer, data)
         self.queue_write(data)
 
 class BufferedUDPSocket(BufferedSocket):
@@ -314,6 +512,7 @@ class PacketUDPSocket(BufferedUDPSocket):
         self.packet_registry = registry.get_packets_dict(protocol, direction)
 
         self.extra_info = ProtocolInformation(self.DEFAULT_VERSION)
+        self.capture = None
 
     def process_recv(self):
         return self.read_buffer_fill()
@@ -348,16 +547,13 @@ class PacketUDPSocket(BufferedUDPSocket):
                     if buf.read_avail < info.length:
                         # Not enough data in buffer to parse the full packet
                         break
+                    if self.capture is not None:
+                        self.capture.record(Direction.RECV, self.openttd_protocol, addr,
+                                            data[buf.index:buf.index + info.length])
                     packet_data = data[buf.index + header_size:buf.index + info.length]
                     buf.index += info.length
-                    packet = self.packet_registry.get(info.packet_id)
-                    if not packet:
-                        # We don't understand this packet.. maybe we should log this.
-                        # TODO: Add Logging
-                        continue
-                    try:
-                        obj = packet.manager.from_data(packet_data.tobytes(), extra = self.extra_info)
-                    except: # pylint: disable=W0702
+                    obj = decode_packet(self.packet_registry, info.packet_id, packet_data.tobytes(), self.extra_info)
+                    if obj is None:
                         continue
                     packets.append((addr, obj))
         return packets
@@ -366,7 +562,7 @@ class PacketUDPSocket(BufferedUDPSocket):
         if isinstance(packet, type):
             packet = packet(*args, **kwargs)
 
-        data = packet.write(extra=self.extra_info)
-        info = OpenTTDPacket(length = len(data) + OpenTTDPacket.get_packet_size(), packet_id = packet.pid)
-        data = '%s%s' % (info.write(), data)
+        data = encode_packet(packet, self.extra_info)
+        if self.capture is not None:
+            self.capture.record(Direction.SEND, self.openttd_protocol, addr, data)
         self.queue_write(addr, data)
@@ -0,0 +1,4 @@
+from .schedule import DeadlineHeap
+from .crawler import Crawler, ProbeResult
+from .cache import ServerInfoCache, Staleness
+from .newgrf import NewGRFTable, newgrf_table
@@ -0,0 +1,219 @@
+from libopenttd.utils import six
+from libopenttd.utils.clock import monotonic
+from libopenttd.utils.enums import EnumHelper
+from .newgrf import newgrf_table
+from .schedule import DeadlineHeap
+
+# GameInformation fields that change without anything happening on the
+#  server, they don't count as a change.
+VOLATILE_INFO_FIELDS = frozenset(['game_date'])
+
+class Staleness(EnumHelper):
+    FRESH               = 0x00  #< Within its TTL.
+    STALE               = 0x01  #< Past its TTL, still good to serve while being refreshed.
+    EXPIRED             = 0x02  #< Too old to serve.
+
+def info_signature(info):
+    """
+    Returns what is compared to tell whether a server changed between two
+    GameInformation packets.
+    """
+    data = info.as_dict()
+    return sorted([(name, repr(value)) for name, value in six.iteritems(data) if name not in VOLATILE_INFO_FIELDS])
+
+class CacheEntry(object):
+    """
+    The latest responses of a single server and when it is due to be probed
+    again.
+    """
+    __slots__ = ('address', 'info', 'details', 'newgrfs', 'signature', 'updated', 'changed', 'ttl', 'failures')
+
+    def __init__(self, address, ttl):
+        self.address = address
+        self.info = None
+        self.details = None
+        self.newgrfs = None
+        self.signature = None
+        self.updated = None
+        self.changed = None
+        self.ttl = ttl
+        self.failures = 0
+
+    def __repr__(self):
+        return '<CacheEntry %s:%s (ttl %.1fs)>' % (self.address[0], self.address[1], self.ttl)
+
+    @property
+    def popular(self):
+        return self.info is not None and self.info.clients_on > 0
+
+    def age(self, now = None):
+        if self.updated is None:
+            return None
+        return (monotonic() if now is None else now) - self.updated
+
+class ServerInfoCache(object):
+    """
+    Keeps the latest GameInformation, DetailInformation and NewGRF responses
+    per server address, so lookups never touch the network.
+
+    Every entry has its own TTL. A server whose information changed since
+    the last probe gets min_ttl, one that didn't has its TTL multiplied by
+    backoff up to max_ttl, and servers with clients on them never wait more
+    than popular_ttl. An entry is fresh within its TTL, stale up to
+    stale_factor times its TTL and expired after that. Servers that didn't
+    answer max_failures probes in a row are dropped.
+
+    The entries that are due are kept on a DeadlineHeap; refresh() hands
+    them to a Crawler and handle_result() stores what comes back, including
+    the names of the server's GRFs looked up in the NewGRFTable newgrfs (the
+    shared newgrf_table by default). Names that aren't known yet are None
+    until the next GameInformation of the server comes in.
+    """
+    def __init__(self, min_ttl = 15.0, max_ttl = 600.0, popular_ttl = 30.0, backoff = 2.0, stale_factor = 3.0,
+                 max_failures = 3, newgrfs = None):
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.popular_ttl = popular_ttl
+        self.backoff = backoff
+        self.stale_factor = stale_factor
+        self.max_failures = max_failures
+        self.newgrfs = newgrfs if newgrfs is not None else newgrf_table
+        self.entries = {}
+        self.timers = DeadlineHeap()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, address):
+        return address in self.entries
+
+    def __iter__(self):
+        return six.itervalues(self.entries)
+
+    def staleness(self, entry, now = None):
+        age = entry.age(now)
+        if age is None or age > entry.ttl * self.stale_factor:
+            return Staleness.EXPIRED
+        if age > entry.ttl:
+            return Staleness.STALE
+        return Staleness.FRESH
+
+    def get(self, address, max_staleness = Staleness.STALE, now = None):
+        """
+        Returns the entry of address, None when there is none or it is
+        older than max_staleness.
+        """
+        entry = self.entries.get(address)
+        if entry is None or self.staleness(entry, now) > max_staleness:
+            return None
+        return entry
+
+    def servers(self, max_staleness = Staleness.STALE, now = None):
+        """
+        Returns the entries no older than max_staleness.
+        """
+        if now is None:
+            now = monotonic()
+        return [entry for entry in six.itervalues(self.entries) if self.staleness(entry, now) <= max_staleness]
+
+    #
+    # Updating
+    #
+    def add(self, address, now = None):
+        """
+        Makes sure address is known, new addresses are due right away.
+        """
+        entry = self.entries.get(address)
+        if entry is None:
+            entry = self.entries[address] = CacheEntry(address, self.min_ttl)
+            self.timers.schedule(address, monotonic() if now is None else now)
+        return entry
+
+    def remove(self, address):
+        self.timers.cancel(address)
+        return self.entries.pop(address, None)
+
+    def update(self, address, info = None, details = None, newgrfs = None, now = None):
+        """
+        Stores the responses of the server at address. Only a new
+        GameInformation reschedules it, its TTL depending on whether the
+        server changed.
+        """
+        if now is None:
+            now = monotonic()
+        entry = self.add(address, now)
+        if details is not None:
+            entry.details = details
+        if newgrfs is not None:
+            entry.newgrfs = newgrfs
+        if info is None:
+            return entry
+
+        signature = info_signature(info)
+        if signature != entry.signature:
+            entry.ttl = self.min_ttl
+            entry.changed = now
+        else:
+            entry.ttl = min(entry.ttl * self.backoff, self.max_ttl)
+        entry.info = info
+        entry.signature = signature
+        entry.updated = now
+        entry.failures = 0
+        if entry.popular:
+            entry.ttl = min(entry.ttl, self.popular_ttl)
+        self.timers.schedule(address, now + entry.ttl)
+        return entry
+
+    def fail(self, address, now = None):
+        """
+        Records a probe of address that wasn't answered.
+        """
+        entry = self.entries.get(address)
+        if entry is None:
+            return None
+        if now is None:
+            now = monotonic()
+        entry.failures += 1
+        if entry.failures >= self.max_failures:
+            return self.remove(address)
+        entry.ttl = min(entry.ttl * self.backoff, self.max_ttl)
+        self.timers.schedule(address, now + entry.ttl)
+        return entry
+
+    def handle_result(self, result, now = None):
+        """
+        Stores a ProbeResult of a Crawler.
+        """
+        if result.info is None:
+            return self.fail(result.address, now)
+        return self.update(result.address, info = result.info, details = result.details,
+                           newgrfs = self.newgrfs.get_names(result.info.grfinfo), now = now)
+
+    #
+    # Refreshing
+    #
+    def due(self, now = None):
+        """
+        Returns the addresses whose TTL ran out, oldest first. They aren't
+        due again until they are updated or fail, or max_ttl passed without
+        either.
+        """
+        if now is None:
+            now = monotonic()
+        due = self.timers.pop_due(now)
+        for address in due:
+            self.timers.schedule(address, now + self.max_ttl)
+        return due
+
+    def wait(self, now = None, timeout = None):
+        return self.timers.wait(monotonic() if now is None else now, timeout)
+
+    def refresh(self, crawler, now = None):
+        """
+        Queues the due addresses for probing on crawler, returns how many
+        there were.
+        """
+        due = self.due(now)
+        for address in due:
+            crawler.add(address)
+        return len(due)
@@ -0,0 +1,380 @@
+import errno
+import socket
+
+from collections import deque, namedtuple
+
+from libopenttd.packets import ProtocolInformation, constants
+from libopenttd.packets.enums import ServerListType
+from libopenttd.packets.packetsocket import FRAME_HEADER, decode_packet, encode_packet
+from libopenttd.utils.clock import monotonic
+from libopenttd.utils.poller import Poller, READ
+from .master import send as m_send, recv as m_recv
+from .server import ServerInfoSocket, send as s_send, recv as s_recv
+from .schedule import DeadlineHeap
+
+# The address families crawled and the server list asked for on each.
+FAMILIES = (
+    (socket.AF_INET,    ServerListType.IPV4),
+    (socket.AF_INET6,   ServerListType.IPV6),
+)
+
+MASTER_SERVER = (constants.NETWORK_MASTER_SERVER_HOST, constants.NETWORK_MASTER_SERVER_PORT)
+
+# Datagrams read per socket per loop iteration, so one busy family can't
+#  starve the timers.
+RECV_BURST_SIZE = 256
+
+# Receive buffer asked for, answers that arrive while the loop is busy
+#  elsewhere queue up here instead of being dropped.
+RECV_BUFFER_SIZE = 1 << 20
+
+ProbeResult = namedtuple('ProbeResult', 'address info attempts rtt details')
+
+class Probe(object):
+    """
+    A request that is retried until answered: the server list asked from
+    the master, or the game information of a single server. When details
+    are fetched result holds what is known of the server while its
+    DetailInformation is asked for.
+    """
+    __slots__ = ('address', 'family', 'server_types', 'attempts', 'sent', 'done', 'result')
+
+    def __init__(self, address, family, server_types = None):
+        self.address = address
+        self.family = family
+        self.server_types = server_types
+        self.attempts = 0
+        self.sent = None
+        self.done = False
+        self.result = None
+
+    @property
+    def master(self):
+        return self.server_types is not None
+
+    def __repr__(self):
+        return '<Probe %s:%s (%d attempts)>' % (self.address[0], self.address[1], self.attempts)
+
+class Crawler(object):
+    """
+    Asks the master server for the IPv4 and IPv6 server lists and probes
+    every server listed for its GameInformation.
+
+    Servers that don't answer within timeout are probed again, up to
+    attempts times. The number of servers probed at once follows AIMD: it
+    starts at min_in_flight, doubles every round trip until the first loss
+    and grows by one per round trip after that, and it is halved (at most
+    once per timeout) when an answer shows that a datagram was lost. Servers
+    that never answer don't count as loss, they are mostly just gone. It
+    never exceeds max_in_flight, nor what fits in the receive buffer.
+    Every outstanding request has its deadline in a DeadlineHeap, so the
+    loop only ever looks at the probes that are due, and sleeps in the
+    poller until the next one is.
+
+    Results are ProbeResult tuples, streamed by crawl() as they come in.
+    Servers that never answered are reported with info None. With details,
+    the DetailInformation of a server is asked for as soon as its
+    GameInformation is in, and its result follows once that is answered
+    too, or with details None if it isn't.
+
+    With a NewGRFTable as newgrfs, every server that answers is asked for
+    the names of its GRFs that the table doesn't know yet, the crawl
+    lasts until those requests are answered or timed out.
+    """
+    def __init__(self, master = MASTER_SERVER, families = FAMILIES, max_in_flight = 256, min_in_flight = 8,
+                 timeout = 1.0, attempts = 3, master_timeout = 2.0, master_attempts = 3, newgrfs = None,
+                 details = False):
+        self.master = master
+        self.families = families
+        self.max_in_flight = max_in_flight
+        self.min_in_flight = min(min_in_flight, max_in_flight)
+        self.details = details
+        self.timeout = timeout
+        self.attempts = attempts
+        self.master_timeout = master_timeout
+        self.master_attempts = master_attempts
+        self.newgrfs = newgrfs
+
+        self.sockets = {}
+        self.poller = Poller()
+        self.probes = {}
+        self.waiting = deque()
+        self.in_flight = 0
+        self.window = float(self.min_in_flight)
+        self.threshold = float(max_in_flight)
+        self.decreased = None
+        self.masters = []
+        self.timers = DeadlineHeap()
+        self.results = []
+        self.started = False
+        self.probe_data = encode_packet(s_send.ServerInformation(),
+                                        ProtocolInformation(ServerInfoSocket.DEFAULT_VERSION))
+        self.details_data = encode_packet(s_send.DetailInformation(),
+                                          ProtocolInformation(ServerInfoSocket.DEFAULT_VERSION))
+
+    def __len__(self):
+        return len(self.probes)
+
+    @property
+    def done(self):
+        """
+        Whether the master answered (or gave up on) every list request and
+        every server listed was probed to the end.
+        """
+        return self.started and not self.waiting and not self.in_flight and \
+            all([probe.done for probe in self.masters]) and \
+            (self.newgrfs is None or not len(self.newgrfs.pending))
+
+    def open_socket(self, family):
+        sock = self.sockets.get(family)
+        if sock is not None:
+            return sock
+        try:
+            sock = ServerInfoSocket(family = family)
+        except socket.error:
+            # No support for this family, IPv6 most likely.
+            return None
+        sock.setblocking(0)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
+            size = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        except socket.error:
+            size = None
+        if size:
+            # Every probe in flight may get a full datagram back at once.
+            self.max_in_flight = max(min(self.max_in_flight, size // constants.SEND_MTU), 1)
+            self.min_in_flight = min(self.min_in_flight, self.max_in_flight)
+            self.window = min(self.window, self.max_in_flight)
+        self.sockets[family] = sock
+        self.poller.register(sock.fileno(), READ)
+        return sock
+
+    def start(self):
+        """
+        Requests the server lists from the master, for every family that
+        both this host and the master support.
+        """
+        self.started = True
+        if self.master is None:
+            return
+        for family, server_types in self.families:
+            try:
+                address = socket.getaddrinfo(self.master[0], self.master[1], family, socket.SOCK_DGRAM)[0][4]
+            except (socket.gaierror, IndexError):
+                continue
+            if self.open_socket(family) is None:
+                continue
+            probe = Probe(address, family, server_types)
+            self.masters.append(probe)
+            self.send_master(probe, monotonic())
+
+    def close(self):
+        for sock in self.sockets.values():
+            self.poller.unregister(sock.fileno())
+            sock.close()
+        self.sockets = {}
+        self.poller.close()
+
+    def add(self, address):
+        """
+        Queues a server for probing, unless it is being probed already.
+        """
+        host, port = address[0], address[1]
+        key = (host, port)
+        probe = self.probes.get(key)
+        if probe is not None and not probe.done:
+            return
+        family = socket.AF_INET6 if ':' in host else socket.AF_INET
+        if self.open_socket(family) is None:
+            return
+        self.probes[key] = probe = Probe(key, family)
+        self.waiting.append(probe)
+
+    #
+    # Sending
+    #
+    def sendto(self, probe, data):
+        try:
+            self.sockets[probe.family].sendto(data, probe.address)
+        except socket.error:
+            # Lost like any datagram, the retry will have another go.
+            pass
+
+    def send_master(self, probe, now):
+        probe.attempts += 1
+        packet = m_send.ServerList(server_types = probe.server_types)
+        self.sendto(probe, encode_packet(packet, ProtocolInformation(constants.NETWORK_MASTER_SERVER_VERSION)))
+        self.timers.schedule(probe, now + self.master_timeout)
+
+    def send_probe(self, probe, now):
+        probe.attempts += 1
+        probe.sent = now
+        self.sendto(probe, self.probe_data)
+        self.timers.schedule(probe, now + self.timeout)
+
+    def send_details(self, probe, now):
+        probe.attempts += 1
+        probe.sent = now
+        self.sendto(probe, self.details_data)
+        self.timers.schedule(probe, now + self.timeout)
+
+    def fill(self, now):
+        while self.waiting and self.in_flight < int(self.window):
+            probe = self.waiting.popleft()
+            self.in_flight += 1
+            self.send_probe(probe, now)
+
+    #
+    # Concurrency
+    #
+    def answered(self, probe, now):
+        if probe.attempts > 1:
+            # An earlier request or its answer got lost.
+            self.lost(now)
+        elif self.window < self.threshold:
+            self.window = min(self.window + 1, self.max_in_flight)
+        else:
+            self.window = min(self.window + 1.0 / self.window, self.max_in_flight)
+
+    def lost(self, now):
+        if self.decreased is not None and now - self.decreased < self.timeout:
+            return
+        self.decreased = now
+        self.window = self.threshold = max(self.window / 2, self.min_in_flight)
+
+    #
+    # Results
+    #
+    def handle_info(self, probe, info, now):
+        self.answered(probe, now)
+        self.timers.cancel(probe)
+        probe.result = ProbeResult(probe.address, info, probe.attempts, now - probe.sent, None)
+        if self.newgrfs is not None:
+            for packet in self.newgrfs.requests(info.grfinfo, now):
+                self.sendto(probe, encode_packet(packet, ProtocolInformation(ServerInfoSocket.DEFAULT_VERSION)))
+        if self.details:
+            probe.attempts = 0
+            self.send_details(probe, now)
+        else:
+            self.finish(probe)
+
+    def handle_details(self, probe, details, now):
+        self.answered(probe, now)
+        probe.result = probe.result._replace(details = details)
+        self.finish(probe)
+
+    def finish(self, probe):
+        probe.done = True
+        self.timers.cancel(probe)
+        self.in_flight -= 1
+        self.results.append(probe.result)
+
+    def expire(self, now):
+        for probe in self.timers.pop_due(now):
+            if probe.master:
+                if probe.attempts < self.master_attempts:
+                    self.send_master(probe, now)
+                else:
+                    probe.done = True
+            elif probe.attempts < self.attempts:
+                if probe.result is None:
+                    self.send_probe(probe, now)
+                else:
+                    self.send_details(probe, now)
+            elif probe.result is None:
+                probe.result = ProbeResult(probe.address, None, probe.attempts, None, None)
+                self.finish(probe)
+            else:
+                # It did answer the GameInformation, so this is loss too.
+                self.lost(now)
+                self.finish(probe)
+
+    #
+    # Receiving
+    #
+    def receive(self, sock, now):
+        for _ in range(RECV_BURST_SIZE):
+            try:
+                data, addr = sock.recvfrom(constants.SEND_MTU)
+            except socket.error as exc:
+                if exc.args and exc.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                continue
+            if len(data) < FRAME_HEADER.size:
+                continue
+            length, pid = FRAME_HEADER.unpack_from(data)
+            packet = decode_packet(sock.packet_registry, pid, data[FRAME_HEADER.size:length],
+                                   ProtocolInformation(sock.DEFAULT_VERSION))
+            if packet is not None:
+                self.handle_packet((addr[0], addr[1]), packet, now)
+
+    def handle_packet(self, addr, packet, now):
+        if isinstance(packet, m_recv.ServerList):
+            for probe in self.masters:
+                if (probe.address[0], probe.address[1]) == addr:
+                    probe.done = True
+                    self.timers.cancel(probe)
+            for item in packet.addresses:
+                self.add((str(item['ip']), item['port']))
+        elif isinstance(packet, s_recv.GameInformation):
+            probe = self.probes.get(addr)
+            if probe is not None and not probe.done and probe.sent is not None and probe.result is None:
+                self.handle_info(probe, packet, now)
+        elif isinstance(packet, s_recv.DetailInformation):
+            probe = self.probes.get(addr)
+            if probe is not None and not probe.done and probe.result is not None:
+                self.handle_details(probe, packet, now)
+        elif isinstance(packet, s_recv.NewGRF):
+            if self.newgrfs is not None:
+                self.newgrfs.handle_newgrf(packet)
+
+    #
+    # Loop
+    #
+    def get_wait(self, timeout, now):
+        if self.waiting and self.in_flight < int(self.window):
+            return 0
+        wait = self.timers.wait(now, timeout)
+        if self.newgrfs is not None:
+            wait = self.newgrfs.pending.wait(now, wait)
+        return wait
+
+    def run_once(self, timeout = None):
+        """
+        Waits at most timeout seconds for answers and returns the results
+        that came in (or timed out) meanwhile.
+        """
+        if not self.started:
+            self.start()
+        now = monotonic()
+        self.fill(now)
+        events = self.poller.poll(self.get_wait(timeout, now))
+        now = monotonic()
+        ready = set([fd for fd, _ in events])
+        for sock in list(self.sockets.values()):
+            if sock.fileno() in ready:
+                self.receive(sock, now)
+        self.expire(now)
+        if self.newgrfs is not None:
+            self.newgrfs.expire(now)
+        self.fill(now)
+        results, self.results = self.results, []
+        return results
+
+    def crawl(self, timeout = 30.0):
+        """
+        Generator yielding a ProbeResult for every server as soon as it is
+        known, until every server is done or timeout seconds have passed.
+        The NewGRFTable is flushed when the crawl ends.
+        """
+        end = monotonic() + timeout
+        try:
+            while not self.done:
+                left = end - monotonic()
+                if left <= 0:
+                    break
+                for result in self.run_once(left):
+                    yield result
+        finally:
+            if self.newgrfs is not None:
+                self.newgrfs.flush()
@@ -0,0 +1,139 @@
+import io
+import os
+
+from libopenttd.packets.constants import NETWORK_MAX_GRF_COUNT
+from libopenttd.packets.fields import MD5Field
+from libopenttd.utils import six
+from libopenttd.utils.clock import monotonic
+from .schedule import DeadlineHeap
+from .server import send
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+class NewGRFTable(object):
+    """
+    NewGRF names by (grf id, md5), shared by every server that runs the same
+    GRF, optionally persisted as JSON at path.
+
+    requests() returns the GetNewGRFList packets asking for the GRFs of a
+    server that aren't known yet, at most NETWORK_MAX_GRF_COUNT per packet.
+    GRFs asked for are pending until a NewGRF answer names them, or for
+    pending_timeout seconds, and are asked of no other server meanwhile.
+
+    New names only mark the table dirty, flush() writes it to path when it
+    is; a Crawler does so at the end of every crawl.
+    """
+    def __init__(self, path = None, pending_timeout = 2.0):
+        self.path = path
+        self.pending_timeout = pending_timeout
+        self.names = {}
+        self.dirty = False
+        self.pending = DeadlineHeap()
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, key):
+        return key in self.names
+
+    def get(self, grf_id, md5, default = None):
+        return self.names.get((grf_id, md5), default)
+
+    def get_names(self, grfinfo):
+        """
+        Returns the names of the GRFs in a GameInformation's grfinfo, None
+        for those that aren't known.
+        """
+        return [self.names.get((grf['id'], grf['md5'])) for grf in grfinfo]
+
+    def add(self, grf_id, md5, name):
+        key = (grf_id, md5)
+        self.pending.cancel(key)
+        if self.names.get(key) == name:
+            return False
+        self.names[key] = name
+        self.dirty = True
+        return True
+
+    def load(self):
+        with io.open(self.path, 'rb') as fileobj:
+            data = json.loads(fileobj.read().decode('utf-8'))
+        for grf_id, md5, name in data:
+            # The same strings decoding a packet gives, so keys are shared.
+            self.names[(grf_id, MD5Field.intern_string(md5))] = name
+        self.dirty = False
+
+    def save(self):
+        data = sorted([[grf_id, md5, name] for (grf_id, md5), name in six.iteritems(self.names)])
+        tmp_path = '%s.tmp' % self.path
+        with io.open(tmp_path, 'wb') as fileobj:
+            fileobj.write(json.dumps(data).encode('utf-8'))
+        os.rename(tmp_path, self.path)
+        self.dirty = False
+
+    def flush(self):
+        """
+        Saves the table if it has a path and changed since it was loaded or
+        saved, returns whether it did.
+        """
+        if not self.dirty or self.path is None:
+            return False
+        self.save()
+        return True
+
+    #
+    # Requests
+    #
+    def unknown(self, grfinfo, now = None):
+        """
+        Returns the (grf id, md5) of the GRFs in grfinfo that are neither
+        known nor pending.
+        """
+        self.expire(now)
+        missing = []
+        seen = set()
+        for grf in grfinfo:
+            key = (grf['id'], grf['md5'])
+            if key not in self.names and key not in self.pending and key not in seen:
+                seen.add(key)
+                missing.append(key)
+        return missing
+
+    def expire(self, now = None):
+        """
+        Forgets about requests that went unanswered for pending_timeout,
+        their GRFs are asked for again.
+        """
+        return self.pending.pop_due(monotonic() if now is None else now)
+
+    def requests(self, grfinfo, now = None):
+        """
+        Returns the GetNewGRFList packets for the unknown GRFs in grfinfo,
+        which are pending from now on.
+        """
+        if now is None:
+            now = monotonic()
+        missing = self.unknown(grfinfo, now)
+        for key in missing:
+            self.pending.schedule(key, now + self.pending_timeout)
+        return [send.GetNewGRFList(newgrfs = [{'id': grf_id, 'md5': md5}
+                                              for grf_id, md5 in missing[index:index + NETWORK_MAX_GRF_COUNT]])
+                for index in range(0, len(missing), NETWORK_MAX_GRF_COUNT)]
+
+    def handle_newgrf(self, packet):
+        """
+        Stores the names of a NewGRF answer, returns how many were new.
+        """
+        added = 0
+        for grf in packet.newgrfs:
+            if self.add(grf['id'], grf['md5'], grf['name']):
+                added += 1
+        return added
+
+# The table shared by everything in the process that doesn't bring its own.
+newgrf_table = NewGRFTable()
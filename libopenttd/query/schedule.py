@@ -0,0 +1,114 @@
+import heapq
+
+# Marks an entry of an item that was cancelled or rescheduled.
+REMOVED = object()
+
+class DeadlineHeap(object):
+    """
+    Keeps a deadline for any number of items, ordered on a heap.
+
+    Scheduling an item and taking the due ones off is O(log n), as is
+    rescheduling and cancelling: the old entry is only marked and dropped
+    once it reaches the top. The heap is rebuilt when the marked entries
+    outnumber the live ones, so they never take up more than half of it.
+
+    Items must be hashable, every item has at most one deadline.
+    """
+    COMPACT_SIZE = 64
+
+    def __init__(self):
+        self.heap = []
+        self.entries = {}
+        self.sequence = 0
+        self.removed = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, item):
+        return item in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def deadline(self, item):
+        """
+        Returns the deadline of item, None if it has none.
+        """
+        entry = self.entries.get(item)
+        return entry[0] if entry is not None else None
+
+    def schedule(self, item, deadline):
+        """
+        Sets the deadline of item, replacing the one it had.
+        """
+        self.cancel(item)
+        # The sequence keeps equal deadlines in order and items from being compared.
+        self.sequence += 1
+        entry = [deadline, self.sequence, item]
+        self.entries[item] = entry
+        heapq.heappush(self.heap, entry)
+
+    def cancel(self, item):
+        """
+        Removes the deadline of item, returns whether it had one.
+        """
+        entry = self.entries.pop(item, None)
+        if entry is None:
+            return False
+        entry[2] = REMOVED
+        self.removed += 1
+        if self.removed > self.COMPACT_SIZE and self.removed > len(self.entries):
+            self.compact()
+        return True
+
+    def compact(self):
+        self.heap = [entry for entry in self.heap if entry[2] is not REMOVED]
+        heapq.heapify(self.heap)
+        self.removed = 0
+
+    def prune(self):
+        heap = self.heap
+        while heap and heap[0][2] is REMOVED:
+            heapq.heappop(heap)
+            self.removed -= 1
+
+    @property
+    def next_deadline(self):
+        """
+        The earliest deadline, None when there is none.
+        """
+        self.prune()
+        return self.heap[0][0] if self.heap else None
+
+    def wait(self, now, timeout = None):
+        """
+        Returns how long to sleep from now until the next deadline, at most
+        timeout. None means forever, for a timeout of None and no deadlines.
+        """
+        deadline = self.next_deadline
+        if deadline is None:
+            return timeout
+        wait = max(deadline - now, 0)
+        return wait if timeout is None else min(wait, timeout)
+
+    def pop_due(self, now):
+        """
+        Removes and returns the items whose deadline is at or before now,
+        earliest first.
+        """
+        heap = self.heap
+        due = []
+        while heap and heap[0][0] <= now:
+            deadline, _, item = heapq.heappop(heap)
+            if item is REMOVED:
+                self.removed -= 1
+                continue
+            del self.entries[item]
+            due.append(item)
+        return due
+
+    def clear(self):
+        self.heap = []
+        self.entries = {}
+        self.removed = 0
@@ -0,0 +1,40 @@
+import time
+
+try:
+    from time import monotonic
+
+except ImportError:
+    # Python 2 does not expose a monotonic clock, so we ask the C library for
+    # CLOCK_MONOTONIC directly when we can, and fall back to the wall clock
+    # on platforms where that isn't possible.
+    try:
+        import ctypes
+        import ctypes.util
+
+        CLOCK_MONOTONIC = 1
+
+        class _timespec(ctypes.Structure):
+            _fields_ = [
+                ('tv_sec', ctypes.c_long),
+                ('tv_nsec', ctypes.c_long),
+            ]
+
+        _librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno = True)
+        _clock_gettime = _librt.clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+        def monotonic():
+            spec = _timespec()
+            if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(spec)) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, "clock_gettime failed")
+            return spec.tv_sec + spec.tv_nsec * 1e-9
+
+        monotonic()
+    except (ImportError, OSError, AttributeError, TypeError):
+        monotonic = time.time
+
+try:
+    from time import perf_counter
+except ImportError:
+    from timeit import default_timer as perf_counter
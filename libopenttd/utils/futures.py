@@ -0,0 +1,106 @@
+try:
+    from concurrent.futures import Future, CancelledError, TimeoutError
+
+except ImportError:
+    # Minimal stand-in for concurrent.futures.Future on Python 2 without the
+    # futures backport installed. Only the parts used by libopenttd, and the
+    # ones a caller would reasonably wait on, are implemented.
+    import threading
+
+    class CancelledError(Exception):
+        pass
+
+    class TimeoutError(Exception): # pylint: disable=W0622
+        pass
+
+    PENDING     = 'PENDING'
+    RUNNING     = 'RUNNING'
+    CANCELLED   = 'CANCELLED'
+    FINISHED    = 'FINISHED'
+
+    class Future(object):
+        def __init__(self):
+            self._condition = threading.Condition()
+            self._state = PENDING
+            self._result = None
+            self._exception = None
+            self._callbacks = []
+
+        def __repr__(self):
+            return '<Future %s>' % self._state
+
+        def cancel(self):
+            with self._condition:
+                if self._state in (RUNNING, FINISHED):
+                    return False
+                if self._state == CANCELLED:
+                    return True
+                self._state = CANCELLED
+                self._condition.notify_all()
+            self._invoke_callbacks()
+            return True
+
+        def cancelled(self):
+            return self._state == CANCELLED
+
+        def running(self):
+            return self._state == RUNNING
+
+        def done(self):
+            return self._state in (CANCELLED, FINISHED)
+
+        def _get_result(self):
+            if self._state == CANCELLED:
+                raise CancelledError()
+            if self._exception is not None:
+                raise self._exception
+            return self._result
+
+        def _wait(self, timeout):
+            with self._condition:
+                if not self.done():
+                    self._condition.wait(timeout)
+                if not self.done():
+                    raise TimeoutError()
+
+        def result(self, timeout = None):
+            self._wait(timeout)
+            return self._get_result()
+
+        def exception(self, timeout = None):
+            self._wait(timeout)
+            if self._state == CANCELLED:
+                raise CancelledError()
+            return self._exception
+
+        def add_done_callback(self, func):
+            with self._condition:
+                if not self.done():
+                    self._callbacks.append(func)
+                    return
+            func(self)
+
+        def _invoke_callbacks(self):
+            for callback in self._callbacks:
+                callback(self)
+
+        def set_running_or_notify_cancel(self):
+            with self._condition:
+                if self._state == CANCELLED:
+                    return False
+                self._state = RUNNING
+                return True
+
+        def set_result(self, result):
+            with self._condition:
+                self._result = result
+                self._state = FINISHED
+                self._condition.notify_all()
+            self._invoke_callbacks()
+
+        def set_exception(self, exception):
+            with self._condition:
+                self._exception = exception
+                self._state = FINISHED
+                self._condition.notify_all()
+            self._invoke_callbacks()
@@ -0,0 +1,170 @@
+#
+# Thin wrapper around the best I/O readiness mechanism the platform offers:
+#  epoll where available, poll otherwise, and select as a last resort.
+#
+import errno
+import math
+import select
+
+READ    = 0x01
+WRITE   = 0x02
+ERROR   = 0x04
+
+class BasePoller(object):
+    def __init__(self):
+        self.fds = {}
+
+    def __len__(self):
+        return len(self.fds)
+
+    def __contains__(self, fd):
+        return fd in self.fds
+
+    def register(self, fd, events):
+        self.fds[fd] = events
+
+    def modify(self, fd, events):
+        self.fds[fd] = events
+
+    def unregister(self, fd):
+        self.fds.pop(fd, None)
+
+    def poll(self, timeout = None):
+        """
+        Waits at most timeout seconds (forever when None) and returns a list
+        of (fd, events) for the file descriptors that are ready.
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        self.fds = {}
+
+def _milliseconds(timeout):
+    # epoll and poll wait in whole milliseconds, rounding down would make
+    #  the loop spin until a sub-millisecond deadline has passed.
+    return int(math.ceil(max(timeout, 0) * 1000.0))
+
+def _retry_on_eintr(func, *args):
+    while True:
+        try:
+            return func(*args)
+        except (IOError, OSError, select.error) as exc:
+            if exc.args and exc.args[0] == errno.EINTR:
+                continue
+            raise
+
+class EpollPoller(BasePoller):
+    def __init__(self):
+        super(EpollPoller, self).__init__()
+        self.epoll = select.epoll()
+
+    def _mask(self, events):
+        mask = 0
+        if events & READ:
+            mask |= select.EPOLLIN | select.EPOLLPRI
+        if events & WRITE:
+            mask |= select.EPOLLOUT
+        return mask
+
+    def register(self, fd, events):
+        self.epoll.register(fd, self._mask(events))
+        super(EpollPoller, self).register(fd, events)
+
+    def modify(self, fd, events):
+        self.epoll.modify(fd, self._mask(events))
+        super(EpollPoller, self).modify(fd, events)
+
+    def unregister(self, fd):
+        if fd not in self.fds:
+            return
+        super(EpollPoller, self).unregister(fd)
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, OSError, ValueError):
+            # The file descriptor was closed already, epoll forgot about it by itself.
+            pass
+
+    def poll(self, timeout = None):
+        events = _retry_on_eintr(self.epoll.poll, -1 if timeout is None else _milliseconds(timeout) / 1000.0)
+        result = []
+        for fd, mask in events:
+            flags = 0
+            if mask & (select.EPOLLIN | select.EPOLLPRI):
+                flags |= READ
+            if mask & select.EPOLLOUT:
+                flags |= WRITE
+            if mask & (select.EPOLLERR | select.EPOLLHUP):
+                flags |= ERROR
+            result.append((fd, flags))
+        return result
+
+    def close(self):
+        super(EpollPoller, self).close()
+        self.epoll.close()
+
+class PollPoller(BasePoller):
+    def __init__(self):
+        super(PollPoller, self).__init__()
+        self.poller = select.poll()
+
+    def _mask(self, events):
+        mask = 0
+        if events & READ:
+            mask |= select.POLLIN | select.POLLPRI
+        if events & WRITE:
+            mask |= select.POLLOUT
+        return mask
+
+    def register(self, fd, events):
+        self.poller.register(fd, self._mask(events))
+        super(PollPoller, self).register(fd, events)
+
+    def modify(self, fd, events):
+        self.poller.modify(fd, self._mask(events))
+        super(PollPoller, self).modify(fd, events)
+
+    def unregister(self, fd):
+        if fd not in self.fds:
+            return
+        super(PollPoller, self).unregister(fd)
+        try:
+            self.poller.unregister(fd)
+        except KeyError:
+            pass
+
+    def poll(self, timeout = None):
+        events = _retry_on_eintr(self.poller.poll, None if timeout is None else _milliseconds(timeout))
+        result = []
+        for fd, mask in events:
+            flags = 0
+            if mask & (select.POLLIN | select.POLLPRI):
+                flags |= READ
+            if mask & select.POLLOUT:
+                flags |= WRITE
+            if mask & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+                flags |= ERROR
+            result.append((fd, flags))
+        return result
+
+class SelectPoller(BasePoller):
+    def poll(self, timeout = None):
+        readers = [fd for fd, events in self.fds.items() if events & READ]
+        writers = [fd for fd, events in self.fds.items() if events & WRITE]
+        if timeout is not None:
+            timeout = max(timeout, 0)
+        readable, writable, errored = _retry_on_eintr(select.select, readers, writers, readers + writers, timeout)
+        result = {}
+        for fd in readable:
+            result[fd] = result.get(fd, 0) | READ
+        for fd in writable:
+            result[fd] = result.get(fd, 0) | WRITE
+        for fd in errored:
+            result[fd] = result.get(fd, 0) | ERROR
+        return list(result.items())
+
+if hasattr(select, 'epoll'):
+    Poller = EpollPoller
+elif hasattr(select, 'poll'):
+    Poller = PollPoller
+else:
+    Poller = SelectPoller
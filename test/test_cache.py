@@ -0,0 +1,89 @@
+import unittest
+
+from libopenttd.query import Crawler, NewGRFTable, ProbeResult, ServerInfoCache, Staleness
+
+from test_crawler import FakeEndpoint, game_information
+
+ADDRESS = ('10.0.0.1', 3979)
+
+class TestServerInfoCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = ServerInfoCache(min_ttl = 10.0, max_ttl = 100.0, popular_ttl = 20.0, backoff = 2.0,
+                                     stale_factor = 3.0, max_failures = 2)
+
+    def idle(self, name = 'Server'):
+        info = game_information(name)
+        info.clients_on = 0
+        return info
+
+    def test_backoff(self):
+        self.assertEqual(self.cache.add(ADDRESS, now = 0.0).info, None)
+        self.assertEqual(self.cache.due(0.0), [ADDRESS])
+        entry = self.cache.update(ADDRESS, info = self.idle(), now = 0.0)
+        self.assertEqual(entry.ttl, 10.0)
+        self.assertEqual(self.cache.due(9.0), [])
+        self.assertEqual(self.cache.due(10.0), [ADDRESS])
+
+        # Only the date moved on, the server didn't change.
+        info = self.idle()
+        info.game_date = info.game_date.replace(year = 1951)
+        self.assertEqual(self.cache.update(ADDRESS, info = info, now = 10.0).ttl, 20.0)
+        self.assertEqual(self.cache.update(ADDRESS, info = info, now = 30.0).ttl, 40.0)
+        self.assertEqual(self.cache.wait(now = 30.0), 40.0)
+        self.assertEqual(self.cache.update(ADDRESS, info = self.idle('Renamed'), now = 70.0).ttl, 10.0)
+
+    def test_popular(self):
+        info = game_information('Busy')
+        for now in (0.0, 10.0, 30.0, 50.0):
+            entry = self.cache.update(ADDRESS, info = info, now = now)
+        self.assertEqual(entry.ttl, 20.0)
+
+    def test_staleness(self):
+        self.cache.update(ADDRESS, info = self.idle(), now = 0.0)
+        self.assertEqual(self.cache.staleness(self.cache.entries[ADDRESS], 5.0), Staleness.FRESH)
+        self.assertTrue(self.cache.get(ADDRESS, now = 25.0) is not None)
+        self.assertEqual(self.cache.get(ADDRESS, Staleness.FRESH, now = 25.0), None)
+        self.assertEqual(self.cache.get(ADDRESS, now = 31.0), None)
+        self.assertEqual(len(self.cache.servers(Staleness.EXPIRED, now = 31.0)), 1)
+
+    def test_failures(self):
+        self.cache.update(ADDRESS, info = self.idle(), now = 0.0)
+        self.assertEqual(self.cache.fail(ADDRESS, now = 10.0).ttl, 20.0)
+        self.cache.fail(ADDRESS, now = 30.0)
+        self.assertFalse(ADDRESS in self.cache)
+        self.assertEqual(self.cache.due(1000.0), [])
+
+    def test_newgrf_names(self):
+        table = NewGRFTable()
+        table.add(1, 'A' * 32, 'Known')
+        self.cache.newgrfs = table
+        info = self.idle()
+        info.grfinfo = [{'id': 1, 'md5': 'A' * 32}, {'id': 2, 'md5': 'B' * 32}]
+        entry = self.cache.handle_result(ProbeResult(ADDRESS, info, 1, 0.01, None), now = 0.0)
+        self.assertEqual(entry.newgrfs, ['Known', None])
+        table.add(2, 'B' * 32, 'Later')
+        entry = self.cache.handle_result(ProbeResult(ADDRESS, info, 1, 0.01, None), now = 10.0)
+        self.assertEqual(entry.newgrfs, ['Known', 'Later'])
+
+    def test_refresh(self):
+        server = FakeEndpoint(lambda endpoint, packet: [game_information('Fake')])
+        crawler = Crawler(master = None, timeout = 0.05)
+        try:
+            self.cache.add(server.address)
+            for _ in range(2):
+                self.assertEqual(self.cache.refresh(crawler), 1)
+                results = []
+                while not results:
+                    results = crawler.run_once(0.01)
+                    server.serve()
+                self.cache.handle_result(results[0])
+                self.assertEqual(self.cache.refresh(crawler), 0)
+                self.cache.timers.schedule(server.address, 0)
+            self.assertEqual(len(server.received), 2)
+            self.assertEqual(self.cache.get(server.address, Staleness.FRESH).info.name, 'Fake')
+        finally:
+            crawler.close()
+            server.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from libopenttd import capture, packets
+from libopenttd.admin import recv, send
+from libopenttd.packets.packetsocket import OpenTTDPacket
+
+def frame(packet):
+    data = packet.write()
+    return bytes(OpenTTDPacket(length = len(data) + 3, packet_id = packet.pid).write() + data)
+
+class TestCapture(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.cap')
+        self.peer = ('127.0.0.1', 3977)
+        self.frames = [frame(recv.Date(date = packets.fields.gamedate_to_datetime(700000 + i))) for i in range(10)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_frames(self, **kwargs):
+        with capture.CaptureWriter(self.path, **kwargs) as writer:
+            writer.record(packets.Direction.SEND, packets.Protocol.ADMIN, self.peer,
+                          frame(send.Join(password = 'pass', name = 'name', version = '1.0')))
+            for data in self.frames:
+                writer.record(packets.Direction.RECV, packets.Protocol.ADMIN, self.peer, data)
+
+    def test_roundtrip(self):
+        self.write_frames(block_records = 3)
+        with capture.CaptureReader(self.path) as reader:
+            self.assertEqual(len(list(reader.blocks())), 4)
+            records = list(reader)
+        self.assertEqual(len(records), 11)
+        self.assertEqual([record.frame for record in records[1:]], self.frames)
+        self.assertEqual(records[0].direction, packets.Direction.SEND)
+        self.assertEqual(records[1].peer, self.peer)
+        self.assertEqual(records[1].pid, recv.Date.pid)
+        timestamps = [record.timestamp for record in records]
+        self.assertEqual(timestamps, sorted(timestamps))
+
+    def test_time_range(self):
+        self.write_frames()
+        with capture.CaptureReader(self.path) as reader:
+            self.assertEqual(list(reader.records(start = time.time() + 60)), [])
+            self.assertEqual(len(list(reader.records(end = time.time() + 60))), 11)
+
+    def test_replay(self):
+        self.write_frames()
+        replayed = list(capture.replay(self.path))
+        self.assertTrue(isinstance(replayed[0][1], send.Join))
+        self.assertEqual(replayed[0][1].name, 'name')
+        self.assertEqual([packet.date for _, packet in replayed[1:]],
+                         [packets.fields.gamedate_to_datetime(700000 + i) for i in range(10)])
+
+    def test_append_after_interrupted_write(self):
+        self.write_frames()
+        with open(self.path, 'ab') as fileobj:
+            fileobj.write(b'BLCK\x10\x00')
+        self.write_frames()
+        with capture.CaptureReader(self.path) as reader:
+            self.assertEqual(len(list(reader)), 22)
+
+    def test_invalid_file(self):
+        with open(self.path, 'wb') as fileobj:
+            fileobj.write(b'not a capture file')
+        self.assertRaises(capture.InvalidCaptureFile, capture.CaptureReader, self.path)
+
+class TestMappedCapture(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.cap')
+        self.servers = [('10.0.0.1', 3977), ('10.0.0.2', 3977)]
+        with capture.CaptureWriter(self.path, block_records = 4) as writer:
+            for i in range(20):
+                peer = self.servers[i % 2]
+                if i % 3:
+                    packet = recv.Date(date = packets.fields.gamedate_to_datetime(700000 + i))
+                else:
+                    packet = recv.ClientQuit(client_id = i)
+                writer.record(packets.Direction.RECV, packets.Protocol.ADMIN, peer, frame(packet),
+                              timestamp = 1000.0 + i)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_query_by_pid_and_peer(self):
+        with capture.MappedCaptureReader(self.path) as reader:
+            self.assertEqual(len(reader), 20)
+            results = list(reader.packets(pids = [recv.ClientQuit], peer = self.servers[0]))
+        self.assertEqual([packet.client_id for _, packet in results], [0, 6, 12, 18])
+        self.assertTrue(all(record.peer == self.servers[0] for record, _ in results))
+
+    def test_query_by_time(self):
+        with capture.MappedCaptureReader(self.path) as reader:
+            first = reader.get_record(0).walltime
+            records = list(reader.records(pids = [recv.Date.pid], start = first + 4.5, end = first + 9.5))
+        self.assertEqual([round(record.walltime - first) for record in records], [5, 7, 8])
+
+    def test_frames_are_views(self):
+        with capture.MappedCaptureReader(self.path) as reader:
+            record = reader.get_record(1)
+            self.assertFalse(isinstance(record.frame, (bytes, bytearray)))
+            self.assertEqual(record.pid, recv.Date.pid)
+            self.assertEqual(bytes(record.frame), frame(recv.Date(date = packets.fields.gamedate_to_datetime(700001))))
+
+    def test_string_packets(self):
+        chat = recv.Chat(action = 3, dest_type = 0, client_id = 2, message = 'hello there', data = 0)
+        with capture.CaptureWriter(self.path) as writer:
+            writer.record(packets.Direction.RECV, packets.Protocol.ADMIN, self.servers[0], frame(chat))
+        with capture.MappedCaptureReader(self.path) as reader:
+            packet = reader.get_packet(20)
+        self.assertEqual((packet.client_id, packet.message), (2, 'hello there'))
+
+    def test_truncated_frame(self):
+        with capture.CaptureWriter(self.path) as writer:
+            writer.record(packets.Direction.RECV, packets.Protocol.ADMIN, self.servers[0],
+                          bytes(OpenTTDPacket(length = 3, packet_id = recv.ClientQuit.pid).write()))
+            writer.record(packets.Direction.RECV, packets.Protocol.ADMIN, self.servers[0],
+                          frame(recv.Date(date = packets.fields.gamedate_to_datetime(800000))))
+        with capture.MappedCaptureReader(self.path) as reader:
+            self.assertEqual(reader.get_packet(20), None)
+            self.assertEqual(reader.get_packet(21).date, packets.fields.gamedate_to_datetime(800000))
+
+    def test_sidecar_index(self):
+        capture.MappedCaptureReader(self.path).close()
+        index_path = capture.CaptureIndex.index_path(self.path)
+        self.assertTrue(os.path.exists(index_path))
+        index = capture.CaptureIndex.load(index_path)
+        self.assertEqual(len(index), 20)
+
+        with capture.CaptureWriter(self.path) as writer:
+            writer.record(packets.Direction.RECV, packets.Protocol.ADMIN, self.servers[1],
+                          frame(recv.ClientQuit(client_id = 99)))
+        with capture.MappedCaptureReader(self.path) as reader:
+            self.assertEqual(len(reader), 21)
+            self.assertEqual([packet.client_id for _, packet in reader.packets(pids = [recv.ClientQuit],
+                                                                              peer = self.servers[1])],
+                             [3, 9, 15, 99])
@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from libopenttd.admin import CmdLogStore, recv
+
+def command(client_id, tile, command_id = 1, text = ''):
+    return recv.CmdLogging(client_id = client_id, company_id = client_id % 3, command_id = command_id,
+                           params = [tile, 7], tile = tile, text = text, frame = tile * 2)
+
+class TestCmdLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = CmdLogStore(self.directory, segment_rows = 10, fsync_segments = 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def fill(self):
+        for number in range(25):
+            self.store.append('server%d' % (number % 2), command(number % 5, number * 100, text = 'sign %d' % (number % 4)),
+                              walltime = 1000.0 + number)
+
+    def test_segments(self):
+        self.fill()
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+        self.assertEqual(self.store.unsynced, [])
+        self.assertEqual(len(self.store.segment), 5)
+
+        rows = list(self.store.query())
+        self.assertEqual(len(rows), 25)
+        self.assertEqual(rows[3]['server'], 'server1')
+        self.assertEqual(rows[3]['text'], 'sign 3')
+        self.assertEqual(rows[3]['param1'], 300)
+        self.assertEqual(rows[3]['param2'], 7)
+        self.assertEqual(rows[24]['frame'], 4800)
+
+        self.store.flush()
+        reopened = CmdLogStore(self.directory, segment_rows = 10)
+        self.assertEqual(len(reopened.segment_paths), 3)
+        self.assertEqual(list(reopened.query()), rows)
+
+    def test_flush_due(self):
+        self.store.append('server0', command(1, 100))
+        start = self.store.last_sync
+        self.assertEqual(self.store.flush_due(start + 1.0), 4.0)
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertEqual(self.store.flush_due(start + 5.0), 5.0)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        self.assertEqual(len(self.store.segment), 0)
+        self.assertEqual(self.store.last_sync, start + 5.0)
+        # Nothing waiting, only the interval restarts.
+        self.assertEqual(self.store.flush_due(start + 20.0), 5.0)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        self.assertEqual(len(list(CmdLogStore(self.directory).query())), 1)
+
+    def test_query(self):
+        self.fill()
+        rows = list(self.store.query(columns = ['tile', 'server'], client_id = 2, tile_range = (500, 1800)))
+        self.assertEqual(rows, [{'tile': 700, 'server': 'server1'}, {'tile': 1200, 'server': 'server0'},
+                                {'tile': 1700, 'server': 'server1'}])
+        rows = list(self.store.query(columns = ['tile'], server = 'server0', start = 1020.0))
+        self.assertEqual([row['tile'] for row in rows], [2000, 2200, 2400])
+        self.assertEqual(list(self.store.query(tile_range = (100000, 200000))), [])
+        self.assertEqual(list(self.store.query(server = 'unknown')), [])
+
+    def test_segment_skipping(self):
+        self.fill()
+        self.store.flush()
+        segments = list(self.store.iter_segments())
+        self.assertFalse(self.store.may_match(segments[0], [('tile', 1000, 1100)]))
+        self.assertTrue(self.store.may_match(segments[1], [('tile', 1000, 1100)]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from libopenttd.admin import AdminSession, CmdNamesCache, CommandNames, send, recv
+from libopenttd.packets.enums import UpdateType
+
+from test_session import FakeServer, SETTINGS
+
+class TestCmdNames(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cmdnames.json')
+        self.server = FakeServer()
+        self.found = []
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def connect(self, cache):
+        session = AdminSession(self.server.address[0], self.server.address[1])
+        cache.attach(session)
+        session.connect()
+        self.server.accept()
+        self.server.receive(1)
+        self.server.handshake(SETTINGS)
+        while not session.ready:
+            session.run_once(5)
+        session.process_send()
+        return session
+
+    def test_table(self):
+        table = CommandNames.from_dict('1.4.0', {0: 'CmdBuildRailroadTrack', 3: 'CmdBuildBridge'})
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table[3], 'CmdBuildBridge')
+        self.assertEqual(table.get(1), None)
+        self.assertEqual(table.get(40, 'unknown'), 'unknown')
+        self.assertEqual(table.get_id('CmdBuildRailroadTrack'), 0)
+        self.assertRaises(KeyError, lambda: table[2])
+
+    def test_collect_and_reuse(self):
+        cache = CmdNamesCache(self.path)
+        cache.on_names(lambda session, table: self.found.append(table))
+        session = self.connect(cache)
+        poll, ping = self.server.receive(2)
+        self.assertTrue(isinstance(poll, send.Poll))
+        self.assertEqual(poll.poll_type, UpdateType.NAMES)
+        self.assertTrue(isinstance(ping, send.Ping))
+
+        self.server.send(recv.CmdNames(commands = {0: 'CmdBuildRailroadTrack', 1: 'CmdRemoveRailroadTrack'}),
+                         recv.CmdNames(commands = {2: 'CmdBuildSingleRail'}),
+                         recv.Pong(payload = ping.payload))
+        while not self.found:
+            session.run_once(5)
+        self.assertEqual(self.found[0].names, ['CmdBuildRailroadTrack', 'CmdRemoveRailroadTrack', 'CmdBuildSingleRail'])
+        self.assertEqual(cache.get_names(session), self.found[0])
+        self.assertEqual(session.dispatch_table.get(recv.CmdNames.pid), None)
+        session.close()
+
+        cache = CmdNamesCache(self.path)
+        self.assertTrue('1.4.0' in cache)
+        cache.on_names(lambda session, table: self.found.append(table))
+        session = self.connect(cache)
+        self.assertEqual(len(self.found), 2)
+        self.assertEqual(self.found[1][2], 'CmdBuildSingleRail')
+        self.assertFalse(UpdateType.NAMES in session.subscriptions)
+        self.assertEqual(cache.collectors, {})
+        session.close()
+
+if __name__ == '__main__':
+    unittest.main()
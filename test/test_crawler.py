@@ -0,0 +1,171 @@
+import socket
+import unittest
+
+from datetime import datetime
+
+from libopenttd import packets
+from libopenttd.packets.enums import ServerListType
+from libopenttd.packets.packetsocket import FRAME_HEADER, decode_packet, encode_packet
+from libopenttd.query import Crawler
+from libopenttd.query.crawler import Probe
+from libopenttd.query.master import recv as m_recv, send as m_send
+from libopenttd.query.server import recv as s_recv, send as s_send
+from libopenttd.utils import ipaddr
+
+def game_information(name):
+    return s_recv.GameInformation(version = 4, grfinfo = [], game_date = datetime(1950, 1, 1),
+                                  start_date = datetime(1950, 1, 1), companies_max = 15, companies_on = 1,
+                                  spectators_max = 10, name = name, revision = '1.4.0', language = 0,
+                                  passworded = False, clients_max = 25, clients_on = 2, spectators_on = 0,
+                                  map_name = 'Map', map_width = 256, map_height = 256, map_set = 0,
+                                  dedicated = 1)
+
+class FakeEndpoint(object):
+    """
+    A UDP master or game server, answering what it receives with the packets
+    respond returns.
+    """
+    registry = packets.registry.get_packets_dict(packets.Protocol.QUERY, packets.Direction.SEND)
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.setblocking(0)
+        self.address = self.sock.getsockname()
+        self.received = []
+
+    def serve(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(packets.constants.SEND_MTU)
+            except socket.error:
+                return
+            length, pid = FRAME_HEADER.unpack_from(data)
+            packet = decode_packet(self.registry, pid, data[FRAME_HEADER.size:length],
+                                   packets.ProtocolInformation(packets.constants.NETWORK_MASTER_SERVER_VERSION))
+            self.received.append(packet)
+            for reply in self.respond(self, packet):
+                self.sock.sendto(encode_packet(reply, packets.ProtocolInformation(4)), addr)
+
+    def close(self):
+        self.sock.close()
+
+class TestCrawler(unittest.TestCase):
+    def setUp(self):
+        self.endpoints = []
+        self.servers = [self.endpoint(self.answer) for _ in range(5)]
+        self.silent = self.endpoint(lambda endpoint, packet: [])
+        self.master = self.endpoint(self.server_list)
+
+    def tearDown(self):
+        for endpoint in self.endpoints:
+            endpoint.close()
+
+    def endpoint(self, respond):
+        endpoint = FakeEndpoint(respond)
+        self.endpoints.append(endpoint)
+        return endpoint
+
+    def answer(self, endpoint, packet):
+        if isinstance(packet, s_send.ServerInformation):
+            return [game_information('Server %d' % endpoint.address[1])]
+        return []
+
+    def server_list(self, endpoint, packet):
+        self.assertTrue(isinstance(packet, m_send.ServerList))
+        self.assertEqual(packet.server_types, ServerListType.IPV4)
+        listed = self.servers + [self.silent]
+        return [m_recv.ServerList(ip_type = 1, addresses = [{'ip': ipaddr.IPAddress(endpoint.address[0]),
+                                                            'port': endpoint.address[1]} for endpoint in listed])]
+
+    def crawl(self, crawler):
+        results = []
+        for _ in range(500):
+            if crawler.done:
+                return results
+            results.extend(crawler.run_once(0.01))
+            for endpoint in self.endpoints:
+                endpoint.serve()
+        self.fail("Crawl didn't finish")
+
+    def test_crawl(self):
+        crawler = Crawler(master = self.master.address, families = ((socket.AF_INET, ServerListType.IPV4), ),
+                          max_in_flight = 2, timeout = 0.05, attempts = 2)
+        results = self.crawl(crawler)
+        crawler.close()
+
+        self.assertEqual(len(self.master.received), 1)
+        answered = dict([(result.address, result) for result in results if result.info is not None])
+        self.assertEqual(sorted(answered), sorted([endpoint.address for endpoint in self.servers]))
+        for address, result in answered.items():
+            self.assertEqual(result.info.name, 'Server %d' % address[1])
+            self.assertEqual(result.attempts, 1)
+        missing = [result for result in results if result.info is None]
+        self.assertEqual([(result.address, result.attempts) for result in missing], [(self.silent.address, 2)])
+        self.assertEqual(len(self.silent.received), 2)
+
+    def test_master_retry(self):
+        self.master.respond = lambda endpoint, packet: []
+        crawler = Crawler(master = self.master.address, families = ((socket.AF_INET, ServerListType.IPV4), ),
+                          master_timeout = 0.02, master_attempts = 3)
+        self.assertEqual(self.crawl(crawler), [])
+        crawler.close()
+        self.assertEqual(len(self.master.received), 3)
+
+    def test_in_flight_limit(self):
+        crawler = Crawler(master = None, max_in_flight = 2)
+        for endpoint in self.servers:
+            crawler.add(endpoint.address)
+        crawler.add(self.servers[0].address)
+        self.assertEqual(len(crawler), 5)
+        crawler.run_once(0)
+        self.assertEqual(crawler.in_flight, 2)
+        results = self.crawl(crawler)
+        crawler.close()
+        self.assertEqual(len(results), 5)
+
+    def test_details(self):
+        def respond(endpoint, packet):
+            if isinstance(packet, s_send.DetailInformation):
+                if endpoint is self.servers[0]:
+                    return []
+                return [s_recv.DetailInformation(company_info_version = 6, companies = [])]
+            return self.answer(endpoint, packet)
+        for endpoint in self.servers:
+            endpoint.respond = respond
+        crawler = Crawler(master = None, timeout = 0.05, attempts = 2, details = True)
+        for endpoint in self.servers:
+            crawler.add(endpoint.address)
+        results = self.crawl(crawler)
+        crawler.close()
+
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all([result.info is not None for result in results]))
+        missing = [result.address for result in results if result.details is None]
+        self.assertEqual(missing, [self.servers[0].address])
+        self.assertEqual(len([packet for packet in self.servers[0].received
+                              if isinstance(packet, s_send.DetailInformation)]), 2)
+        self.assertEqual(set([result.details.company_info_version for result in results if result.details]), set([6]))
+
+    def test_window(self):
+        crawler = Crawler(master = None, min_in_flight = 4, max_in_flight = 64, timeout = 1.0)
+        probe = Probe(('127.0.0.1', 3979), socket.AF_INET)
+        probe.attempts = 1
+        for _ in range(4):
+            crawler.answered(probe, 10.0)
+        self.assertEqual(crawler.window, 8)
+        # Answered after a retry: multiplicative decrease, once per timeout.
+        probe.attempts = 2
+        crawler.answered(probe, 10.0)
+        crawler.lost(10.5)
+        self.assertEqual((crawler.window, crawler.threshold), (4, 4))
+        probe.attempts = 1
+        crawler.answered(probe, 11.0)
+        self.assertEqual(crawler.window, 4.25)
+        crawler.lost(11.5)
+        self.assertEqual(crawler.window, 4)
+        crawler.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+
+from libopenttd.admin import AdminFleet, recv
+from libopenttd.admin.fleet import HashRing
+
+from test_session import FakeServer, SETTINGS
+
+class TestHashRing(unittest.TestCase):
+    def test_stable_assignment(self):
+        ring = HashRing(range(4))
+        keys = ['server%d' % number for number in range(200)]
+        before = dict([(key, ring.get_node(key)) for key in keys])
+        self.assertEqual(before, dict([(key, HashRing(range(4)).get_node(key)) for key in keys]))
+        self.assertEqual(set(before.values()), set(range(4)))
+
+        ring.remove(3)
+        after = dict([(key, ring.get_node(key)) for key in keys])
+        for key in keys:
+            if before[key] != 3:
+                self.assertEqual(before[key], after[key])
+            else:
+                self.assertNotEqual(after[key], 3)
+
+class TestFleet(unittest.TestCase):
+    def setUp(self):
+        self.servers = [FakeServer(), FakeServer()]
+        self.fleet = AdminFleet(workers = 2, track_state = True)
+        self.received = []
+
+    def tearDown(self):
+        self.fleet.stop()
+        for server in self.servers:
+            server.close()
+
+    def test_forwarding(self):
+        events = []
+        changes = []
+        self.fleet.on(recv.Chat, lambda key, packet: self.received.append((key, packet.message)))
+        self.fleet.on('ready', events.append)
+        self.fleet.on('change', lambda key, change: changes.append((key, change)))
+        self.fleet.start()
+        for number, server in enumerate(self.servers):
+            self.fleet.add('server%d' % number, server.address[0], server.address[1], password = 'pw')
+
+        for number, server in enumerate(self.servers):
+            server.accept()
+            server.receive(1)
+            server.handshake(SETTINGS)
+        for _ in range(50):
+            if len(events) == 2:
+                break
+            self.fleet.run_once(0.1)
+        self.assertEqual(sorted(events), ['server0', 'server1'])
+
+        for number, server in enumerate(self.servers):
+            server.send(recv.Chat(action = 3, dest_type = 0, client_id = 1, message = 'hi %d' % number, data = 0),
+                        recv.ClientJoin(client_id = 5))
+        for _ in range(50):
+            if len(self.received) == 2 and len([1 for _, change in changes if change.kind == 'added']) == 2:
+                break
+            self.fleet.run_once(0.1)
+        self.assertEqual(sorted(self.received), [('server0', 'hi 0'), ('server1', 'hi 1')])
+        added = sorted([(key, change.key) for key, change in changes if change.kind == 'added'])
+        self.assertEqual(added, [('server0', 5), ('server1', 5)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+import unittest
+
+from libopenttd.admin import AdminSession, GamescriptChannel, send, recv
+from libopenttd.packets import InvalidFieldData
+from libopenttd.packets.constants import NETWORK_GAMESCRIPT_JSON_LENGTH
+from libopenttd.packets.fields import LazyJson, RawJson
+
+from test_session import FakeServer, SETTINGS
+
+class TestLazyJson(unittest.TestCase):
+    def test_peek(self):
+        message = LazyJson('{"skip": {"a": "}\\"]", "b": [1, {"c": null}]}, "n": -1.5e3 , "event" : "tick"}')
+        self.assertEqual(message.peek('event'), 'tick')
+        self.assertEqual(message.peek('n'), -1500.0)
+        self.assertEqual(message.peek('missing', 'default'), 'default')
+        self.assertFalse(message._decoded)
+        self.assertEqual(message['skip']['b'], [1, {'c': None}])
+        self.assertEqual(message.peek('event'), 'tick')
+        self.assertEqual(LazyJson('[1, 2]').peek('event'), None)
+        self.assertEqual(LazyJson('{"event": ').peek('event'), None)
+
+    def test_items(self):
+        items = list(LazyJson('[ {"x": "a,b"} , [1, 2],3,"]" ]').items())
+        self.assertEqual([item.raw for item in items], ['{"x": "a,b"}', '[1, 2]', '3', '"]"'])
+        self.assertEqual(items[0], {'x': 'a,b'})
+        self.assertEqual(list(LazyJson('[]').items()), [])
+
+class TestGamescriptChannel(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer()
+        self.session = AdminSession(self.server.address[0], self.server.address[1])
+        self.channel = GamescriptChannel(self.session)
+        self.session.connect()
+        self.server.accept()
+        self.server.receive(1)
+        self.server.handshake(SETTINGS)
+        while not self.session.ready:
+            self.session.run_once(5)
+        self.session.process_send()
+        self.received = []
+
+    def tearDown(self):
+        self.session.close()
+        self.server.close()
+
+    def handler(self, session, message):
+        self.received.append(message)
+
+    def test_batching(self):
+        self.channel.send_many([{'event': 'build', 'tile': tile} for tile in range(3)])
+        self.session.process_send()
+        packet = self.server.receive(1)[0]
+        self.assertTrue(isinstance(packet, send.Gamescript))
+        self.assertEqual(packet.data, {'__batch__': [{'event': 'build', 'tile': tile} for tile in range(3)]})
+
+        self.channel.send_many([{'event': 'alone'}])
+        self.session.process_send()
+        self.assertEqual(self.server.receive(1)[0].data, {'event': 'alone'})
+
+    def test_batches_fill_packets(self):
+        messages = [{'event': 'sign', 'text': 'x' * 100, 'id': number} for number in range(40)]
+        self.channel.send_many(messages)
+        self.session.process_send()
+        received = []
+        while sum([len(data['__batch__']) for data in received]) < len(messages):
+            received.extend([packet.data for packet in self.server.receive(1)])
+        self.assertTrue(len(received) < 5)
+        self.assertEqual([message for data in received for message in data['__batch__']], messages)
+
+    def test_fragments(self):
+        message = {'event': 'big', 'names': ['"quoted" \\ %d' % number for number in range(400)]}
+        self.channel.send(message)
+        self.session.process_send()
+        parts = []
+        while not parts or len(parts) < parts[0]['__parts__']:
+            parts.extend([packet.data for packet in self.server.receive(1)])
+        self.assertTrue(len(parts) > 1)
+        self.assertEqual(set([part['__seq__'] for part in parts]), set([1]))
+        self.assertEqual(LazyJson(''.join([part['__data__'] for part in parts])), message)
+
+        # The script sends fragments the same way.
+        self.channel.on('big', self.handler)
+        self.server.send(*[recv.Gamescript(data = part) for part in parts])
+        while not self.received:
+            self.session.run_once(5)
+        self.assertEqual(self.received[0], message)
+
+    def test_fragments_unicode(self):
+        text = u'\xe9\u20ac' * 2000
+        self.channel.send(RawJson('{"event":"big","t":"%s"}' % text.encode('utf-8')))
+        while self.session.wants_write:
+            self.session.process_send()
+        parts = []
+        while not parts or len(parts) < parts[0]['__parts__']:
+            parts.extend([packet.data for packet in self.server.receive(1)])
+        self.assertTrue(len(parts) > 1)
+
+        self.channel.on('big', self.handler)
+        self.server.send(*[recv.Gamescript(data = part) for part in parts])
+        while not self.received:
+            self.session.run_once(5)
+        self.assertEqual(self.received[0]['t'], text)
+        # Forwarding what was received splits it the same way.
+        self.channel.send(self.received[0])
+
+    def test_invalid_fragments(self):
+        self.channel.max_partial = 2
+        self.channel.on('big', self.handler)
+        self.server.send(recv.Gamescript(data = {'__seq__': 1, '__part__': 5, '__parts__': 2, '__data__': '{'}),
+                         recv.Gamescript(data = {'__seq__': 2, '__part__': 0, '__parts__': 10 ** 9, '__data__': '{'}),
+                         recv.Gamescript(data = {'__seq__': 3, '__part__': 0, '__parts__': 2, '__data__': 7}),
+                         recv.Gamescript(data = {'__seq__': 'x', '__part__': 0, '__parts__': 2, '__data__': '{'}))
+        # Partial messages that never complete don't pile up.
+        for sequence in range(10, 20):
+            self.server.send(recv.Gamescript(data = {'__seq__': sequence, '__part__': 0, '__parts__': 2,
+                                                     '__data__': '{"event":'}))
+        self.server.send(recv.Gamescript(data = {'__seq__': 19, '__part__': 1, '__parts__': 2, '__data__': '"big"}'}))
+        while not self.received:
+            self.session.run_once(5)
+        self.assertEqual(self.received, [{'event': 'big'}])
+        self.assertEqual(list(self.channel.fragments), [18])
+
+    def test_routing(self):
+        self.channel.on('tick', self.handler)
+        everything = []
+        self.channel.on(None, lambda session, message: everything.append(message))
+        batch = RawJson('{"__batch__":[{"event":"tick","n":1},{"event":"tock"},{"event":"tick","n":2}]}')
+        self.server.send(recv.Gamescript(data = batch), recv.Gamescript(data = {'event': 'tick', 'n': 3}))
+        while len(everything) < 4:
+            self.session.run_once(5)
+        self.assertEqual([message.peek('n') for message in self.received], [1, 2, 3])
+        self.assertFalse(any([message._decoded for message in self.received]))
+        self.assertEqual(everything[1], {'event': 'tock'})
+
+    def test_packet_stays_eager(self):
+        packets = []
+        self.session.on(recv.Gamescript, lambda session, packet: packets.append(packet))
+        self.channel.on('tick', self.handler)
+        self.server.send(recv.Gamescript(data = {'event': 'tick', 'n': 1}))
+        while not packets or not self.received:
+            self.session.run_once(5)
+        self.assertTrue(isinstance(packets[0].data, dict))
+        self.assertTrue(isinstance(self.received[0], LazyJson))
+        self.assertFalse(self.received[0]._decoded)
+
+    def test_limit(self):
+        self.assertRaises(InvalidFieldData, send.Gamescript(data = RawJson('"%s"' % ('x' * NETWORK_GAMESCRIPT_JSON_LENGTH))).write)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+
+from libopenttd import packets
+from libopenttd.packets.base import PacketManager
+
+class TestPacket(packets.Packet):
+    testa = packets.UInt16Field(ordering=1)
+    testb = packets.StringField(ordering=2)
+    class Meta:
+        virtual = True
+
+class TestHooks(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.original_from_data = PacketManager.__dict__['from_data']
+        self.original_to_data = PacketManager.__dict__['to_data']
+
+    def tearDown(self):
+        packets.hooks.clear()
+
+    def record(self, point, target, result, elapsed):
+        self.calls.append((point, target, result, elapsed))
+
+    def test_unused_points_are_untouched(self):
+        self.assertFalse(packets.hooks.is_active('decode'))
+        self.assertTrue(PacketManager.__dict__['from_data'] is self.original_from_data)
+
+    def test_decode_hook(self):
+        packets.hooks.register('decode', self.record)
+        self.assertTrue(packets.hooks.is_active('decode'))
+        packet = TestPacket.manager.from_data('\x05\x00test\x00')
+        self.assertEqual(len(self.calls), 1)
+        point, target, result, elapsed = self.calls[0]
+        self.assertEqual(point, 'decode')
+        self.assertTrue(target is TestPacket.manager)
+        self.assertTrue(result is packet)
+        self.assertTrue(elapsed >= 0)
+        self.assertEqual(packet.testa, 5)
+
+    def test_encode_hook(self):
+        packets.hooks.register('encode', self.record)
+        data = TestPacket(testa = 5, testb = 'test').write()
+        self.assertEqual(data, '\x05\x00test\x00')
+        self.assertEqual([call[0] for call in self.calls], ['encode'])
+
+    def test_unregister_restores_original(self):
+        packets.hooks.register('decode', self.record)
+        packets.hooks.register('encode', self.record)
+        packets.hooks.unregister('decode', self.record)
+        self.assertTrue(PacketManager.__dict__['from_data'] is self.original_from_data)
+        self.assertFalse(PacketManager.__dict__['to_data'] is self.original_to_data)
+        packets.hooks.unregister('encode', self.record)
+        self.assertTrue(PacketManager.__dict__['to_data'] is self.original_to_data)
+
+    def test_sampling(self):
+        packets.hooks.register('decode', self.record, sample_rate = 0.1)
+        for _ in range(1000):
+            TestPacket.manager.from_data('\x05\x00test\x00')
+        self.assertTrue(40 < len(self.calls) < 200)
+
+    def test_unknown_point(self):
+        self.assertRaises(KeyError, packets.hooks.register, 'unknown', self.record)
@@ -0,0 +1,88 @@
+import re
+import unittest
+
+from libopenttd.admin import MessageDispatcher, recv
+from libopenttd.packets.enums import Action, DestType
+
+def chat(message, action = Action.CHAT, dest_type = DestType.BROADCAST, client_id = 2):
+    return recv.Chat(action = action, dest_type = dest_type, client_id = client_id, message = message, data = 0)
+
+class TestMessages(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = MessageDispatcher()
+        self.received = []
+
+    def collect(self, name):
+        return lambda session, packet: self.received.append((name, packet.message))
+
+    def test_chat_filters(self):
+        self.dispatcher.subscribe_chat(self.collect('all'))
+        self.dispatcher.subscribe_chat(self.collect('client 2'), client_id = 2)
+        self.dispatcher.subscribe_chat(self.collect('team'), dest_type = DestType.TEAM)
+        self.dispatcher.subscribe_chat(self.collect('admin'), action = Action.CHAT, pattern = r'^!admin\b')
+        self.dispatcher.subscribe_chat(self.collect('grief'), pattern = re.compile('grief', re.I))
+
+        self.assertEqual(self.dispatcher.dispatch(None, chat('hello')), 2)
+        self.assertEqual(self.received, [('all', 'hello'), ('client 2', 'hello')])
+
+        del self.received[:]
+        self.dispatcher.dispatch(None, chat('!admin GRIEFER here', dest_type = DestType.TEAM, client_id = 3))
+        self.assertEqual(sorted([name for name, _ in self.received]), ['admin', 'all', 'grief', 'team'])
+
+        del self.received[:]
+        self.dispatcher.dispatch(None, chat('!admin', action = Action.CHAT_CLIENT, client_id = 3))
+        self.assertEqual([name for name, _ in self.received], ['all'])
+
+    def test_console_prefix(self):
+        self.dispatcher.subscribe_console(self.collect('net'), origin = 'net')
+        self.dispatcher.subscribe_console(self.collect('script'), origin = 'script')
+        self.dispatcher.subscribe_console(self.collect('errors'), pattern = 'error')
+
+        self.dispatcher.dispatch(None, recv.Console(origin = 'network', message = 'connected'))
+        self.dispatcher.dispatch(None, recv.Console(origin = 'script', message = 'an error occured'))
+        self.dispatcher.dispatch(None, recv.Console(origin = 'misc', message = 'nothing'))
+        self.assertEqual(sorted(self.received), [('errors', 'an error occured'), ('net', 'connected'),
+                                                 ('script', 'an error occured')])
+
+    def test_groups(self):
+        self.dispatcher.subscribe_chat(self.collect('joined'), pattern = r'(?P<n>\d+) joined')
+        self.dispatcher.subscribe_chat(self.collect('left'), pattern = r'(?P<n>\d+) left')
+        self.dispatcher.subscribe_chat(self.collect('repeat'), pattern = r'(\w)\1')
+        self.dispatcher.subscribe_chat(self.collect('plain'), pattern = 'plain')
+        self.dispatcher.dispatch(None, chat('12 joined'))
+        self.dispatcher.dispatch(None, chat('7 left'))
+        self.dispatcher.dispatch(None, chat('moon'))
+        self.dispatcher.dispatch(None, chat('plain'))
+        self.dispatcher.dispatch(None, chat('nothing'))
+        self.assertEqual(self.received, [('joined', '12 joined'), ('left', '7 left'), ('repeat', 'moon'),
+                                         ('plain', 'plain')])
+
+    def test_many_patterns(self):
+        for number in range(250):
+            self.dispatcher.subscribe_chat(self.collect(number), pattern = r'\bword%d\b' % number)
+        self.dispatcher.subscribe_chat(self.collect('start'), pattern = '^word')
+        self.dispatcher.subscribe_chat(self.collect('again'), pattern = r'\bword7\b')
+        self.dispatcher.subscribe_chat(self.collect('case'), pattern = re.compile('WORD130', re.I))
+        group = self.dispatcher.chat_groups[(None, None, None)]
+        self.assertEqual(self.dispatcher.dispatch(None, chat('word130 and word7')), 5)
+        self.assertEqual([name for name, _ in self.received], [7, 130, 'start', 'again', 'case'])
+        self.assertEqual(len(group._combined), 4)
+        self.assertEqual(group._separate, [])
+
+        del self.received[:]
+        self.assertEqual(self.dispatcher.dispatch(None, chat('a word249')), 1)
+        self.assertEqual(self.received, [(249, 'a word249')])
+
+    def test_unsubscribe(self):
+        subscription = self.dispatcher.subscribe_chat(self.collect('client'), client_id = 2, pattern = 'x')
+        console = self.dispatcher.subscribe_console(self.collect('console'), origin = 'net')
+        self.dispatcher.unsubscribe(subscription)
+        self.dispatcher.unsubscribe(console)
+        self.assertEqual(len(self.dispatcher), 0)
+        self.assertEqual(self.dispatcher.chat_groups, {})
+        self.assertEqual(dict(self.dispatcher.chat_masks), {})
+        self.assertEqual(dict(self.dispatcher.console_groups), {})
+        self.assertEqual(self.dispatcher.dispatch(None, chat('x')), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from libopenttd.packets.constants import NETWORK_MAX_GRF_COUNT
+from libopenttd.query import Crawler, NewGRFTable
+from libopenttd.query.server import recv as s_recv, send as s_send
+
+from test_crawler import FakeEndpoint, game_information
+
+MD5 = '0123456789ABCDEF0123456789ABCDEF'
+
+def grfinfo(*grf_ids):
+    return [{'id': grf_id, 'md5': MD5} for grf_id in grf_ids]
+
+class TestNewGRFTable(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'newgrfs.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_requests(self):
+        table = NewGRFTable(pending_timeout = 1.0)
+        table.add(1, MD5, 'Known')
+        packets = table.requests(grfinfo(*range(NETWORK_MAX_GRF_COUNT + 2)), now = 0.0)
+        self.assertEqual([len(packet.newgrfs) for packet in packets], [NETWORK_MAX_GRF_COUNT, 1])
+        self.assertFalse(1 in [grf['id'] for packet in packets for grf in packet.newgrfs])
+        # Pending GRFs aren't asked of the next server, until the answer is overdue.
+        self.assertEqual(table.requests(grfinfo(0, 2), now = 0.5), [])
+        table.handle_newgrf(s_recv.NewGRF(newgrfs = [{'id': 0, 'md5': MD5, 'name': 'Zero'}]))
+        self.assertEqual([grf['id'] for packet in table.requests(grfinfo(0, 2), now = 1.0) for grf in packet.newgrfs],
+                         [2])
+        self.assertEqual(table.get_names(grfinfo(0, 1, 2)), ['Zero', 'Known', None])
+
+    def test_persistence(self):
+        table = NewGRFTable(self.path)
+        self.assertEqual(table.handle_newgrf(s_recv.NewGRF(newgrfs = [{'id': 7, 'md5': MD5, 'name': 'Seven'}])), 1)
+        # Nothing is written until the table is flushed.
+        self.assertFalse(os.path.exists(self.path))
+        self.assertTrue(table.flush())
+        self.assertFalse(table.flush())
+        loaded = NewGRFTable(self.path)
+        self.assertEqual(loaded.get(7, MD5), 'Seven')
+        self.assertFalse(loaded.dirty)
+
+        # Loaded keys share the strings packets decode to.
+        packet = s_send.GetNewGRFList(newgrfs = grfinfo(7))
+        decoded = s_send.GetNewGRFList.manager.from_data(packet.write())
+        self.assertTrue([key for key in loaded.names][0][1] is decoded.newgrfs[0]['md5'])
+
+    def test_flush_after_crawl(self):
+        table = NewGRFTable(self.path)
+        table.add(7, MD5, 'Seven')
+        crawler = Crawler(master = None, newgrfs = table)
+        try:
+            self.assertEqual(list(crawler.crawl(1.0)), [])
+        finally:
+            crawler.close()
+        self.assertFalse(table.dirty)
+        self.assertEqual(NewGRFTable(self.path).get(7, MD5), 'Seven')
+
+    def test_interned_md5(self):
+        packet = s_send.GetNewGRFList(newgrfs = grfinfo(1, 2))
+        decoded = s_send.GetNewGRFList.manager.from_data(packet.write())
+        self.assertTrue(decoded.newgrfs[0]['md5'] is decoded.newgrfs[1]['md5'])
+        self.assertEqual(decoded.newgrfs[0]['md5'], MD5)
+
+class TestCrawlerNewGRFs(unittest.TestCase):
+    def test_shared_names(self):
+        def respond(endpoint, packet):
+            if isinstance(packet, s_send.ServerInformation):
+                info = game_information('Server')
+                info.grfinfo = grfinfo(1, 2)
+                return [info]
+            return [s_recv.NewGRF(newgrfs = [dict(grf, name = 'GRF %d' % grf['id']) for grf in packet.newgrfs])]
+        servers = [FakeEndpoint(respond) for _ in range(3)]
+        table = NewGRFTable()
+        crawler = Crawler(master = None, newgrfs = table)
+        try:
+            for server in servers:
+                crawler.add(server.address)
+            for _ in range(200):
+                if crawler.done:
+                    break
+                crawler.run_once(0.01)
+                for server in servers:
+                    server.serve()
+            self.assertTrue(crawler.done)
+        finally:
+            crawler.close()
+            for server in servers:
+                server.close()
+        requests = [packet for server in servers for packet in server.received
+                    if isinstance(packet, s_send.GetNewGRFList)]
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(table.get_names(grfinfo(1, 2)), ['GRF 1', 'GRF 2'])
+
+if __name__ == '__main__':
+    unittest.main()
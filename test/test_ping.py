@@ -0,0 +1,82 @@
+import unittest
+
+from libopenttd.admin import AdminSession, PingMonitor, send, recv
+from libopenttd.admin.ping import RTT_BUCKETS
+from libopenttd.utils.clock import monotonic
+
+from test_session import FakeServer, SETTINGS
+
+class TestPing(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer()
+        self.session = AdminSession(self.server.address[0], self.server.address[1])
+        self.session.connect()
+        self.server.accept()
+        self.server.receive(1)
+        self.server.handshake(SETTINGS)
+        while not self.session.ready:
+            self.session.run_once(5)
+        self.session.process_send()
+        self.monitor = PingMonitor(self.session, interval = 5.0, timeout = 15.0, slow_after = 1.0)
+
+    def tearDown(self):
+        self.session.close()
+        self.server.close()
+
+    def ping(self, now):
+        self.monitor.tick(now)
+        self.session.process_send()
+        packet = self.server.receive(1)[0]
+        self.assertTrue(isinstance(packet, send.Ping))
+        return packet.payload
+
+    def test_round_trip(self):
+        self.assertEqual(self.monitor.status, 'unknown')
+        now = monotonic()
+        first = self.ping(now - 5.0)
+        self.assertEqual(self.monitor.tick(now - 4.0), 4.0)
+        second = self.ping(now)
+        self.assertEqual(second, first + 1)
+
+        # Answer the second ping only, the first counts as lost.
+        self.server.send(recv.Pong(payload = second))
+        while self.monitor.outstanding:
+            self.session.run_once(5)
+        self.assertEqual(self.monitor.samples, 1)
+        self.assertEqual(self.monitor.lost, 1)
+        self.assertEqual(self.monitor.status, 'ok')
+        self.assertEqual(sum(self.monitor.histogram), 1)
+
+    def test_statistics(self):
+        for rtt in [0.004] * 9 + [0.3]:
+            self.monitor.add_sample(rtt)
+        self.assertTrue(0.004 < self.monitor.srtt < 0.3)
+        self.assertEqual(self.monitor.percentile(0.5), 0.005)
+        self.assertEqual(self.monitor.percentile(1.0), 0.5)
+        self.assertEqual(self.monitor.last_rtt, 0.3)
+        self.monitor.add_sample(10.0)
+        self.assertEqual(self.monitor.histogram[len(RTT_BUCKETS)], 1)
+        self.assertEqual(self.monitor.status, 'slow')
+
+    def test_dead(self):
+        dead = []
+        self.monitor.on_dead.append(dead.append)
+        self.ping(100.0)
+        self.assertEqual(self.monitor.tick(110.0), 5.0)
+        self.assertEqual(dead, [])
+        self.monitor.tick(115.0)
+        self.assertEqual(dead, [self.monitor])
+        self.assertEqual(self.monitor.status, 'dead')
+
+        # A late answer revives it.
+        alive = []
+        self.monitor.on_alive.append(alive.append)
+        self.server.send(recv.Pong(payload = self.monitor.payload))
+        while self.monitor.outstanding:
+            self.session.run_once(5)
+        self.assertEqual(alive, [self.monitor])
+        self.assertFalse(self.monitor.dead)
+        self.assertEqual(self.monitor.status, 'slow')
+
+if __name__ == '__main__':
+    unittest.main()
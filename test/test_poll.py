@@ -0,0 +1,100 @@
+import unittest
+
+from datetime import datetime
+
+from libopenttd.admin import AdminPool, PollScheduler, PollError, send, recv
+from libopenttd.packets.enums import UpdateType, PollExtra
+
+from test_session import FakeServer, SETTINGS
+
+def client_info(client_id):
+    return recv.ClientInfo(client_id = client_id, hostname = '127.0.0.1', name = 'Client %d' % client_id,
+                           language = 0, joindate = datetime(1950, 1, 1), play_as = 255)
+
+class TestPollScheduler(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer()
+        self.pool = AdminPool()
+        self.pool.add('server', self.server.address[0], self.server.address[1])
+        self.pool.connect()
+        self.run_until(lambda: not self.pool['server'].connecting)
+        self.server.accept()
+        self.server.receive(1)
+        self.server.handshake(SETTINGS)
+        self.run_until(lambda: self.pool['server'].ready)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.close()
+
+    def run_until(self, condition):
+        for _ in range(100):
+            if condition():
+                return
+            self.pool.run_once(0.05)
+        self.fail("Condition not reached")
+
+    def receive_polls(self, count):
+        packets = self.server.receive(count + 1)
+        self.assertEqual(len(packets), count + 1)
+        self.assertTrue(isinstance(packets[-1], send.Ping))
+        return packets[:-1], packets[-1]
+
+    def answer(self, ping, *responses):
+        self.server.send(*(responses + (recv.Pong(payload = ping.payload), )))
+
+    def test_coalesce(self):
+        scheduler = PollScheduler(self.pool, window = 0)
+        first = scheduler.poll('server', UpdateType.CLIENT_INFO, 2)
+        self.assertTrue(scheduler.poll('server', UpdateType.CLIENT_INFO, 2) is first)
+        third = scheduler.poll('server', UpdateType.CLIENT_INFO, 3)
+        self.run_until(lambda: not len(scheduler))
+
+        polls, ping = self.receive_polls(2)
+        self.assertEqual([(poll.poll_type, poll.poll_extra) for poll in polls],
+                         [(UpdateType.CLIENT_INFO, 2), (UpdateType.CLIENT_INFO, 3)])
+        self.answer(ping, client_info(2), client_info(3))
+        self.run_until(third.done)
+        self.assertEqual([packet.client_id for packet in first.result()], [2])
+        self.assertEqual([packet.client_id for packet in third.result()], [3])
+        # Poll responses don't subscribe the session to automatic updates.
+        self.assertFalse(UpdateType.CLIENT_INFO in self.pool['server'].subscriptions)
+
+    def test_upgrade_to_all(self):
+        scheduler = PollScheduler(self.pool, window = 0, upgrade_threshold = 3)
+        futures = [scheduler.poll('server', UpdateType.CLIENT_INFO, client_id) for client_id in (2, 3, 4)]
+        self.run_until(lambda: not len(scheduler))
+        (poll, ), ping = self.receive_polls(1)
+        self.assertEqual((poll.poll_type, poll.poll_extra), (UpdateType.CLIENT_INFO, PollExtra.ALL))
+        self.answer(ping, client_info(1), client_info(2), client_info(4))
+        self.run_until(futures[-1].done)
+        self.assertEqual([len(future.result()) for future in futures], [1, 0, 1])
+
+    def test_rate_limit(self):
+        scheduler = PollScheduler(self.pool, window = 0, rate = 20.0, burst = 1)
+        dates = scheduler.poll('server', UpdateType.DATE)
+        stats = scheduler.poll('server', UpdateType.COMPANY_STATS, 1)
+        self.pool.run_once(0)
+        self.assertEqual(len(scheduler), 1)
+        (poll, ), ping = self.receive_polls(1)
+        self.assertEqual(poll.poll_type, UpdateType.DATE)
+        self.answer(ping, recv.Date(date = datetime(1950, 1, 2)))
+        self.run_until(dates.done)
+        self.assertFalse(stats.done())
+        self.assertEqual(len(dates.result()), 1)
+        self.run_until(lambda: not len(scheduler))
+        (poll, ), ping = self.receive_polls(1)
+        self.assertEqual((poll.poll_type, poll.poll_extra), (UpdateType.COMPANY_STATS, 1))
+
+    def test_disconnect(self):
+        scheduler = PollScheduler(self.pool, window = 0)
+        future = scheduler.poll('server', UpdateType.COMPANY_ECONOMY, 0)
+        self.run_until(lambda: not len(scheduler))
+        self.server.sock.close()
+        self.run_until(future.done)
+        self.assertTrue(isinstance(future.exception(), PollError))
+        self.assertRaises(PollError, scheduler.poll, 'server', UpdateType.DATE)
+        self.assertRaises(PollError, scheduler.poll, 'unknown', UpdateType.DATE)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import os
+import socket
+import unittest
+
+from libopenttd.admin import AdminPool, send, recv
+from libopenttd.packets.enums import UpdateType, UpdateFrequency
+
+from test_session import FakeServer, SETTINGS
+
+class TestPool(unittest.TestCase):
+    def setUp(self):
+        self.servers = [FakeServer(), FakeServer()]
+        self.pool = AdminPool()
+        self.received = []
+        for number, server in enumerate(self.servers):
+            self.pool.add('server%d' % number, server.address[0], server.address[1], password = 'pw%d' % number)
+
+    def tearDown(self):
+        self.pool.close()
+        for server in self.servers:
+            server.close()
+
+    def handler(self, session, packet):
+        self.received.append((session.key, packet))
+
+    def run_until(self, condition):
+        for _ in range(100):
+            if condition():
+                return
+            self.pool.run_once(0.05)
+        self.fail("Condition not reached")
+
+    def connect(self):
+        self.assertEqual(self.pool.connect(), [])
+        self.run_until(lambda: not any([self.pool[key].connecting for key in self.pool]))
+        for number, server in enumerate(self.servers):
+            server.accept()
+            join = server.receive(1)[0]
+            self.assertEqual(join.password, 'pw%d' % number)
+            server.handshake(SETTINGS)
+        self.run_until(lambda: all([self.pool[key].ready for key in self.pool]))
+
+    def test_dispatch(self):
+        self.pool.on(recv.Chat, self.handler)
+        self.connect()
+        for server in self.servers:
+            update = server.receive(1)[0]
+            self.assertTrue(isinstance(update, send.UpdateFrequency))
+            self.assertEqual(update.update_type, UpdateType.CHAT)
+            self.assertEqual(update.update_freq, UpdateFrequency.AUTOMATIC)
+
+        for number, server in enumerate(self.servers):
+            server.send(*[recv.Chat(action = 3, dest_type = 0, client_id = 1, message = 'hi %d' % i, data = 0)
+                          for i in range(number + 1)])
+        self.run_until(lambda: len(self.received) == 3)
+        self.assertEqual(sorted([(key, packet.message) for key, packet in self.received]),
+                         [('server0', 'hi 0'), ('server1', 'hi 0'), ('server1', 'hi 1')])
+
+        metrics = self.pool.get_metrics()
+        self.assertEqual(metrics['ready'], 2)
+        self.assertEqual(metrics['servers']['server0']['packets'], 3)
+        self.assertEqual(metrics['servers']['server1']['packets'], 4)
+        self.assertEqual(metrics['packets'], 7)
+
+    def test_disconnect(self):
+        self.connect()
+        self.servers[0].sock.close()
+        self.run_until(lambda: self.pool['server0'].socket is None)
+        self.assertEqual(len(self.pool.registered), 1)
+        metrics = self.pool.get_metrics()
+        self.assertEqual(metrics['connected'], 1)
+        self.assertEqual(metrics['servers']['server0']['disconnects'], 1)
+
+        self.pool.remove('server1')
+        self.assertEqual(len(self.pool), 1)
+        self.assertEqual(len(self.pool.registered), 0)
+
+    def test_server_not_reading(self):
+        self.connect()
+        session = self.pool['server0']
+        session.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        self.servers[0].sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        # Everything in a single flush, so it can't fit in the kernel buffers.
+        session.socket.PACKET_BURST_SIZE = 0
+        # Far more than the kernel buffers take while the server isn't reading.
+        for number in range(500):
+            session.send_packet(send.Gamescript(data = {'filler': 'x' * 1200}))
+        for _ in range(300):
+            self.pool.run_once(0)
+        self.assertTrue(session.wants_write)
+        self.assertTrue(session.connected)
+        self.assertTrue(session in self.pool.registered)
+
+        received = []
+        while len(received) < 500:
+            self.servers[0].sock.process_recv()
+            received.extend([packet for packet in self.servers[0].sock.process_packets()
+                             if isinstance(packet, send.Gamescript)])
+            self.pool.run_once(0)
+        self.assertFalse(session.wants_write)
+
+    def test_lookup(self):
+        self.pool.remove('server1')
+        self.pool.add('named', 'localhost', self.servers[1].address[1], password = 'pw1')
+        self.assertEqual(self.pool.connect(), [])
+        self.assertTrue(self.pool['named'] in self.pool.lookups)
+        self.assertEqual(self.pool['named'].socket, None)
+        self.run_until(lambda: not self.pool.lookups and not self.pool['named'].connecting)
+        self.assertEqual(self.pool.readers, {})
+        self.servers[1].accept()
+        self.assertEqual(self.servers[1].receive(1)[0].password, 'pw1')
+
+    def test_timers_and_readers(self):
+        calls = []
+        self.pool.call_later(0, calls.append, 'first')
+        self.pool.call_later(10, calls.append, 'never').cancel()
+        self.pool.run_once(0)
+        self.assertEqual(calls, ['first'])
+        self.assertEqual(self.pool.timers, [])
+
+        read_fd, write_fd = os.pipe()
+        try:
+            self.pool.add_reader(read_fd, lambda: calls.append(os.read(read_fd, 1)))
+            os.write(write_fd, b'x')
+            self.pool.run_once(1)
+            self.assertEqual(calls, ['first', b'x'])
+            self.pool.remove_reader(read_fd)
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+import socket
+import unittest
+
+from datetime import datetime
+
+from libopenttd.admin import AdminPool, AdminProxy, AdminSocket, RconClient, send, recv
+from libopenttd.packets.enums import UpdateType, UpdateFrequency, PollExtra, ErrorCode
+from libopenttd.packets.fields import gamedate_to_datetime, datetime_to_gamedate
+
+from test_session import FakeServer, SETTINGS
+
+class TestProxy(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer()
+        self.pool = AdminPool()
+        self.pool.add('upstream', self.server.address[0], self.server.address[1])
+        self.proxy = AdminProxy(self.pool)
+        self.address = self.proxy.listen('upstream', password = 'local')
+        self.received = []
+
+        self.pool.connect('upstream')
+        self.run_until(lambda: not self.pool['upstream'].connecting)
+        self.server.accept()
+        self.server.sock.settimeout(0.01)
+        self.receive(lambda packets: packets)
+        self.server.handshake(SETTINGS)
+        # The state mirror polls everything once the session is ready.
+        packets = self.receive(lambda packets: isinstance(packets[-1], send.Ping))
+        polls = [(packet.poll_type, packet.poll_extra) for packet in packets if isinstance(packet, send.Poll)]
+        self.assertTrue((UpdateType.CLIENT_INFO, PollExtra.ALL) in polls)
+        self.server.send(recv.ClientInfo(client_id = 2, hostname = '10.0.0.2', name = 'Player', language = 0,
+                                         joindate = datetime(1950, 1, 1), play_as = 0),
+                         recv.Pong(payload = packets[-1].payload))
+        self.run_until(lambda: self.proxy.servers['upstream'].synced)
+
+    def tearDown(self):
+        self.proxy.close()
+        self.pool.close()
+        self.server.close()
+
+    def run_until(self, condition):
+        for _ in range(200):
+            if condition():
+                return
+            self.pool.run_once(0.01)
+        self.fail("Condition not reached")
+
+    def receive(self, condition):
+        """
+        Runs the loop until the packets the fake server received satisfy
+        condition.
+        """
+        packets = []
+        for _ in range(200):
+            self.pool.run_once(0.01)
+            try:
+                self.server.sock.process_recv()
+            except socket.timeout:
+                pass
+            packets.extend(self.server.sock.process_packets())
+            if packets and condition(packets):
+                return packets
+        self.fail("Packets not received")
+
+    def handler(self, session, packet):
+        self.received.append((session.key, packet))
+
+    def add_client(self, key, password = 'local'):
+        session = self.pool.add(key, self.address[0], self.address[1], password = password)
+        self.pool.connect(key)
+        return session
+
+    def test_forwarding(self):
+        first = self.add_client('first')
+        second = self.add_client('second')
+        first.on(recv.Chat, self.handler)
+        first.on([recv.Rcon, recv.RconEnd], self.handler)
+        second.on(recv.Rcon, self.handler)
+        self.run_until(lambda: first.ready and second.ready)
+        self.assertEqual(first.welcome.name, 'Test server')
+        self.assertEqual(first.supported, SETTINGS)
+
+        update = self.receive(lambda packets: True)[0]
+        self.assertEqual((update.update_type, update.update_freq), (UpdateType.CHAT, UpdateFrequency.AUTOMATIC))
+        self.server.send(recv.Chat(action = 3, dest_type = 0, client_id = 2, message = 'hello', data = 0))
+        self.run_until(lambda: self.received)
+        self.assertEqual([(key, packet.message) for key, packet in self.received], [('first', 'hello')])
+
+        self.received = []
+        first.send_packet(send.Rcon(command = 'companies'))
+        rcon = self.receive(lambda packets: True)[0]
+        self.assertEqual(rcon.command, 'companies')
+        self.server.send(recv.Rcon(colour = 1, result = 'none'), recv.RconEnd(command = 'companies'))
+        self.run_until(lambda: len(self.received) == 2)
+        self.assertEqual([key for key, _ in self.received], ['first', 'first'])
+
+    def test_client_frequency(self):
+        client = self.add_client('client')
+        client.frequencies[UpdateType.DATE] = UpdateFrequency.WEEKLY
+        client.on(recv.Date, self.handler)
+        self.run_until(lambda: client.ready)
+        upstream = self.proxy.servers['upstream']
+        self.run_until(lambda: upstream.clients and UpdateType.DATE in upstream.clients[0].subscriptions)
+        # The mirror keeps the upstream session on daily dates.
+        self.assertEqual(self.pool['upstream'].subscriptions[UpdateType.DATE], UpdateFrequency.DAILY)
+
+        start = datetime_to_gamedate(datetime(1950, 1, 1))
+        start += (3 - start) % 7
+        self.server.send(*[recv.Date(date = gamedate_to_datetime(start + day)) for day in range(21)])
+        self.run_until(lambda: len(self.received) == 3)
+        self.pool.run_once(0.05)
+        self.assertEqual([datetime_to_gamedate(packet.date) for _, packet in self.received],
+                         [start, start + 7, start + 14])
+
+    def test_foreign_rcon(self):
+        client = self.add_client('client')
+        client.on([recv.Rcon, recv.RconEnd], self.handler)
+        self.run_until(lambda: client.ready)
+        rcon = RconClient(self.pool['upstream'])
+        future = rcon.execute('version')
+        client.send_packet(send.Rcon(command = 'companies'))
+        commands = self.receive(lambda packets: len([packet for packet in packets
+                                                     if isinstance(packet, send.Rcon)]) == 2)
+        self.assertEqual([packet.command for packet in commands if isinstance(packet, send.Rcon)],
+                         ['version', 'companies'])
+        self.server.send(recv.Rcon(colour = 1, result = '1.0'), recv.RconEnd(command = 'version'),
+                         recv.Rcon(colour = 1, result = 'none'), recv.RconEnd(command = 'companies'))
+        self.run_until(lambda: len(self.received) == 2)
+        self.assertEqual(future.result(0).text, '1.0')
+        self.assertEqual([packet.result for _, packet in self.received[:1]], ['none'])
+        self.assertEqual(self.received[1][1].command, 'companies')
+        rcon.close()
+
+    def test_pipelined_client(self):
+        # More frames than the write queue of a blocking socket holds.
+        client = AdminSocket()
+        client.connect(self.address)
+        client.send_packet(send.Join(password = 'local', name = 'pipeliner', version = '1.0'))
+        for number in range(100):
+            client.send_packet(send.Rcon(command = 'echo %d' % number))
+            while client.buffer.write_avail:
+                client.process_send()
+        packets = self.receive(lambda packets: len(packets) == 100)
+        self.assertEqual([packet.command for packet in packets], ['echo %d' % number for number in range(100)])
+        client.close()
+
+    def test_polls_from_mirror(self):
+        client = self.add_client('client')
+        client.on(recv.ClientInfo, self.handler, subscribe = False)
+        self.run_until(lambda: client.ready)
+        client.poll(UpdateType.CLIENT_INFO, PollExtra.ALL)
+        client.poll(UpdateType.CLIENT_INFO, 2)
+        client.poll(UpdateType.CLIENT_INFO, 3)
+        self.run_until(lambda: len(self.received) == 2)
+        self.assertEqual([(packet.client_id, packet.name) for _, packet in self.received],
+                         [(2, 'Player'), (2, 'Player')])
+
+        # Nothing reached the server, the ping is the proxy's own.
+        client.barrier(lambda session: self.received.append(None))
+        self.run_until(lambda: len(self.received) == 3)
+        self.server.sock.settimeout(0.05)
+        self.assertRaises(socket.timeout, self.server.sock.process_recv)
+
+    def test_wrong_password(self):
+        client = self.add_client('client', password = 'wrong')
+        self.run_until(lambda: client.error is not None)
+        self.assertEqual(client.error, ErrorCode.WRONG_PASSWORD)
+        self.assertEqual(self.proxy.servers['upstream'].clients, [])
+
+    def test_slow_client(self):
+        upstream = self.proxy.servers['upstream']
+        upstream.max_pending = 64 * 1024
+        # A client that joins and subscribes, then never reads again.
+        slow = AdminSocket()
+        slow.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        slow.connect(self.address)
+        slow.send_packet(send.Join(password = 'local', name = 'slow', version = '1.0'))
+        slow.send_packet(send.UpdateFrequency(update_type = UpdateType.CHAT, update_freq = UpdateFrequency.AUTOMATIC))
+        while slow.buffer.write_avail:
+            slow.process_send()
+        self.run_until(lambda: upstream.clients and UpdateType.CHAT in upstream.clients[0].subscriptions)
+        upstream.clients[0].socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+
+        chat = recv.Chat(action = 3, dest_type = 0, client_id = 2, message = 'x' * 800, data = 0)
+        for _ in range(50):
+            if not upstream.clients:
+                break
+            self.server.send(*([chat] * 20))
+            for _ in range(20):
+                self.pool.run_once(0.001)
+        self.assertEqual(upstream.clients, [])
+        self.assertEqual(self.pool.writers, {})
+        slow.close()
+
+if __name__ == '__main__':
+    unittest.main()
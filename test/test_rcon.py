@@ -0,0 +1,70 @@
+import unittest
+
+from libopenttd.admin import AdminSession, RconClient, RconError, send, recv
+
+from test_session import FakeServer, SETTINGS
+
+class TestRcon(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer()
+        self.session = AdminSession(self.server.address[0], self.server.address[1], password = 'secret')
+        self.session.connect()
+        self.server.accept()
+        self.server.receive(1)
+        self.server.handshake(SETTINGS)
+        while not self.session.ready:
+            self.session.run_once(5)
+        self.session.process_send()
+        self.client = RconClient(self.session, max_in_flight = 2)
+
+    def tearDown(self):
+        self.session.close()
+        self.server.close()
+
+    def run_until(self, futures):
+        while not all([future.done() for future in futures]):
+            self.session.process_send()
+            self.session.run_once(5)
+
+    def test_pipelined(self):
+        futures = self.client.execute_many(['clients', 'companies', 'date'])
+        self.session.process_send()
+        commands = [packet.command for packet in self.server.receive(2)]
+        self.assertEqual(commands, ['clients', 'companies'])
+
+        self.server.send(recv.Rcon(colour = 1, result = 'client 1'), recv.Rcon(colour = 1, result = 'client 2'),
+                         recv.RconEnd(command = 'clients'), recv.RconEnd(command = 'companies'))
+        self.run_until(futures[:2])
+        self.assertEqual(futures[0].result().lines, [(1, 'client 1'), (1, 'client 2')])
+        self.assertEqual(futures[0].result().text, 'client 1\nclient 2')
+        self.assertEqual(futures[1].result().lines, [])
+
+        self.session.process_send()
+        self.assertEqual(self.server.receive(1)[0].command, 'date')
+        self.server.send(recv.Rcon(colour = 2, result = 'Date: 1950-01-01'), recv.RconEnd(command = 'date'))
+        self.run_until(futures)
+        self.assertEqual(futures[2].result().command, 'date')
+        self.assertEqual(len(self.client), 0)
+
+    def test_missing_response(self):
+        futures = self.client.execute_many(['first', 'second'])
+        self.session.process_send()
+        self.server.receive(2)
+        self.server.send(recv.Rcon(colour = 1, result = 'second output'), recv.RconEnd(command = 'second'))
+        self.run_until(futures)
+        self.assertTrue(isinstance(futures[0].exception(), RconError))
+        self.assertEqual(futures[1].result().command, 'second')
+        self.assertEqual(futures[1].result().lines, [(1, 'second output')])
+
+    def test_disconnect(self):
+        futures = self.client.execute_many(['first', 'second', 'third'])
+        self.session.process_send()
+        self.server.receive(2)
+        self.server.sock.close()
+        self.run_until(futures)
+        for future in futures:
+            self.assertTrue(isinstance(future.exception(), RconError))
+        self.assertRaises(RconError, self.client.execute, 'fourth')
+
+if __name__ == '__main__':
+    unittest.main()
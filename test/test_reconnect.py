@@ -0,0 +1,103 @@
+import socket
+import unittest
+
+from libopenttd.admin import AdminPool, ReconnectManager, Backoff, SessionState, send, recv
+from libopenttd.packets.enums import UpdateType
+
+from test_session import FakeServer, SETTINGS
+
+class TestBackoff(unittest.TestCase):
+    def test_delays(self):
+        backoff = Backoff(base = 1.0, cap = 10.0, random = lambda: 1.0)
+        self.assertEqual([backoff.next_delay() for _ in range(6)], [1.0, 2.0, 4.0, 8.0, 10.0, 10.0])
+        backoff.reset()
+        backoff.random = lambda: 0.0
+        self.assertEqual([backoff.next_delay() for _ in range(3)], [0.5, 1.0, 2.0])
+
+class TestReconnect(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer()
+        self.pool = AdminPool()
+        self.session = self.pool.add('server', self.server.address[0], self.server.address[1])
+        self.session.on(recv.Chat, lambda session, packet: None)
+        self.manager = ReconnectManager(self.pool, base = 0.01, cap = 0.05)
+
+    def tearDown(self):
+        self.manager.close()
+        self.pool.close()
+        self.server.close()
+
+    def run_until(self, condition):
+        for _ in range(200):
+            if condition():
+                return
+            self.pool.run_once(0.05)
+        self.fail("Condition not reached")
+
+    def handshake(self):
+        self.run_until(lambda: self.session.state == SessionState.AUTHENTICATING)
+        self.server.accept()
+        self.assertTrue(isinstance(self.server.receive(1)[0], send.Join))
+        self.server.handshake(SETTINGS)
+        self.run_until(lambda: self.session.ready)
+        update = self.server.receive(1)[0]
+        self.assertEqual(update.update_type, UpdateType.CHAT)
+
+    def test_reconnect_after_disconnect(self):
+        self.manager.start()
+        self.handshake()
+        self.server.sock.close()
+        self.run_until(lambda: self.session.socket is None)
+        self.assertTrue('server' in self.manager.timers)
+        self.handshake()
+        metrics = self.pool.get_metrics()['servers']['server']
+        self.assertEqual(metrics['connects'], 2)
+        self.assertEqual(metrics['disconnects'], 1)
+        self.assertEqual(self.manager.backoffs['server'].attempts, 0)
+
+    def test_handshake_timer_per_attempt(self):
+        self.manager.start()
+        first = self.manager.handshake_timers['server']
+        self.run_until(lambda: self.session.state == SessionState.AUTHENTICATING)
+        self.server.accept()
+        self.server.sock.close()
+        self.run_until(lambda: self.session.socket is None)
+        self.assertTrue(first.cancelled)
+        self.assertFalse('server' in self.manager.handshake_timers)
+        # The next attempt gets a timer of its own, which is gone once ready.
+        self.run_until(lambda: 'server' in self.manager.handshake_timers)
+        self.assertFalse(self.manager.handshake_timers['server'] is first)
+        self.handshake()
+        self.assertEqual(self.manager.handshake_timers, {})
+
+    def test_backoff_on_failure(self):
+        # The port is bound but nothing listens on it, so connecting is refused.
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.addCleanup(sock.close)
+        address = sock.getsockname()
+        self.pool.remove('server')
+        session = self.pool.add('closed', address[0], address[1])
+        failures = []
+        self.pool.connect_failed.append(lambda session, error: failures.append(error))
+        self.manager.start()
+        self.run_until(lambda: len(failures) >= 3)
+        self.assertTrue(self.manager.backoffs['closed'].attempts >= 3)
+        self.assertEqual(self.pool.get_metrics()['servers']['closed']['failures'], len(failures))
+        self.assertEqual(session.state in (SessionState.DISCONNECTED, SessionState.CONNECTING), True)
+
+    def test_connect_timeout(self):
+        self.pool.connect_timeout = 0
+        failures = []
+        self.pool.connect_failed.append(lambda session, error: failures.append(error))
+        self.pool.connect('server')
+        self.assertEqual(self.session.state, SessionState.CONNECTING)
+        # Timers run before the loop polls, so the connect never gets to finish.
+        self.pool.run_once(0)
+        self.assertTrue(isinstance(failures[0], socket.timeout))
+        self.assertEqual(self.session.state, SessionState.DISCONNECTED)
+        self.assertEqual(self.pool.registered, {})
+        self.assertTrue('server' in self.manager.timers)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+from libopenttd.query import DeadlineHeap
+
+class TestDeadlineHeap(unittest.TestCase):
+    def test_order(self):
+        timers = DeadlineHeap()
+        timers.schedule('b', 2.0)
+        timers.schedule('a', 1.0)
+        timers.schedule('c', 2.0)
+        self.assertEqual(timers.next_deadline, 1.0)
+        self.assertEqual(timers.pop_due(0.5), [])
+        self.assertEqual(timers.pop_due(2.0), ['a', 'b', 'c'])
+        self.assertEqual(len(timers), 0)
+        self.assertEqual(timers.next_deadline, None)
+
+    def test_reschedule_and_cancel(self):
+        timers = DeadlineHeap()
+        timers.schedule('a', 1.0)
+        timers.schedule('b', 2.0)
+        timers.schedule('a', 3.0)
+        self.assertEqual(timers.deadline('a'), 3.0)
+        self.assertTrue(timers.cancel('b'))
+        self.assertFalse(timers.cancel('b'))
+        self.assertEqual(timers.next_deadline, 3.0)
+        self.assertEqual(timers.pop_due(5.0), ['a'])
+        self.assertEqual(timers.heap, [])
+
+    def test_wait(self):
+        timers = DeadlineHeap()
+        self.assertEqual(timers.wait(10.0), None)
+        self.assertEqual(timers.wait(10.0, 1.0), 1.0)
+        timers.schedule('a', 10.5)
+        self.assertEqual(timers.wait(10.0), 0.5)
+        self.assertEqual(timers.wait(10.0, 0.25), 0.25)
+        self.assertEqual(timers.wait(11.0), 0)
+
+    def test_compact(self):
+        timers = DeadlineHeap()
+        for number in range(1000):
+            timers.schedule(number, float(number))
+        for number in range(900):
+            timers.cancel(number)
+        self.assertTrue(len(timers.heap) <= 2 * len(timers) + DeadlineHeap.COMPACT_SIZE)
+        self.assertEqual(timers.pop_due(949.0), list(range(900, 950)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import socket
+import unittest
+
+from datetime import datetime
+
+from libopenttd import packets
+from libopenttd.admin import AdminSession, AdminServerSocket, SessionState, send, recv
+from libopenttd.packets.enums import UpdateType, UpdateFrequency
+from libopenttd.packets.packetsocket import encode_packet
+
+class FakeServer(object):
+    """
+    Minimal server side of an admin connection, driven synchronously from
+    the tests.
+    """
+    def __init__(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.address = self.listener.getsockname()
+        self.sock = None
+
+    def accept(self):
+        conn, addr = self.listener.accept()
+        self.sock = AdminServerSocket.from_socket(conn, addr)
+        self.sock.settimeout(5)
+
+    def send(self, *packet_list):
+        for packet in packet_list:
+            self.sock.send_packet(packet)
+        while self.sock.buffer.write_avail:
+            self.sock.process_send()
+
+    def receive(self, count):
+        received = []
+        while len(received) < count:
+            self.sock.process_recv()
+            received.extend(self.sock.process_packets())
+        return received
+
+    def handshake(self, settings):
+        self.send(recv.Protocol(version = 1, settings = settings),
+                  recv.Welcome(name = 'Test server', version = '1.4.0', dedicated = True, map_name = 'Map',
+                               seed = 1, landscape = 0, startyear = datetime(1950, 1, 1),
+                               size_x = 256, size_y = 256))
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.listener.close()
+
+SETTINGS = {
+    UpdateType.DATE:            UpdateFrequency.POLL | UpdateFrequency.DAILY | UpdateFrequency.WEEKLY,
+    UpdateType.CLIENT_INFO:     UpdateFrequency.POLL | UpdateFrequency.AUTOMATIC,
+    UpdateType.CHAT:            UpdateFrequency.AUTOMATIC,
+    UpdateType.NAMES:           UpdateFrequency.POLL,
+}
+
+class TestSession(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer()
+        self.session = AdminSession(self.server.address[0], self.server.address[1], password = 'secret')
+        self.received = []
+
+    def tearDown(self):
+        self.session.close()
+        self.server.close()
+
+    def handler(self, session, packet):
+        self.received.append(packet)
+
+    def connect(self):
+        self.session.connect()
+        self.server.accept()
+        join = self.server.receive(1)[0]
+        self.assertTrue(isinstance(join, send.Join))
+        self.assertEqual(join.password, 'secret')
+        self.server.handshake(SETTINGS)
+        while not self.session.ready:
+            self.session.run_once(5)
+        self.session.process_send()
+
+    def test_subscriptions(self):
+        self.session.on([recv.Chat, recv.ClientJoin, recv.ClientQuit], self.handler)
+        self.session.on(recv.CmdNames, self.handler)
+        self.session.on(recv.Date, self.handler)
+        self.session.frequencies[UpdateType.DATE] = UpdateFrequency.WEEKLY
+        self.connect()
+        self.assertEqual(self.session.state, SessionState.ACTIVE)
+        self.assertEqual(self.session.welcome.name, 'Test server')
+
+        subscriptions = self.server.receive(4)
+        frequencies = dict([(packet.update_type, packet.update_freq) for packet in subscriptions
+                            if isinstance(packet, send.UpdateFrequency)])
+        self.assertEqual(frequencies, {
+            UpdateType.DATE:        UpdateFrequency.WEEKLY,
+            UpdateType.CLIENT_INFO: UpdateFrequency.AUTOMATIC,
+            UpdateType.CHAT:        UpdateFrequency.AUTOMATIC,
+        })
+        polls = [packet for packet in subscriptions if isinstance(packet, send.Poll)]
+        self.assertEqual([packet.poll_type for packet in polls], [UpdateType.NAMES])
+
+    def test_dispatch(self):
+        self.session.on(recv.ClientQuit, self.handler)
+        self.connect()
+        self.server.send(recv.Date(date = datetime(1950, 1, 2)), recv.ClientQuit(client_id = 5))
+        while not self.received:
+            self.session.run_once(5)
+        self.assertEqual(len(self.received), 1)
+        self.assertEqual(self.received[0].client_id, 5)
+
+    def test_frames(self):
+        frames = []
+        decoded = []
+        self.session.on(recv.ClientQuit, self.handler)
+        self.session.on_frames(recv.Date, lambda session, pid, frame: frames.append((pid, frame.tobytes())))
+        self.connect()
+        packets.hooks.register('decode', lambda point, target, result, elapsed: decoded.append(result))
+        try:
+            self.server.send(recv.Date(date = datetime(1950, 1, 2)), recv.ClientJoin(client_id = 6),
+                             recv.ClientQuit(client_id = 5))
+            while not self.received:
+                self.session.run_once(5)
+        finally:
+            packets.hooks.clear()
+        # Only the packet somebody handles got decoded.
+        self.assertEqual([type(packet) for packet in decoded], [recv.ClientQuit])
+        self.assertEqual([pid for pid, _ in frames], [recv.Date.pid])
+
+        frame = encode_packet(recv.Date(date = datetime(1950, 1, 2)), self.server.sock.extra_info)
+        self.assertEqual(frames[0][1], frame)
+
+        # A frame is queued as it is.
+        self.session.socket.send_frame(memoryview(frame))
+        self.assertEqual(self.session.socket.buffer.dequeue_write(), frame)
+
+    def test_events(self):
+        events = []
+        self.session.on('ready', lambda session: events.append('ready'))
+        self.session.on('disconnected', lambda session: events.append('disconnected'))
+        self.connect()
+        self.server.send(recv.Error(errorcode = packets.enums.ErrorCode.NOT_EXPECTED))
+        self.server.sock.close()
+        while self.session.socket is not None:
+            self.session.run_once(5)
+        self.assertEqual(events, ['ready', 'disconnected'])
+        self.assertEqual(self.session.error, packets.enums.ErrorCode.NOT_EXPECTED)
+        self.assertEqual(self.session.state, SessionState.DISCONNECTED)
@@ -0,0 +1,73 @@
+import unittest
+
+from datetime import datetime
+
+from libopenttd.admin import GameState, recv
+
+class TestGameState(unittest.TestCase):
+    def setUp(self):
+        self.state = GameState()
+        self.changes = []
+        self.state.on_change(self.changes.append)
+
+    def client_info(self, client_id, play_as, name = 'Player'):
+        return recv.ClientInfo(client_id = client_id, hostname = '127.0.0.1', name = name, language = 0,
+                               joindate = datetime(1950, 1, 1), play_as = play_as)
+
+    def test_clients(self):
+        self.state.apply(self.client_info(2, 0))
+        self.state.apply(self.client_info(3, 0))
+        self.state.apply(self.client_info(4, 255))
+        self.assertEqual(sorted(self.state.clients), [2, 3, 4])
+        self.assertEqual(self.state.clients_by_company[0], set([2, 3]))
+
+        del self.changes[:]
+        self.state.apply(recv.ClientUpdate(client_id = 3, name = 'Renamed', play_as = 255))
+        self.assertEqual(self.state.clients_by_company[0], set([2]))
+        self.assertEqual(self.state.clients_by_company[255], set([3, 4]))
+        self.assertEqual(self.changes, [('updated', 'clients', 3, {
+            'name':     ('Player', 'Renamed'),
+            'play_as':  (0, 255),
+        })])
+
+        self.state.apply(recv.ClientQuit(client_id = 2))
+        self.assertFalse(2 in self.state.clients)
+        self.assertFalse(0 in self.state.clients_by_company)
+        self.assertEqual(self.changes[-1], ('removed', 'clients', 2, {}))
+
+    def test_unchanged_fields_are_not_reported(self):
+        self.state.apply(self.client_info(2, 0))
+        del self.changes[:]
+        self.state.apply(self.client_info(2, 0))
+        self.assertEqual(self.changes, [])
+
+    def test_companies(self):
+        self.state.apply(recv.CompanyNew(company_id = 1))
+        self.state.apply(recv.CompanyInfo(company_id = 1, name = 'Company', manager_name = 'Manager', colour = 3,
+                                          passworded = False, startyear = 1950, is_ai = False,
+                                          bankrupcy_counter = 0, shareholder = [255] * 4))
+        self.state.apply(recv.CompanyUpdate(company_id = 1, name = 'Renamed', manager_name = 'Manager',
+                                            colour = 3, passworded = True, bankrupcy_counter = 0,
+                                            shareholder = [255] * 4))
+        self.state.apply(recv.CompanyEconomy(company_id = 1, money = 100, current_loan = 50, income = 10,
+                                             delivered = 5, history = []))
+        company = self.state.companies[1]
+        self.assertEqual((company.name, company.startyear, company.passworded, company.money),
+                         ('Renamed', 1950, True, 100))
+        self.assertEqual(self.changes[0], ('added', 'companies', 1, {}))
+        self.assertEqual(self.changes[2], ('updated', 'companies', 1, {
+            'name':         ('Company', 'Renamed'),
+            'passworded':   (False, True),
+        }))
+
+        self.state.apply(recv.CompanyRemove(company_id = 1, reason = 2))
+        self.assertEqual(self.state.companies, {})
+        self.assertEqual(self.changes[-1], ('removed', 'companies', 1, {'reason': (None, 2)}))
+
+    def test_snapshot_is_a_copy(self):
+        self.state.apply(recv.Date(date = datetime(1950, 1, 1)))
+        self.state.apply(self.client_info(2, 0))
+        snapshot = self.state.snapshot()
+        self.state.apply(recv.ClientUpdate(client_id = 2, name = 'Renamed', play_as = 0))
+        self.assertEqual(snapshot['clients'][2]['name'], 'Player')
+        self.assertEqual(snapshot['date'], datetime(1950, 1, 1))
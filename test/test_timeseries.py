@@ -0,0 +1,97 @@
+import unittest
+
+from datetime import datetime
+
+from libopenttd.admin import TimeSeriesStore, recv
+from libopenttd.admin.timeseries import RingBuffer
+from libopenttd.packets.fields import datetime_to_gamedate
+
+def economy(money, company_id = 1):
+    return recv.CompanyEconomy(company_id = company_id, money = money, current_loan = 100000, income = money // 10,
+                               delivered = 5, history = [{'value': money * 2, 'performance': 300, 'delivered': 40},
+                                                         {'value': 0, 'performance': 0, 'delivered': 0}])
+
+class TestTimeSeries(unittest.TestCase):
+    def test_ring_buffer(self):
+        ring = RingBuffer('i', 3)
+        for value in range(5):
+            ring.append(value)
+        self.assertEqual(len(ring), 3)
+        self.assertEqual(ring.to_list(), [2, 3, 4])
+        self.assertEqual(ring[0], 2)
+        self.assertEqual(ring[-1], 4)
+        ring[-1] = 10
+        self.assertEqual(ring.to_list(), [2, 3, 10])
+        self.assertRaises(IndexError, lambda: ring[3])
+
+    def test_samples(self):
+        store = TimeSeriesStore(capacity = 100)
+        base = datetime_to_gamedate(datetime(1950, 1, 1))
+        for day in range(120):
+            store.set_date('srv', base + day)
+            store.add_economy('srv', economy(1000 * day))
+        store.add_economy('srv', economy(5))
+
+        result = store.query('srv', 1, metrics = ['money', 'value'])
+        self.assertEqual(len(result['date']), 100)
+        self.assertEqual(result['date'][0], base + 20)
+        self.assertEqual(result['money'][0], 20000)
+        self.assertEqual(result['money'][-1], 5)
+        self.assertEqual(result['value'][0], 40000)
+
+        result = store.query('srv', 1, metrics = ['money'], start = datetime(1950, 3, 1), end = base + 70)
+        self.assertEqual(result['date'], list(range(base + 59, base + 70)))
+
+        result = store.query('srv', 1, metrics = ['income'], start = base + 20, end = base + 40, bucket = 10,
+                             how = 'mean')
+        buckets = {}
+        for date in range(base + 20, base + 40):
+            buckets.setdefault(date - date % 10, []).append(100 * (date - base))
+        self.assertEqual(result['date'], sorted(buckets))
+        self.assertEqual(result['income'], [sum(buckets[date]) / float(len(buckets[date])) for date in sorted(buckets)])
+
+        empty = store.query('srv', 2, kind = 'stats')
+        self.assertEqual(empty['date'], [])
+        self.assertEqual(empty['vehicles_train'], [])
+
+    def test_stats(self):
+        store = TimeSeriesStore()
+        store.set_date('srv', datetime(1950, 1, 1))
+        store.add_stats('srv', recv.CompanyStats(company_id = 0,
+                                                 vehicles = {'train': 3, 'lorry': 1, 'bus': 0, 'plane': 2, 'ship': 0},
+                                                 stations = {'train': 2, 'lorry': 1, 'bus': 0, 'plane': 1, 'ship': 0}))
+        result = store.query('srv', 0, kind = 'stats', metrics = ['vehicles_train', 'stations_plane'])
+        self.assertEqual(result, {'date': [datetime_to_gamedate(datetime(1950, 1, 1))],
+                                  'vehicles_train': [3], 'stations_plane': [1]})
+
+    def test_exact_money(self):
+        store = TimeSeriesStore()
+        store.set_date('srv', datetime(1950, 1, 1))
+        money = 2 ** 53 + 1
+        store.add_economy('srv', economy(money))
+        result = store.query('srv', 1, metrics = ['money'])
+        self.assertEqual(result['money'], [money])
+
+    def test_no_date(self):
+        store = TimeSeriesStore()
+        store.add_economy('srv', economy(1000))
+        store.add_economy('srv', economy(2000))
+        self.assertEqual(store.query('srv', 1, metrics = ['money'])['money'], [])
+        store.set_date('srv', datetime(1950, 1, 1))
+        store.add_economy('srv', economy(3000))
+        self.assertEqual(store.query('srv', 1, metrics = ['money'])['money'], [3000])
+
+    def test_date_goes_back(self):
+        store = TimeSeriesStore()
+        base = datetime_to_gamedate(datetime(1950, 1, 1))
+        for day in range(10):
+            store.set_date('srv', base + day)
+            store.add_economy('srv', economy(1000 * day))
+        # A save from an earlier date is loaded.
+        store.set_date('srv', base + 3)
+        store.add_economy('srv', economy(7))
+        result = store.query('srv', 1, metrics = ['money'], start = base)
+        self.assertEqual(result, {'date': [base + 3], 'money': [7]})
+
+if __name__ == '__main__':
+    unittest.main()